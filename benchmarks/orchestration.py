@@ -0,0 +1,244 @@
+"""
+Measures how the orchestration commands scale with the size and the
+shape of the dependency graph:
+
+    python -m benchmarks.orchestration [--graphs chain,fan,...]
+        [--size N] [--latency MS] [--jitter MS] [--workers W]
+        [--repeat N] [--save FILE] [--compare FILE]
+        [--max-regression PCT] [--min-regression-ms MS]
+
+For each graph (see GRAPHS) a config is generated and up, down, up again
+(restarting the stopped containers), run (of the last container) and
+remove (of the first one, with everything depending on it) are run on a
+fake docker engine (test.fake) answering each call after latency
+milliseconds plus up to jitter more, drawn from a seeded generator. The
+steps are repeated (5 times by default) and reported per step: the median
+wall time, the number of docker calls and, for the graph, the time to
+load the context and plan it. --save writes the results as json,
+--compare prints them next to a saved baseline and exits with 1 when the
+number of docker calls grew at all or a wall time grew by more than
+--max-regression percent (default 20) and more than --min-regression-ms
+(default 10), below which it is noise.
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+import dockman
+from dockman import context
+from test.fake import FakeEngine, LatencyDocker
+
+
+STEPS = ('up', 'down', 'restart', 'run', 'remove')
+
+
+def chain(size):
+    """
+    c0 <- c1 <- ... each container depending on the previous one.
+    """
+    return dict(('c%d' % i, ['c%d' % (i - 1)] if i else [])
+                for i in range(size))
+
+
+def fan(size):
+    """
+    One base container and all the others depending on it.
+    """
+    return dict(('c%d' % i, ['c0'] if i else []) for i in range(size))
+
+
+def diamond(size):
+    """
+    Layers of 4 containers, each one depending on all of the layer
+    below.
+    """
+    graph = {}
+    for i in range(size):
+        layer = i // 4
+        graph['c%d' % i] = ['c%d' % j
+                            for j in range(4 * (layer - 1), 4 * layer)
+                            if j >= 0]
+    return graph
+
+
+def large(size):
+    """
+    A random graph (always the same), each container depending on up to 3
+    of the previous ones.
+    """
+    rnd = random.Random(size)
+    graph = {}
+    for i in range(size):
+        count = min(i, rnd.randint(0, 3))
+        graph['c%d' % i] = sorted(set('c%d' % rnd.randrange(i)
+                                      for _ in range(count)))
+    return graph
+
+
+GRAPHS = {'chain': (chain, 50), 'fan': (fan, 50),
+          'diamond': (diamond, 48), 'large': (large, 500)}
+
+
+def config(graph):
+    containers = {}
+    for name, deps in graph.items():
+        containers[name] = {'image': 'image%d' % (int(name[1:]) % 5),
+                            'volumes_from': deps}
+    return {'containers': containers, 'groups': {'all': sorted(graph)}}
+
+
+def last(graph):
+    return 'c%d' % (len(graph) - 1)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def measure(graph, latency, jitter, repeat=1):
+    """
+    Returns the median times of repeat runs of the steps on graph.
+    """
+    runs = [measure_once(graph, latency, jitter) for _ in range(repeat)]
+    result = {'context': median([r['context'] for r in runs]),
+              'plan': median([r['plan'] for r in runs])}
+    for step in STEPS:
+        result[step] = {'time': median([r[step]['time'] for r in runs]),
+                        'calls': max(r[step]['calls'] for r in runs)}
+    return result
+
+
+def measure_once(graph, latency, jitter):
+    result = {}
+
+    t0 = time.time()
+    ctx = context.Context(path='bench', config=config(graph))
+    t1 = time.time()
+    ctx.plan(ctx.groups['all'])
+    t2 = time.time()
+    result['context'] = t1 - t0
+    result['plan'] = t2 - t1
+
+    engine = FakeEngine()
+    steps = (('up', lambda: ctx.up('all')),
+             ('down', lambda: ctx.down('all')),
+             ('restart', lambda: ctx.up('all')),
+             ('run', lambda: ctx.run(False, last(graph), [])),
+             ('remove', lambda: ctx.remove('c0')))
+
+    stdout = sys.stdout
+    for name, step in steps:
+        docker = LatencyDocker(engine, latency, jitter)
+        dockman.CONTEXT, dockman.DOCKER = ctx, docker
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            t0 = time.time()
+            step()
+            elapsed = time.time() - t0
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        result[name] = {'time': elapsed,
+                        'calls': sum(docker.calls.values())}
+
+    return result
+
+
+def compare(results, baseline, max_regression, min_regression=0):
+    failed = False
+    for graph in sorted(results):
+        for step in STEPS:
+            new = results[graph][step]
+            old = baseline.get(graph, {}).get(step)
+            line = '%-8s %-8s %8.1f ms %5d calls' % (
+                graph, step, new['time'] * 1000, new['calls'])
+            if old:
+                change = (new['time'] - old['time']) / old['time'] * 100
+                line += '   was %8.1f ms %5d calls (%+.0f%%)' % (
+                    old['time'] * 1000, old['calls'], change)
+                slower = (change > max_regression and
+                          new['time'] - old['time'] > min_regression)
+                if slower or new['calls'] > old['calls']:
+                    line += '  REGRESSION'
+                    failed = True
+            print(line)
+    return failed
+
+
+def report(results):
+    for graph in sorted(results):
+        result = results[graph]
+        print('%-8s context %.1f ms, plan %.1f ms' % (
+            graph, result['context'] * 1000, result['plan'] * 1000))
+        for step in STEPS:
+            print('%-8s %-8s %8.1f ms %5d calls' % (
+                graph, step, result[step]['time'] * 1000,
+                result[step]['calls']))
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog='benchmarks.orchestration')
+    parser.add_argument('--graphs', default=','.join(sorted(GRAPHS)),
+                        help='comma separated graphs among %s' %
+                        ', '.join(sorted(GRAPHS)))
+    parser.add_argument('--size', type=int,
+                        help='containers per graph (default per graph)')
+    parser.add_argument('--latency', type=float, default=5.0,
+                        help='ms per docker call')
+    parser.add_argument('--jitter', type=float, default=1.0,
+                        help='up to this many ms more per call')
+    parser.add_argument('--workers', help='sets DOCKMAN_WORKERS')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of the steps, the median is kept')
+    parser.add_argument('--save', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE')
+    parser.add_argument('--max-regression', type=float, default=20.0,
+                        metavar='PCT')
+    parser.add_argument('--min-regression-ms', type=float, default=10.0,
+                        metavar='MS')
+    options = parser.parse_args(args)
+
+    options.graphs = options.graphs.split(',')
+    for name in options.graphs:
+        if name not in GRAPHS:
+            parser.error('unknown graph: %s' % name)
+    if options.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    return options
+
+
+def main(args):
+    options = parse_args(args)
+    if options.workers:
+        os.environ['DOCKMAN_WORKERS'] = options.workers
+
+    results = {}
+    for name in options.graphs:
+        generate, default_size = GRAPHS[name]
+        graph = generate(options.size or default_size)
+        results[name] = measure(graph, options.latency / 1000,
+                                options.jitter / 1000, options.repeat)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        failed = compare(results, baseline, options.max_regression,
+                         options.min_regression_ms / 1000)
+        return 1 if failed else 0
+
+    report(results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
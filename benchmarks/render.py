@@ -0,0 +1,76 @@
+"""
+Measures how many log lines per second `dockman logs` can write:
+
+    python -m benchmarks.render [--lines N] [--containers K] [--batch B]
+        [--color]
+
+The lines are written to /dev/null through logs.Renderer in batches of
+B lines, and for comparison with one click.secho + click.echo per line,
+as dockman wrote them before the renderer.
+"""
+from __future__ import absolute_import
+
+import argparse
+import os
+import sys
+import time
+
+from dockman import utils
+from dockman.logs import Renderer
+
+
+def batches(lines, containers, batch):
+    names = [u'project.container%s' % i for i in range(containers)]
+    line = 'x' * 80
+    ret = []
+    for start in range(0, lines, batch):
+        size = min(batch, lines - start)
+        ret.append([(names[(start + i) % containers], [line])
+                    for i in range(size)])
+    return ret
+
+
+def per_line(devnull, batch_list):
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        for batch in batch_list:
+            for name, lines in batch:
+                for line in lines:
+                    utils.yellow_(name + ': ')
+                    utils.echo(line)
+    finally:
+        sys.stdout = stdout
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog='benchmarks.render')
+    parser.add_argument('--lines', type=int, default=100000)
+    parser.add_argument('--containers', type=int, default=10)
+    parser.add_argument('--batch', type=int, default=500,
+                        help='lines per batch')
+    parser.add_argument('--color', action='store_true')
+    return parser.parse_args(args)
+
+
+def main(args):
+    options = parse_args(args)
+    lines = options.lines
+
+    batch_list = batches(lines, options.containers, options.batch)
+    with open(os.devnull, 'wb') as devnull:
+        renderer = Renderer(devnull, color=options.color)
+        t0 = time.time()
+        for b in batch_list:
+            renderer.write(b)
+        renderer_time = time.time() - t0
+
+        t0 = time.time()
+        per_line(devnull, batch_list)
+        per_line_time = time.time() - t0
+
+    print('renderer  %10.0f lines/s' % (lines / renderer_time))
+    print('per line  %10.0f lines/s' % (lines / per_line_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,121 @@
+"""
+Measures the startup cost of the command line tool:
+
+    python -m benchmarks.startup [--runs N] [--config DIR]
+        [--max-help-ms MS] [--max-ps-ms MS]
+
+"help" is the wall time of a whole `python -m dockman --help` process,
+"ps" is the time spent importing the commands, loading the context from
+the dockman.yaml in DIR (by default a copy of test/test9.yaml) and
+creating the docker backend, as `dockman ps` does before calling docker.
+Exits with 1 when a median exceeds its limit.
+"""
+from __future__ import absolute_import
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CONFIG = os.path.join(ROOT, 'test', 'test9.yaml')
+
+
+def child_ps(config_dir):
+    os.chdir(config_dir)
+    t0 = time.time()
+    from dockman import dockman  # noqa
+    from dockman import utils
+    t1 = time.time()
+    utils.get_context()
+    t2 = time.time()
+    utils.get_docker()
+    t3 = time.time()
+    print(json.dumps({'import': t1 - t0, 'context': t2 - t1,
+                      'docker': t3 - t2, 'total': t3 - t0}))
+
+
+def run(cmd, cwd):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    t0 = time.time()
+    output = subprocess.check_output(cmd, cwd=cwd, env=env)
+    return time.time() - t0, output
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog='benchmarks.startup')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='runs of each measure, the median is kept')
+    parser.add_argument('--config', metavar='DIR',
+                        help='directory of the dockman.yaml to load')
+    parser.add_argument('--max-help-ms', type=float, metavar='MS')
+    parser.add_argument('--max-ps-ms', type=float, metavar='MS')
+    # run by measure in a fresh process
+    parser.add_argument('--child-ps', metavar='DIR', help=argparse.SUPPRESS)
+    options = parser.parse_args(args)
+    if options.runs < 1:
+        parser.error('--runs must be at least 1')
+    return options
+
+
+def main(args):
+    options = parse_args(args)
+    if options.child_ps:
+        return child_ps(options.child_ps)
+
+    runs = options.runs
+    config_dir = options.config and os.path.abspath(options.config)
+    limits = {}
+    if options.max_help_ms is not None:
+        limits['help'] = options.max_help_ms
+    if options.max_ps_ms is not None:
+        limits['ps'] = options.max_ps_ms
+
+    if config_dir is None:
+        config_dir = tempfile.mkdtemp()
+        shutil.copy(DEFAULT_CONFIG, os.path.join(config_dir, 'dockman.yaml'))
+        try:
+            return measure(runs, config_dir, limits)
+        finally:
+            shutil.rmtree(config_dir)
+    return measure(runs, config_dir, limits)
+
+
+def measure(runs, config_dir, limits):
+    results = {'help': [], 'ps': [], 'import': [], 'context': []}
+    for _ in range(runs):
+        elapsed, _ = run([sys.executable, '-m', 'dockman', '--help'],
+                         config_dir)
+        results['help'].append(elapsed)
+
+        _, output = run([sys.executable, '-m', 'benchmarks.startup',
+                         '--child-ps', config_dir], ROOT)
+        timings = json.loads(output)
+        results['ps'].append(timings['total'])
+        results['import'].append(timings['import'])
+        results['context'].append(timings['context'])
+
+    failed = False
+    for name in ('help', 'ps', 'import', 'context'):
+        ms = median(results[name]) * 1000
+        line = '%-8s %8.1f ms' % (name, ms)
+        if name in limits and ms > limits[name]:
+            line += '  > %.1f ms' % limits[name]
+            failed = True
+        print(line)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,6 +1,6 @@
 from __future__ import absolute_import
 
-from .dockman import main
+from .dockman import cli
 
 
-main()
+cli()
@@ -0,0 +1,306 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import errno
+import hashlib
+import json
+import os
+import socket
+import stat
+import sys
+import tempfile
+
+# This module is imported by every command line call to find out whether
+# an agent is running: it must stay cheap, the rest of dockman is only
+# imported by the agent itself.
+
+# commands the agent runs, the others (interactive, following logs) are
+# always run in process
+FORWARDED = ('ps', 'up', 'down', 'remove', 'run', 'pull')
+
+CONFIG_FILENAME = 'dockman.yaml'
+
+
+def find_project(path=None):
+    """
+    Returns the directory of the config file the context would load from
+    path (the current directory by default), None if there is none.
+    """
+    if path is None:
+        path = os.getcwd()
+    while True:
+        if os.path.isfile(os.path.join(path, CONFIG_FILENAME)):
+            return path
+        head, tail = os.path.split(path)
+        if not tail:
+            return None
+        path = head
+
+
+def runtime_dir():
+    """
+    Returns the directory of the agent sockets of the user: XDG_RUNTIME_DIR
+    if set, a dockman-<uid> directory in the temp directory otherwise,
+    created 0700. Raises RuntimeError if the latter is not a directory
+    only the user can access.
+    """
+    path = os.environ.get('XDG_RUNTIME_DIR')
+    if path:
+        return path
+
+    path = os.path.join(tempfile.gettempdir(), 'dockman-%s' % os.getuid())
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise RuntimeError('Can not create %s: %s' % (path, e))
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or
+            st.st_mode & 0o077):
+        raise RuntimeError('%s is not a private directory' % path)
+    return path
+
+
+def socket_path(project_path):
+    """
+    Returns the socket of the agent of a project, DOCKMAN_AGENT_SOCKET if
+    set, a file named after the project directory in runtime_dir
+    otherwise.
+    """
+    path = os.environ.get('DOCKMAN_AGENT_SOCKET')
+    if path:
+        return path
+    digest = hashlib.sha1(os.path.abspath(project_path)).hexdigest()[:12]
+    return os.path.join(runtime_dir(), 'dockman-%s.sock' % digest)
+
+
+def forwarded(args):
+    if not args or args[0] not in FORWARDED:
+        return False
+    return not ('-i' in args or '--interactive' in args)
+
+
+def connect(path):
+    """
+    Returns a socket connected to path, None if there is no agent there or
+    it is not one of the user.
+    """
+    try:
+        if os.stat(path).st_uid != os.getuid():
+            return None
+    except OSError:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def send(sock, message):
+    sock.sendall(json.dumps(message) + '\n')
+
+
+def forward(args, cwd=None, stdout=None):
+    """
+    Runs the command line args on the agent of the project if one is
+    running and the command can be forwarded, writing its output to
+    stdout. Returns the exit code, or None if the command is to be run in
+    process. DOCKMAN_NO_AGENT disables forwarding.
+    """
+    if os.environ.get('DOCKMAN_NO_AGENT') or not forwarded(args):
+        return None
+    project = find_project(cwd)
+    if project is None:
+        return None
+    try:
+        sock = connect(socket_path(project))
+    except RuntimeError:
+        return None
+    if sock is None:
+        return None
+
+    stdout = stdout or sys.stdout
+    isatty = getattr(stdout, 'isatty', None)
+    try:
+        send(sock, {'args': list(args), 'tty': bool(isatty and isatty())})
+        for line in sock.makefile('rb'):
+            message = json.loads(line)
+            if 'out' in message:
+                stdout.write(message['out'].encode('utf-8'))
+                stdout.flush()
+            elif 'exit' in message:
+                return message['exit']
+    except (socket.error, ValueError):
+        pass
+    finally:
+        sock.close()
+
+    stdout.write('Lost connection to the dockman agent\n')
+    return 1
+
+
+def stop(cwd=None):
+    """
+    Stops the agent of the project, returns whether one was running.
+    """
+    project = find_project(cwd)
+    try:
+        sock = project and connect(socket_path(project))
+    except RuntimeError:
+        return False
+    if not sock:
+        return False
+    try:
+        send(sock, {'stop': True})
+        sock.recv(1)
+    finally:
+        sock.close()
+    return True
+
+
+class Output(object):
+    """
+    The stdout of a command run by the agent, sending every write to the
+    client.
+    """
+    def __init__(self, wfile, tty):
+        self.wfile = wfile
+        self.tty = tty
+
+    def isatty(self):
+        return self.tty
+
+    def write(self, data):
+        if not isinstance(data, unicode):
+            data = data.decode('utf-8', 'replace')
+        if data:
+            self.wfile.write(json.dumps({'out': data}) + '\n')
+            self.wfile.flush()
+
+    def flush(self):
+        pass
+
+
+def default_backend():
+    """
+    Returns the backend of the agent when the config gives none: api,
+    unless docker is run with sudo or its socket is not accessible.
+    """
+    from .api import DEFAULT_SOCKET
+
+    if os.environ.get('DOCKMAN_SUDO'):
+        return 'cli'
+    path = os.environ.get('DOCKMAN_SOCKET', DEFAULT_SOCKET)
+    return 'api' if os.access(path, os.R_OK | os.W_OK) else 'cli'
+
+
+class Agent(object):
+    """
+    Keeps the context of a project and its docker backend (see
+    default_backend, unless the config or DOCKMAN_BACKEND says otherwise)
+    loaded and runs the forwarded commands with them, one at a time. The
+    context is reloaded when the config file changes.
+    """
+    def __init__(self, project_path):
+        self.project_path = project_path
+        self.config_path = os.path.join(project_path, CONFIG_FILENAME)
+        self.config_stat = None
+        self.load()
+
+    def stat(self):
+        st = os.stat(self.config_path)
+        return st.st_mtime, st.st_size
+
+    def load(self):
+        import dockman
+        from . import context
+        from . import docker
+
+        self.config_stat = self.stat()
+        dockman.CONTEXT = context.Context(path=self.project_path)
+        dockman.DOCKER = docker.from_env(
+            dockman.CONTEXT.config.get('backend') or default_backend())
+
+    def refresh(self):
+        try:
+            changed = self.stat() != self.config_stat
+        except OSError:
+            changed = False
+        if changed:
+            self.load()
+
+    def execute(self, args, stdout):
+        """
+        Runs the command line args with the output going to stdout,
+        returns the exit code.
+        """
+        from .dockman import main
+        from .utils import WrongConfigException
+
+        saved = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = stdout
+        try:
+            self.refresh()
+            main.main(args=list(args), prog_name='dockman')
+        except WrongConfigException as e:
+            stdout.write('%s\n' % e)
+            return 1
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            stdout.write('%s\n' % e.code)
+            return 1
+        except Exception as e:
+            stdout.write('%s: %s\n' % (type(e).__name__, e))
+            return 1
+        finally:
+            sys.stdout, sys.stderr = saved
+        return 0
+
+    def serve(self, path=None):
+        """
+        Serves the clients on the project's socket until stopped.
+        """
+        import SocketServer
+
+        agent = self
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline())
+                except ValueError:
+                    return
+                if request.get('stop'):
+                    self.server.stopped = True
+                    return
+                code = agent.execute(request['args'],
+                                     Output(self.wfile, request.get('tty')))
+                self.wfile.write(json.dumps({'exit': code}) + '\n')
+
+        path = path or socket_path(self.project_path)
+        if os.path.exists(path):
+            sock = connect(path)
+            if sock:
+                sock.close()
+                raise RuntimeError('An agent is already running on %s' %
+                                   path)
+            os.remove(path)
+
+        # no window where others could connect
+        umask = os.umask(0o177)
+        try:
+            server = SocketServer.UnixStreamServer(path, Handler)
+        finally:
+            os.umask(umask)
+        server.stopped = False
+        try:
+            while not server.stopped:
+                server.handle_request()
+        finally:
+            server.server_close()
+            os.remove(path)
@@ -0,0 +1,381 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import httplib
+import json
+import socket
+import struct
+import threading
+import urllib
+
+from . import events
+from . import logs
+from . import trace
+from .docker import Docker, DockerError, NOT_CACHED
+
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """
+    HTTP/1.1 connection over a unix socket, kept alive between requests.
+    """
+    def __init__(self, socket_path, timeout=None):
+        httplib.HTTPConnection.__init__(self, 'localhost')
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class LogStream(object):
+    """
+    A followed log stream of one container, mimicking the part of
+    subprocess.Popen the log multiplexer relies on: stdout, poll, wait,
+    terminate. The stream is read over a dedicated HTTP/1.0 connection,
+    so the body is neither chunked nor shared with other requests.
+    """
+    def __init__(self, socket_path, path, multiplexed):
+        self.multiplexed = multiplexed
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_path)
+        self.sock.sendall('GET %s HTTP/1.0\r\nHost: docker\r\n\r\n' % path)
+        self.raw = self.sock.makefile('rb', 0)
+        self.closed = False
+        self.buffer = ''
+
+        status_line = self.raw.readline()
+        status = int(status_line.split()[1])
+        while self.raw.readline() not in ('\r\n', '\n', ''):
+            pass
+        if status >= 400:
+            message = self.raw.read()
+            self.close()
+            raise DockerError(message)
+
+        self.stdout = self
+
+    def read_payload(self):
+        """
+        Returns the next piece of payload or '' at the end of the stream.
+        """
+        if not self.multiplexed:
+            return self.sock.recv(4096) if not self.closed else ''
+
+        while not self.closed:
+            header = self.raw.read(8)
+            if len(header) < 8:
+                return ''
+            _, size = struct.unpack('>BxxxL', header)
+            if size:
+                return self.raw.read(size)
+        return ''
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_chunk(self):
+        try:
+            return self.read_payload()
+        except (socket.error, ValueError):
+            return ''
+
+    def readline(self):
+        while '\n' not in self.buffer:
+            payload = self.read_chunk()
+            if not payload:
+                line, self.buffer = self.buffer, ''
+                return line
+            self.buffer += payload
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line + '\n'
+
+    def poll(self):
+        return 0 if self.closed else None
+
+    def wait(self):
+        return 0
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.sock.close()
+
+    terminate = close
+
+
+class APIDocker(Docker):
+    """
+    Talks to the Docker Engine API directly over the unix socket instead
+    of forking the docker client for every call. Interactive runs still
+    go through the client, as they need the terminal.
+    """
+    def __init__(self, socket_path=DEFAULT_SOCKET, **kwargs):
+        super(APIDocker, self).__init__(**kwargs)
+        self.socket_path = socket_path
+        self.local = threading.local()
+
+    @property
+    def connection(self):
+        conn = getattr(self.local, 'connection', None)
+        if conn is None:
+            conn = UnixHTTPConnection(self.socket_path)
+            self.local.connection = conn
+        return conn
+
+    def request(self, method, path, params=None, body=None):
+        """
+        Returns (status, data) where data is the decoded json body or the
+        raw body when it is not json. The request is retried once on a
+        new connection if the kept-alive one went away.
+        """
+        if params:
+            path += '?' + urllib.urlencode(params)
+
+        headers = {}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+
+        with trace.span('%s %s' % (method, path.partition('?')[0]), 'api',
+                        argv=[method, path]) as span:
+            for attempt in (1, 2):
+                conn = self.connection
+                try:
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                    data = response.read()
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    self.local.connection = None
+                    if attempt == 2:
+                        raise
+                else:
+                    break
+            span.note('status', response.status)
+
+        if response.getheader('Content-Type', '').startswith(
+                'application/json') and data:
+            try:
+                data = json.loads(data)
+            except ValueError:
+                pass
+
+        return response.status, data
+
+    def check(self, status, data):
+        if status >= 400:
+            if isinstance(data, dict):
+                data = data.get('message', data)
+            raise DockerError(data)
+        return data
+
+    def quote(self, name):
+        return urllib.quote(name, safe='')
+
+    def pull(self, image):
+        repo, _, tag = image.rpartition(':')
+        if not repo or '/' in tag:
+            repo, tag = image, 'latest'
+        status, data = self.request('POST', '/images/create',
+                                    {'fromImage': repo, 'tag': tag})
+        self.check(status, data)
+        # the body is a stream of json progress messages
+        for line in str(data).splitlines():
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if 'error' in message:
+                raise DockerError(message['error'])
+
+    def local_images(self):
+        data = self.check(*self.request('GET', '/images/json'))
+        images = set()
+        for image in data:
+            for tag in image.get('RepoTags') or []:
+                if '<none>' not in tag:
+                    images.add(tag)
+        return images
+
+    def create(self, image, name='', volumes_from=[], volumes={},
+               ports={}, links={}, env={}, cmd=[], labels={},
+               stop_signal=None):
+        exposed = {}
+        bindings = {}
+        for host_port, container_port in ports.items():
+            container_port = str(container_port)
+            if '/' not in container_port:
+                container_port += '/tcp'
+            exposed[container_port] = {}
+            bindings.setdefault(container_port, []).append(
+                {'HostPort': str(host_port)})
+
+        config = {
+            'Image': image,
+            'Env': ['%s=%s' % (k, v) for k, v in env.items()],
+            'ExposedPorts': exposed,
+            'HostConfig': {
+                'Binds': ['%s:%s' % v for v in volumes.items()],
+                'PortBindings': bindings,
+                'Links': ['%s:%s' % link for link in links.items()],
+                'VolumesFrom': list(volumes_from),
+            }
+        }
+        if cmd:
+            config['Cmd'] = list(cmd)
+        if labels:
+            config['Labels'] = dict(labels)
+        if stop_signal:
+            config['StopSignal'] = stop_signal
+
+        params = {'name': name} if name else None
+        status, data = self.request('POST', '/containers/create',
+                                    params, config)
+        if status == 404 and 'image' in str(data).lower():
+            self.pull(image)
+            status, data = self.request('POST', '/containers/create',
+                                        params, config)
+        return self.check(status, data)['Id']
+
+    def run(self, image, daemon=True, interactive=False,
+            remove=False, name='', volumes_from=[], volumes={},
+            ports={}, links={}, env={}, cmd=[], labels={},
+            stop_signal=None):
+
+        if not daemon:
+            return super(APIDocker, self).run(
+                image, daemon=daemon, interactive=interactive,
+                remove=remove, name=name, volumes_from=volumes_from,
+                volumes=volumes, ports=ports, links=links, env=env, cmd=cmd,
+                labels=labels, stop_signal=stop_signal)
+
+        container_id = self.create(image, name=name,
+                                   volumes_from=volumes_from,
+                                   volumes=volumes, ports=ports,
+                                   links=links, env=env, cmd=cmd,
+                                   labels=labels, stop_signal=stop_signal)
+        self.start(container_id)
+        if name:
+            self.set_state(name, True)
+        return container_id + '\n'
+
+    def start(self, container_name):
+        path = '/containers/%s/start' % self.quote(container_name)
+        self.check(*self.request('POST', path))
+        self.set_state(container_name, True)
+
+    def stop(self, container_name, timeout=None):
+        params = {}
+        if timeout is not None:
+            params['t'] = timeout
+        path = '/containers/%s/stop' % self.quote(container_name)
+        self.check(*self.request('POST', path, params))
+        self.set_state(container_name, False)
+
+    def remove(self, container_name):
+        path = '/containers/%s' % self.quote(container_name)
+        self.check(*self.request('DELETE', path, {'v': 1}))
+        self.set_state(container_name, None)
+
+    def start_many(self, container_names):
+        return self.each(self.start, container_names)
+
+    def stop_many(self, container_names, timeout=None):
+        return self.each(self.stop, container_names, timeout=timeout)
+
+    def remove_many(self, container_names):
+        return self.each(self.remove, container_names)
+
+    def inspect(self, container_name):
+        path = '/containers/%s/json' % self.quote(container_name)
+        return self.check(*self.request('GET', path))
+
+    def ip_address(self, container_name):
+        try:
+            info = self.inspect(container_name)
+        except DockerError:
+            return None
+        return info.get('NetworkSettings', {}).get('IPAddress') or None
+
+    def project_states(self, project):
+        prefix = project + '.'
+        filters = json.dumps({'name': [prefix]})
+        data = self.check(*self.request('GET', '/containers/json',
+                                        {'all': 1, 'filters': filters}))
+        states = {}
+        for c in data:
+            for name in c.get('Names', []):
+                name = name[1:]
+                if name.startswith(prefix) and '/' not in name:
+                    states[name] = c.get('State') == 'running'
+        return states
+
+    def project_labels(self, project, key):
+        prefix = project + '.'
+        filters = json.dumps({'name': [prefix]})
+        data = self.check(*self.request('GET', '/containers/json',
+                                        {'all': 1, 'filters': filters}))
+        labels = {}
+        for c in data:
+            for name in c.get('Names', []):
+                name = name[1:]
+                if name.startswith(prefix) and '/' not in name:
+                    labels[name] = (c.get('Labels') or {}).get(key)
+        return labels
+
+    def getstate(self, container_name):
+        state = self.cached_state(container_name)
+        if state is not NOT_CACHED:
+            return state
+
+        try:
+            info = self.inspect(container_name)
+        except DockerError:
+            return None
+        return bool(info['State']['Running'])
+
+    @property
+    def container_ids(self):
+        data = self.check(*self.request('GET', '/containers/json',
+                                        {'all': 1}))
+        return [c['Id'] for c in data]
+
+    @property
+    def container_info(self):
+        return [self.inspect(cid) for cid in self.container_ids]
+
+    def events_process(self, since=None):
+        filters = {'type': ['container'], 'event': list(events.EVENTS)}
+        params = {'filters': json.dumps(filters)}
+        if since is not None:
+            params['since'] = '%.9f' % since
+        path = '/events?%s' % urllib.urlencode(params)
+        return LogStream(self.socket_path, path, multiplexed=False)
+
+    def logs_process(self, container_name, follow=True, timestamps=False,
+                     since=None, until=None, tail=None):
+        tty = self.inspect(container_name)['Config'].get('Tty', False)
+        params = {'follow': int(follow), 'stdout': 1, 'stderr': 1,
+                  'timestamps': int(timestamps)}
+        if since is None and until is None and tail is None:
+            tail = 0 if follow else None
+        if since is not None:
+            params['since'] = '%.9f' % logs.to_epoch(since)
+        if until is not None:
+            params['until'] = '%.9f' % logs.to_epoch(until)
+        params['tail'] = 'all' if tail is None else tail
+        params = urllib.urlencode(params)
+        path = '/containers/%s/logs?%s' % (self.quote(container_name),
+                                           params)
+        return LogStream(self.socket_path, path, multiplexed=not tty)
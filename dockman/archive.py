@@ -0,0 +1,276 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import bisect
+import fnmatch
+import gzip
+import os
+import signal
+import sys
+import time
+
+from . import logs
+
+
+# rotate a segment when it is this big (compressed) or this old
+MAX_BYTES = 64 * 1024 * 1024
+MAX_AGE = 24 * 3600
+
+# lines compressed into one gzip member, one index entry each
+BLOCK_LINES = 1000
+# seconds lines may wait in memory before written anyway
+FLUSH_INTERVAL = 5
+
+SEGMENT_SUFFIX = '.log.gz'
+INDEX_SUFFIX = '.idx'
+
+
+class Segment(object):
+    """
+    An archive segment of one container: a gzip file made of independent
+    members, one per block of lines, and an index file with a
+    "<timestamp of the block's first line> <offset of the member>" line
+    for each of them. Reading can start at any indexed offset.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+    def open(self):
+        self.file = open(self.path, 'ab')
+        self.index = open(self.index_path, 'ab')
+        self.started = time.time()
+
+    @property
+    def size(self):
+        return self.file.tell()
+
+    def write_block(self, lines):
+        offset = self.file.tell()
+        member = gzip.GzipFile(fileobj=self.file, mode='wb')
+        member.write(''.join(line + '\n' for line in lines))
+        member.close()
+        self.file.flush()
+
+        timestamp = lines[0].partition(' ')[0]
+        self.index.write('%s %d\n' % (timestamp, offset))
+        self.index.flush()
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+    def entries(self):
+        """
+        Returns the (timestamp, offset) index entries.
+        """
+        ret = []
+        try:
+            with open(self.index_path, 'rb') as f:
+                for line in f:
+                    timestamp, _, offset = line.strip().partition(' ')
+                    if offset:
+                        ret.append((timestamp, int(offset)))
+        except IOError:
+            pass
+        return ret
+
+    def lines(self, since=None):
+        """
+        Yields the timestamped lines of the segment, starting at the last
+        block beginning before since.
+        """
+        entries = self.entries()
+        offset = 0
+        if since is not None and entries:
+            pos = bisect.bisect_right([e[0] for e in entries], since)
+            offset = entries[max(pos - 1, 0)][1]
+
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in gzip.GzipFile(fileobj=f, mode='rb'):
+                yield line.rstrip('\n')
+
+
+class ContainerArchive(object):
+    """
+    The segments of one container in a directory, named by sequence
+    number so that they sort in time order.
+    """
+    def __init__(self, directory, max_bytes=MAX_BYTES, max_age=MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment = None
+        self.pending = []
+        self.pending_since = None
+
+    def segments(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        names = sorted(n for n in names if n.endswith(SEGMENT_SUFFIX))
+        return [Segment(os.path.join(self.directory, n)) for n in names]
+
+    def rotate(self):
+        if self.segment:
+            self.segment.close()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        segments = self.segments()
+        if segments:
+            last = os.path.basename(segments[-1].path)
+            number = int(last[:-len(SEGMENT_SUFFIX)]) + 1
+        else:
+            number = 1
+        path = os.path.join(self.directory,
+                            '%08d%s' % (number, SEGMENT_SUFFIX))
+        self.segment = Segment(path)
+        self.segment.open()
+
+    def write(self, lines):
+        if not self.pending:
+            self.pending_since = time.time()
+        self.pending.extend(lines)
+        while len(self.pending) >= BLOCK_LINES:
+            self.write_block(self.pending[:BLOCK_LINES])
+            self.pending = self.pending[BLOCK_LINES:]
+        self.flush_expired()
+
+    def flush_expired(self):
+        """
+        Writes the pending lines if the oldest waited FLUSH_INTERVAL.
+        """
+        if (self.pending and
+                time.time() - self.pending_since >= FLUSH_INTERVAL):
+            self.flush()
+
+    def write_block(self, lines):
+        if (self.segment is None or self.segment.size >= self.max_bytes or
+                time.time() - self.segment.started >= self.max_age):
+            self.rotate()
+        self.segment.write_block(lines)
+
+    def flush(self):
+        if self.pending:
+            self.write_block(self.pending)
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        if self.segment:
+            self.segment.close()
+            self.segment = None
+
+    def lines(self, since=None, until=None):
+        """
+        Yields (timestamp, name, line) of the archived lines between since
+        and until (RFC 3339 strings as docker prints them), skipping the
+        segments and blocks entirely before since without reading them.
+        """
+        name = os.path.basename(self.directory)
+        segments = self.segments()
+        if since is not None:
+            firsts = [(s.entries() or [(None, 0)])[0][0] for s in segments]
+            start = 0
+            for i, first in enumerate(firsts):
+                if first is not None and first <= since:
+                    start = i
+            segments = segments[start:]
+
+        for segment in segments:
+            for line in segment.lines(since):
+                timestamp, _, line = line.partition(' ')
+                if since is not None and timestamp < since:
+                    continue
+                if until is not None and timestamp > until:
+                    return
+                yield timestamp, name, line
+
+
+class Archive(object):
+    """
+    Writes the timestamped log lines of the containers (as docker logs -t
+    prints them) into DIRECTORY/<container>/ segments, see Segment.
+    """
+    def __init__(self, directory, max_bytes=MAX_BYTES, max_age=MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.containers = {}
+
+    def container(self, name):
+        archive = self.containers.get(name)
+        if archive is None:
+            archive = ContainerArchive(os.path.join(self.directory, name),
+                                       self.max_bytes, self.max_age)
+            self.containers[name] = archive
+        return archive
+
+    def write(self, batch):
+        for name, lines in batch:
+            self.container(name).write(lines)
+
+    def tick(self):
+        """
+        Flushes the containers gone quiet, to be called regularly even
+        when no lines come.
+        """
+        for archive in self.containers.values():
+            archive.flush_expired()
+
+    def close(self):
+        for archive in self.containers.values():
+            archive.close()
+
+    def names(self, patterns=()):
+        try:
+            names = sorted(os.listdir(self.directory))
+        except OSError:
+            return []
+        if patterns:
+            names = [n for n in names
+                     if any(fnmatch.fnmatchcase(n, p) or
+                            fnmatch.fnmatchcase(n.partition('.')[2], p)
+                            for p in patterns)]
+        return names
+
+    def history(self, patterns=(), since=None, until=None):
+        """
+        Yields (timestamp, name, line) of the archived containers matching
+        the patterns, in time order.
+        """
+        if since is not None:
+            since = logs.epoch_to_rfc3339(logs.to_epoch(since))
+        if until is not None:
+            until = logs.epoch_to_rfc3339(logs.to_epoch(until))
+
+        iterators = [self.container(name).lines(since, until)
+                     for name in self.names(patterns)]
+        return logs.merge_history(iterators)
+
+
+def close_on_sigterm(archive):
+    """
+    Makes SIGTERM (how a dockman logs run in the background is usually
+    ended) close archive, writing the pending lines, before exiting.
+    """
+    def terminate(signum, frame):
+        archive.close()
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, terminate)
+
+
+def print_history(directory, patterns=(), since=None, until=None,
+                  line_filter=None, color=None):
+    items = Archive(directory).history(patterns, since, until)
+    if line_filter:
+        items = (item for item in items if line_filter.match(item[2]))
+
+    renderer = logs.Renderer(color=color)
+    for batch in logs.batched(items):
+        renderer.write(batch)
@@ -2,11 +2,18 @@
 
 from __future__ import absolute_import
 
+import hashlib
+import json
 import os
 
 import dockman
 from . import utils
 from . import docker
+from . import readiness
+
+
+# label holding the hash of the run arguments a container was created with
+HASH_LABEL = 'dockman.hash'
 
 
 class Container(object):
@@ -59,6 +66,15 @@ class Container(object):
         # icmd: default command when interactive
         self.icmd = config.get('icmd', '').split()
 
+        # stop_timeout: seconds docker stop waits before killing,
+        # stop_signal: the signal it sends, given at creation
+        self.stop_timeout = config.get('stop_timeout')
+        self.stop_signal = config.get('stop_signal')
+
+        # ready: how to tell that the container is ready for its dependents
+        self.ready = config.get('ready')
+        readiness.check_config(self.full_name, self.ready)
+
     @property
     def dependencies(self):
         """
@@ -69,6 +85,35 @@ class Container(object):
         deps = deps.union(set(self.links.keys()))
         return deps
 
+    def run_args(self, extra=[]):
+        """
+        Returns the arguments of docker run for the container (but the
+        labels), with the given command instead of cmd if any.
+        """
+        args = {'image': self.image,
+                'volumes_from': self.project_volumes_from,
+                'volumes': self.volumes,
+                'ports': self.ports,
+                'links': self.project_links,
+                'env': dict(self.env, container_name=self.full_name),
+                'cmd': extra or self.cmd}
+        # only when set, not to change the hash of the other containers
+        if self.stop_signal:
+            args['stop_signal'] = self.stop_signal
+        return args
+
+    @property
+    def config_hash(self):
+        """
+        Hash of the resolved run arguments, stored in the HASH_LABEL label
+        of the container so that changes of the config can be detected.
+        """
+        return self.args_hash(self.run_args())
+
+    def args_hash(self, args):
+        data = json.dumps(args, sort_keys=True)
+        return hashlib.sha1(data).hexdigest()
+
     @property
     def next_postfix(self):
         """
@@ -78,46 +123,57 @@ class Container(object):
         if self.state is None:
             return None
 
-        for counter in xrange(1, 10000):
-            name = '%s.%s' % (self.full_name, counter)
-            if dockman.DOCKER.getstate(name) is None:
-                return counter
+        prefix = '%s.' % self.full_name
+        taken = set()
+        for name in dockman.DOCKER.container_names(self.project, prefix):
+            postfix = name[len(prefix):]
+            if postfix.isdigit():
+                taken.add(int(postfix))
+
+        counter = 1
+        while counter in taken:
+            counter += 1
+        return counter
 
     @property
     def state(self):
         return dockman.DOCKER.getstate(self.full_name)
 
+    def probe(self):
+        """
+        Returns a new readiness probe or None if the container has no
+        ready block.
+        """
+        if self.ready is None:
+            return None
+        return readiness.probe(self.full_name, self.ready)
+
     def start(self, extra=[]):
-        utils.echo_('%s ' % self.full_name)
+        """
+        Starts the container and returns its readiness probe if any.
+        """
+        message = '%s ' % self.full_name
 
         state = self.state
         if state:
-            utils.echo_('already running ... ')
-            utils.green('✔')
+            utils.status(message + 'already running ... ')
         else:
-            utils.echo_('starting ... ')
+            message += 'starting ... '
             try:
                 if state is None:
-                    extended_env = self.env
-                    extended_env.update({'container_name': self.full_name})
-                    volumes_from = self.project_volumes_from
-                    dockman.DOCKER.run(self.image, daemon=True,
-                                       interactive=False, remove=False,
-                                       name=self.full_name,
-                                       volumes_from=volumes_from,
-                                       volumes=self.volumes,
-                                       ports=self.ports,
-                                       links=self.project_links,
-                                       env=extended_env,
-                                       cmd=(extra or self.cmd))
+                    args = self.run_args(extra)
+                    labels = {HASH_LABEL: self.args_hash(args)}
+                    dockman.DOCKER.run(daemon=True, interactive=False,
+                                       remove=False, name=self.full_name,
+                                       labels=labels, **args)
                 else:
                     dockman.DOCKER.start(self.full_name)
             except docker.DockerError as e:
-                utils.red('✘')
-                utils.red(str(e))
+                utils.status(message, ok=False, error=e)
                 raise e
             else:
-                utils.green('✔')
+                utils.status(message)
+        return self.probe()
 
     def start_interactive(self, extra=[]):
         postfix = self.next_postfix
@@ -143,22 +199,22 @@ class Container(object):
     def stop(self):
         state = self.state
 
-        utils.echo_('%s ' % self.full_name)
+        message = '%s ' % self.full_name
 
         if state:
-            utils.echo_('stopping ... ')
+            message += 'stopping ... '
             try:
-                dockman.DOCKER.stop(self.full_name)
+                dockman.DOCKER.stop(self.full_name,
+                                    timeout=self.stop_timeout)
             except Exception as e:
-                utils.red('✘')
-                utils.red(str(e))
+                utils.status(message, ok=False, error=e)
                 raise e
         elif state is False:
-            utils.echo_('already stopped ... ')
+            message += 'already stopped ... '
         else:
-            utils.echo_('does not exist ... ')
+            message += 'does not exist ... '
 
-        utils.green('✔')
+        utils.status(message)
 
     def remove(self):
         state = self.state
@@ -167,18 +223,80 @@ class Container(object):
             self.stop()
             state = False
 
-        utils.echo_('%s ' % self.full_name)
+        message = '%s ' % self.full_name
 
         if state is None:
-            utils.echo_('does not exist ... ')
+            message += 'does not exist ... '
         else:
-            utils.echo_('removing ... ')
+            message += 'removing ... '
             try:
                 dockman.DOCKER.remove(self.full_name)
             except Exception as e:
-                utils.red('✘')
-                utils.red(str(e))
-
+                utils.status(message, ok=False, error=e)
                 raise e
 
-        utils.green('✔')
+        utils.status(message)
+
+
+def report(containers, errors, message):
+    """
+    Writes the status line of each container after a batch call, returns
+    the containers that failed mapped to their DockerError.
+    """
+    failed = {}
+    for c in containers:
+        error = errors.get(c.full_name)
+        line = '%s %s ... ' % (c.full_name, message)
+        if error is None:
+            utils.status(line)
+        else:
+            utils.status(line, ok=False, error=error)
+            failed[c] = error
+    return failed
+
+
+def start_many(containers):
+    """
+    Starts existing stopped containers with one docker start. Returns a
+    dictionary mapping them to their readiness probe or DockerError.
+    """
+    if len(containers) == 1:
+        return {containers[0]: containers[0].start()}
+
+    errors = dockman.DOCKER.start_many([c.full_name for c in containers])
+    failed = report(containers, errors, 'starting')
+    return dict((c, failed.get(c) or c.probe()) for c in containers)
+
+
+def stop_many(containers):
+    """
+    Stops running containers with the same stop timeout with one docker
+    stop. Returns a dictionary mapping the failed ones to the DockerError.
+    """
+    if len(containers) == 1:
+        containers[0].stop()
+        return {}
+
+    first = containers[0]
+    errors = dockman.DOCKER.stop_many([c.full_name for c in containers],
+                                      timeout=first.stop_timeout)
+    return report(containers, errors, 'stopping')
+
+
+def remove_many(containers):
+    """
+    Stops (if running) and removes existing containers with the same stop
+    timeout, with one docker stop and one docker rm. Returns a dictionary
+    mapping the failed ones to the DockerError.
+    """
+    if len(containers) == 1:
+        containers[0].remove()
+        return {}
+
+    running = [c for c in containers if c.state]
+    failed = stop_many(running) if running else {}
+
+    to_remove = [c for c in containers if c not in failed]
+    errors = dockman.DOCKER.remove_many([c.full_name for c in to_remove])
+    failed.update(report(to_remove, errors, 'removing'))
+    return failed
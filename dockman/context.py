@@ -2,20 +2,71 @@
 
 from __future__ import absolute_import
 
+import fnmatch
+import hashlib
+import heapq
+import json
 import os
-
-import yaml
+import time
 
 import dockman
 from . import container as container_module
+from . import docker as docker_module
+from . import durations as durations_module
+from . import events
+from . import trace
+from . import utils
+from .scheduler import Scheduler
 from .utils import NoConfigException, WrongConfigException
 
 
+def construct_yaml_str(self, node):
+    return self.construct_scalar(node)
+
+
+def load_yaml(content):
+    """
+    Parses yaml with libyaml if available. yaml is imported here, as
+    importing it is the most expensive part of the startup and the
+    config cache makes it unnecessary most of the time.
+    """
+    import yaml
+
+    # --------------------
+    # Override the default yaml string handling function
+    # to always return unicode objects
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    for cls in (yaml.Loader, yaml.SafeLoader, loader):
+        cls.add_constructor(u'tag:yaml.org,2002:str', construct_yaml_str)
+    # --------------------
+
+    return yaml.load(content, Loader=loader)
+
+
+def normalize(config):
+    """
+    Returns the config as it reads back from json, the format of the
+    config cache: mapping keys are strings, anything json does not know
+    is converted to a string.
+    """
+    return json.loads(json.dumps(config, default=unicode))
+
+
+# written next to the config file, see load_config
+CACHE_FILENAME = '.%s.cache'
+CACHE_VERSION = 2
+
+
 class Context(object):
 
     def __init__(self, path=None, config=None,
                  config_filename='dockman.yaml'):
         self.config_filename = config_filename
+        self.cache_path = None
+        self.cache_key = None
+        self.cache_hit = False
+        self.durations_path = None
+        self._durations = None
 
         if path is None:
             path = os.getcwd()
@@ -78,11 +129,69 @@ class Context(object):
 
         self.check_consistency()
 
-    def load_config(self, path):
-        with open(path, 'r') as f:
-            config = yaml.load(f)
+        # dependency index: container -> frozenset of containers,
+        # forward is what it depends on, backward what depends on it
+        self.forward = {}
+        self.backward = dict((c, set()) for c in self.containerlist)
+        for c in self.containerlist:
+            deps = frozenset(self.containers[d] for d in c.dependencies)
+            self.forward[c] = deps
+            for dep in deps:
+                self.backward[dep].add(c)
+        for c in self.containerlist:
+            self.backward[c] = frozenset(self.backward[c])
 
-        return config
+        # memoized plans, see plan
+        self.plans = {}
+
+        # the config is valid, cache it for the next time
+        if self.cache_path and not self.cache_hit:
+            self.write_cache()
+
+    def load_config(self, path):
+        """
+        Loads the yaml config file. The parsed config is cached as json
+        next to it (.dockman.cache for dockman.yaml), the cache is used as
+        long as the mtime, the size and the sha1 of the config file are
+        the same, and only if it is owned by the current user.
+        """
+        with open(path, 'rb') as f:
+            content = f.read()
+            stat = os.fstat(f.fileno())
+
+        head, tail = os.path.split(path)
+        cache_filename = CACHE_FILENAME % os.path.splitext(tail)[0]
+        self.cache_path = os.path.join(head, cache_filename)
+        self.durations_path = os.path.join(
+            head, durations_module.FILENAME % os.path.splitext(tail)[0])
+        self.cache_key = [CACHE_VERSION, stat.st_mtime, stat.st_size,
+                          hashlib.sha1(content).hexdigest()]
+
+        try:
+            with open(self.cache_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_uid != os.getuid():
+                    raise IOError('not owned by the current user')
+                cache = json.load(f)
+            if cache['key'] == self.cache_key:
+                self.cache_hit = True
+                return cache['config']
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            pass
+
+        # normalized as it is cached, so that both behave the same
+        return normalize(load_yaml(content))
+
+    def write_cache(self):
+        tmp = '%s.%s' % (self.cache_path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                json.dump({'key': self.cache_key, 'config': self.config}, f)
+            os.rename(tmp, self.cache_path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
 
     def check_consistency(self):
         for c in self.containerlist:
@@ -96,92 +205,374 @@ class Context(object):
         """
         Returns a set of Container instances.
         """
-        return set([self.containers[d] for d in container.dependencies])
+        return self.forward[container]
 
     def reverse_dependencies(self, container):
         """
         Returns a set of Container instances.
         """
-        ret = set()
-        for c in self.containerlist:
-            if container in self.dependencies(c):
-                ret.add(c)
-        return ret
+        return self.backward[container]
 
-    def _circular_msg(self, new, node, reverse):
-        circular = node[node.index(new):] + [new]
+    def _circular_msg(self, start, remaining, reverse):
+        edges = self.backward if reverse else self.forward
+        node = []
+        current = start
+        while current not in node:
+            node.append(current)
+            current = min(edges[current] & remaining, key=lambda c: c.name)
+
+        circular = node[node.index(current):] + [current]
         names = [c.name for c in circular]
         arrow = ' <- ' if reverse else ' -> '
         return 'Circular dependencies: ' + arrow.join(names)
 
-    def _chain(self, start, reverse=False):
-        seen = []
-        node = [start]
-        while node:
-            # one unseen dependency needed
-            current = node[-1]
-            if reverse:
-                deps = self.reverse_dependencies(current)
-            else:
-                deps = self.dependencies(current)
-            unseen = [d for d in deps if d not in seen]
-            if unseen:
-                new = unseen[0]
-                if new in node:
-                    message = self._circular_msg(new, node, reverse)
-                    raise WrongConfigException(message)
-
-                node.append(new)
-            else:
-                seen.append(current)
-                node.pop()
+    def plan(self, containers, reverse=False):
+        """
+        Returns the given containers with all their dependencies (or
+        reverse dependencies) in topological order: everything comes
+        after what it depends on (or before, when reverse). Ties are
+        broken by name. Plans are memoized.
+        """
+        key = (frozenset(containers), reverse)
+        if key in self.plans:
+            return list(self.plans[key])
 
-        return seen
+        if reverse:
+            edges, back_edges = self.backward, self.forward
+        else:
+            edges, back_edges = self.forward, self.backward
+
+        closure = set(containers)
+        stack = list(closure)
+        while stack:
+            for dep in edges[stack.pop()]:
+                if dep not in closure:
+                    closure.add(dep)
+                    stack.append(dep)
+
+        # Kahn: the closure is closed under edges, so every edge counts
+        waiting = dict((c, len(edges[c])) for c in closure)
+        ready = [(c.name, c) for c in closure if not waiting[c]]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            _, current = heapq.heappop(ready)
+            order.append(current)
+            for dependent in back_edges[current]:
+                if dependent in waiting:
+                    waiting[dependent] -= 1
+                    if not waiting[dependent]:
+                        heapq.heappush(ready, (dependent.name, dependent))
+
+        if len(order) < len(closure):
+            remaining = closure.difference(order)
+            starts = [c for c in containers if c in remaining]
+            start = starts[0] if starts else min(remaining,
+                                                 key=lambda c: c.name)
+            message = self._circular_msg(start, remaining, reverse)
+            raise WrongConfigException(message)
+
+        self.plans[key] = tuple(order)
+        return order
 
     def chain(self, container):
-        return self._chain(container)
+        return self.plan([container])
 
     def reverse_chain(self, container):
-        return self._chain(container, reverse=True)
+        return self.plan([container], reverse=True)
+
+    @property
+    def durations(self):
+        """
+        The start durations recorded for the project (.dockman.durations
+        next to dockman.yaml), see durations.Durations.
+        """
+        if self._durations is None:
+            self._durations = durations_module.Durations(self.durations_path)
+        return self._durations
+
+    def expected(self, container):
+        """
+        Returns the seconds the container is expected to take to start
+        and become ready: 0 if running, the recorded average otherwise.
+        """
+        if container.state:
+            return 0
+        duration = self.durations.get(container.name, container.image)
+        if duration is None:
+            return durations_module.DEFAULT_DURATION
+        return duration
+
+    def remaining(self, containers):
+        """
+        Returns a dictionary mapping each of the containers (a plan) to
+        the expected seconds of the longest chain starting with it and
+        going through the containers depending on it.
+        """
+        nodeset = set(containers)
+        remaining = {}
+        for c in reversed(containers):
+            after = [remaining[d] for d in self.backward[c] if d in nodeset]
+            remaining[c] = self.expected(c) + max(after or [0])
+        return remaining
+
+    def levels(self, containers):
+        """
+        Returns the containers (a plan) by level: those depending on none
+        of them first, then those depending only on the first level, ...
+        The containers of a level can be started at the same time.
+        """
+        nodeset = set(containers)
+        level = {}
+        levels = []
+        for c in containers:
+            deps = [level[d] for d in self.forward[c] if d in nodeset]
+            level[c] = max(deps) + 1 if deps else 0
+            if level[c] == len(levels):
+                levels.append([])
+            levels[level[c]].append(c)
+        return levels
+
+    def critical_path(self, containers):
+        """
+        Returns the chain of the containers (a plan) expected to take the
+        longest to start, which bounds the time of starting them all.
+        """
+        if not containers:
+            return []
+        nodeset = set(containers)
+        remaining = self.remaining(containers)
+
+        def longest(candidates):
+            return min(candidates, key=lambda c: (-remaining[c], c.name))
+
+        path = [longest(c for c in containers
+                        if not self.forward[c] & nodeset)]
+        while True:
+            after = self.backward[path[-1]] & nodeset
+            if not after:
+                return path
+            path.append(longest(after))
+
+    def start(self, containers):
+        """
+        Starts the given containers on a worker pool, each one as soon as
+        its dependencies are up and ready. The ready ones on the longest
+        chain (see remaining) are started first, and the time each one
+        took is recorded in durations.
+        """
+        dockman.DOCKER.load_states(self.project)
+
+        def batch(c):
+            # the stopped ones ready together are started at once
+            return 'start' if c.state is False else None
+
+        starting = [c for c in containers if not c.state]
+        scheduler = Scheduler(containers, self.dependencies,
+                              container_module.start_many, batch=batch,
+                              priority=self.remaining(containers).get)
+        try:
+            with trace.span('start', 'phase'):
+                scheduler.run()
+        finally:
+            for c in starting:
+                if c in scheduler.durations:
+                    self.durations.record(c.name, c.image,
+                                          scheduler.durations[c])
+            self.durations.save()
 
     def run(self, interactive, container_name, extra):
         container = self.containers[container_name]
-        for c in self.chain(container)[:-1]:
-            c.start()
-        if interactive:
-            container.start_interactive(extra)
+        self.start(self.chain(container)[:-1])
+        with trace.span('run', 'phase'):
+            if interactive:
+                container.start_interactive(extra)
+            else:
+                container.start(extra)
+
+    def up(self, group_name, reconcile=False, pull=True):
+        """
+        Starts the containers of the group. With reconcile, those created
+        with another config are recreated first, see reconcile. With pull
+        the missing images are pulled first, see pull_images.
+        """
+        with trace.span('plan', 'phase'):
+            containers = self.plan(self.groups[group_name])
+        if pull:
+            self.pull_images(containers)
+        if reconcile:
+            with trace.span('reconcile', 'phase'):
+                containers = self.plan(containers +
+                                       self.reconcile(containers))
+        self.start(containers)
+
+    def show_plan(self, group_name):
+        """
+        Prints how up would start the group: the containers of each
+        level, which can be started at once, and the critical path with
+        the recorded durations.
+        """
+        containers = self.plan(self.groups[group_name])
+        dockman.DOCKER.load_states(self.project)
+
+        utils.yellow('level  containers')
+        for i, level in enumerate(self.levels(containers)):
+            utils.echo('%5d  %d: %s' % (i + 1, len(level),
+                                        ', '.join(c.name for c in level)))
+
+        path = self.critical_path(containers)
+        total = self.remaining(containers)[path[0]] if path else 0
+        utils.yellow('critical path, about %.1f s:' % total)
+        width = max([len(c.name) for c in path] or [0])
+        for c in path:
+            duration = self.durations.get(c.name, c.image)
+            if c.state:
+                note = 'running'
+            elif duration is None:
+                note = 'never started (%.1f s assumed)' % self.expected(c)
+            else:
+                note = '%.1f s' % duration
+            utils.echo('  %s  %s' % (c.name.ljust(width), note))
+
+    def images(self, containers):
+        """
+        Returns the distinct images of the containers, in their order.
+        """
+        images = []
+        for c in containers:
+            if c.image not in images:
+                images.append(c.image)
+        return images
+
+    def pull(self, group_name=None, workers=None):
+        """
+        Pulls the missing images of the group (of every container if no
+        group is given) and of everything they depend on.
+        """
+        if group_name is None:
+            containers = self.containerlist
         else:
-            container.start(extra)
+            containers = self.groups[group_name]
+        self.pull_images(self.plan(containers), workers, verbose=True)
 
-    def up(self, group_name):
-        group = self.groups[group_name]
+    def pull_images(self, containers, workers=None, verbose=False):
+        """
+        Pulls the images of the containers missing locally (checked with
+        one call) on a worker pool, each one once. With verbose the images
+        already present are listed too.
+        """
+        present = dockman.DOCKER.local_images()
+        missing = []
+        for image in self.images(containers):
+            if docker_module.image_ref(image) not in present:
+                missing.append(image)
+            elif verbose:
+                utils.status('%s present ... ' % image)
+
+        def pull(image):
+            message = '%s pulling ... ' % image
+            try:
+                dockman.DOCKER.pull(image)
+            except docker_module.DockerError as e:
+                utils.status(message, ok=False, error=e)
+                raise e
+            utils.status(message)
+
+        with trace.span('pull images', 'phase'):
+            Scheduler(missing, lambda image: [], pull, workers).run()
+
+    def drifted(self, containers):
+        """
+        Returns the existing containers whose config changed since they
+        were created, comparing the hash labels fetched at once. Those
+        without the label (created before it, or by hand) are unknown and
+        left alone.
+        """
+        labels = dockman.DOCKER.project_labels(
+            self.project, container_module.HASH_LABEL)
+        ret = []
+        for c in containers:
+            if c.full_name not in labels:
+                continue
+            if labels[c.full_name] is None:
+                utils.yellow('%s has no %s label, left alone' %
+                             (c.full_name, container_module.HASH_LABEL))
+            elif labels[c.full_name] != c.config_hash:
+                ret.append(c)
+        return ret
+
+    def reconcile(self, containers):
+        """
+        Removes the drifted ones of the containers along with everything
+        depending on them (links bind to the old containers). Returns the
+        removed ones that were running, to be started again.
+        """
+        drifted = self.drifted(containers)
+        if not drifted:
+            return []
+
+        to_remove = self.plan(drifted, reverse=True)
+        dockman.DOCKER.load_states(self.project)
+        running = [c for c in to_remove if c.state]
+        self.remove_containers(to_remove)
+        return running
 
-        to_start = []
-        for container in group:
-            for dep in self.chain(container):
-                if dep not in to_start:
-                    to_start.append(dep)
+    def stop_key(self, c):
+        # never None, which would mean not batched
+        return ('stop', c.stop_timeout)
 
-        for c in to_start:
-            c.start()
+    def remove_containers(self, containers):
+        """
+        Removes the containers, each one after those depending on it, the
+        ones ready together with one docker call.
+        """
+        def batch(c):
+            return None if c.state is None else self.stop_key(c)
+
+        scheduler = Scheduler(containers, self.reverse_dependencies,
+                              container_module.remove_many, batch=batch)
+        with trace.span('remove', 'phase'):
+            scheduler.run()
 
     def remove(self, container_name):
         container = self.containers[container_name]
-        for c in self.reverse_chain(container):
-            c.remove()
+        dockman.DOCKER.load_states(self.project)
+        self.remove_containers(self.reverse_chain(container))
 
     def down(self, group_name):
-        group = self.groups[group_name]
+        to_stop = self.plan(self.groups[group_name], reverse=True)
 
-        to_stop = []
-        for container in group:
-            for dep in self.reverse_chain(container):
-                if dep not in to_stop:
-                    to_stop.append(dep)
+        dockman.DOCKER.load_states(self.project)
 
-        for c in to_stop:
-            c.stop()
+        def batch(c):
+            return self.stop_key(c) if c.state else None
 
-    def logs(self):
+        scheduler = Scheduler(to_stop, self.reverse_dependencies,
+                              container_module.stop_many, batch=batch)
+        with trace.span('stop', 'phase'):
+            scheduler.run()
+
+    def logs(self, patterns=(), **kwargs):
+        """
+        Follows the logs of the running containers of the project, only
+        those matching any of the patterns if given. A pattern is a
+        container name or glob, with or without the project prefix. The
+        containers of the project started meanwhile are followed too, see
+        events.StateTable.
+        """
+        prefix = self.project + '.'
+
+        def selected(name):
+            short = name[len(prefix):]
+            return any(fnmatch.fnmatchcase(name, p) or
+                       fnmatch.fnmatchcase(short, p) for p in patterns)
+
+        since = time.time()
         containers = dockman.DOCKER.running_container_names(self.project)
-        dockman.DOCKER.logs(containers)
+        if patterns:
+            containers = filter(selected, containers)
+
+        watch = events.StateTable(self.project,
+                                  dict((c, True) for c in containers),
+                                  selected if patterns else None, since)
+        dockman.DOCKER.logs(containers, watch=watch, **kwargs)
@@ -2,76 +2,163 @@
 
 from __future__ import absolute_import
 
+import os
+import re
 import subprocess
 import json
 import threading
-import Queue
+import time
 
 from . import utils
-import dockman
+from . import events
+from . import trace
+from . import logs as logs_module
+from .logs import Multiplexer, Pipeline, Renderer
 
 
-class DockerError(Exception):
-    pass
+# seconds a loaded project state snapshot is trusted
+STATE_TTL = 5
 
+# returned by cached_state for containers not in the snapshot
+NOT_CACHED = object()
 
-class LogsThread(threading.Thread):
-    def __init__(self, queue, command, container_name, **kwargs):
-        super(LogsThread, self).__init__(**kwargs)
-        self.queue = queue
-        self.command = command
-        self.container_name = container_name
-        self.sp = None
 
-    def run(self):
-        fix_cmd = ['logs', '-f', '--tail="0"', self.container_name]
-        self.sp = dockman.DOCKER.Popen(self.command + fix_cmd,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.STDOUT)
+def image_ref(image):
+    """
+    Returns the image name with its tag, latest if none is given, as
+    docker images lists them.
+    """
+    if '@' in image or ':' in image.rpartition('/')[2]:
+        return image
+    return image + ':latest'
 
-        while True:
-            line = self.sp.stdout.readline()
-            if not line:
-                break
 
-            self.queue.put((self.container_name, line), True, 0.1)
+class DockerError(Exception):
+    pass
 
-        self.sp.wait()
 
-    def stop(self):
-        if self.sp and self.sp.poll() is None:
-            try:
-                self.sp.terminate()
-            except OSError:
-                pass
+def batch_errors(container_names, output):
+    """
+    Tells from the output of a failed docker call on several containers
+    which of them failed: docker prints the name of every container it
+    handled and an error line for each other one. Returns a dictionary
+    mapping the names to None or a DockerError with the lines about them
+    (the whole output if none).
+    """
+    lines = [line.strip() for line in output.splitlines()]
+    errors = {}
+    for name in container_names:
+        if name in lines:
+            errors[name] = None
+            continue
+        pattern = re.compile(r'(?<![\w.-])%s(?![\w.-])' % re.escape(name))
+        mentions = [line for line in lines if pattern.search(line)]
+        errors[name] = DockerError('\n'.join(mentions) or output.strip())
+    return errors
 
 
 class Docker(object):
-    def __init__(self, command=['docker']):
+    def __init__(self, command=['docker'], state_ttl=STATE_TTL):
         self.command = command
-        self.logthreads = set()
-        self.queue = Queue.Queue()
+        self.multiplexer = Multiplexer()
+        self.pipeline = None
 
-    def Popen(self, *args, **kwargs):
-        return subprocess.Popen(*args, **kwargs)
+        # state cache of one project, see load_states
+        self.state_ttl = state_ttl
+        self.states = {}
+        self.states_project = None
+        self.states_loaded = 0
+        self.states_lock = threading.Lock()
+
+    def Popen(self, cmd, *args, **kwargs):
+        # the span only covers starting the process
+        with trace.span('docker ' + cmd[len(self.command)], argv=cmd,
+                        kind='popen'):
+            return subprocess.Popen(cmd, *args, **kwargs)
+
+    def logs_process(self, container_name, follow=True, timestamps=False,
+                     since=None, until=None, tail=None):
+        """
+        Returns a process-like object writing the logs of the container
+        to its stdout. By default it follows only the new lines.
+        """
+        if follow and since is None and until is None and tail is None:
+            fix_cmd = ['logs', '-f', '--tail="0"', container_name]
+        else:
+            fix_cmd = ['logs']
+            if follow:
+                fix_cmd.append('-f')
+            if timestamps:
+                fix_cmd.append('-t')
+            if since is not None:
+                fix_cmd += ['--since', str(since)]
+            if until is not None:
+                fix_cmd += ['--until', str(until)]
+            if tail is not None:
+                fix_cmd.append('--tail=%s' % tail)
+            fix_cmd.append(container_name)
+
+        return self.Popen(self.command + fix_cmd,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT)
+
+    def events_process(self, since=None):
+        """
+        Returns a process-like object writing a "<time> <action> <name>"
+        line (the time in nanoseconds) to its stdout for each container
+        event of events.EVENTS.
+        """
+        fix_cmd = ['events', '--filter', 'type=container']
+        for event in events.EVENTS:
+            fix_cmd += ['--filter', 'event=%s' % event]
+        fix_cmd += ['--format',
+                    '{{.TimeNano}} {{.Status}} {{.Actor.Attributes.name}}']
+        if since is not None:
+            fix_cmd += ['--since', '%.9f' % since]
+        return self.Popen(self.command + fix_cmd,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.STDOUT)
+
+    def exec_process(self, container_name, cmd):
+        """
+        Returns the process running cmd in the container, its output
+        discarded.
+        """
+        with open(os.devnull, 'wb') as devnull:
+            return self.Popen(self.command + ['exec', container_name] + cmd,
+                              stdout=devnull, stderr=subprocess.STDOUT)
+
+    def ip_address(self, container_name):
+        try:
+            ip = self.execute(['inspect', '--format',
+                               '{{.NetworkSettings.IPAddress}}',
+                               container_name])
+        except DockerError:
+            return None
+        return (ip or '').strip() or None
 
     def execute(self, params):
         cmd = self.command + params
 
-        try:
-            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError as e:
-            raise DockerError(e.output)
-        else:
-            return output
+        with trace.span('docker ' + params[0], argv=cmd):
+            try:
+                output = subprocess.check_output(cmd,
+                                                 stderr=subprocess.STDOUT)
+            except subprocess.CalledProcessError as e:
+                raise DockerError(e.output)
+            else:
+                return output
 
     def execute_interactive(self, params):
         cmd = self.command + params
-        subprocess.call(cmd)
+        with trace.span('docker ' + params[0], argv=cmd,
+                        kind='interactive'):
+            subprocess.call(cmd)
 
     def run(self, image, daemon=True, interactive=False,
             remove=False, name='', volumes_from=[], volumes={},
-            ports={}, links={}, env={}, cmd=[]):
+            ports={}, links={}, env={}, cmd=[], labels={},
+            stop_signal=None):
 
         _args = ['run']
 
@@ -104,28 +191,217 @@ class Docker(object):
         for var_name, value in env.items():
             _args += ['-e', "%s=%s" % (var_name, value)]
 
+        for key, value in sorted(labels.items()):
+            _args += ['--label', '%s=%s' % (key, value)]
+
+        if stop_signal:
+            _args += ['--stop-signal', stop_signal]
+
         _args.append(image)
         _args += cmd
 
         if interactive:
-            return self.execute_interactive(_args)
+            ret = self.execute_interactive(_args)
         else:
-            return self.execute(_args)
+            ret = self.execute(_args)
+
+        if name:
+            self.set_state(name, True if daemon else
+                           (None if remove else False))
+        return ret
 
     def start(self, container_name):
         self.execute(['start', container_name])
+        self.set_state(container_name, True)
 
-    def stop(self, container_name):
-        self.execute(['stop', container_name])
+    def stop(self, container_name, timeout=None):
+        # the signal is the one given to run: docker stop --signal needs
+        # docker 23
+        _args = ['stop']
+
+        if timeout is not None:
+            _args += ['-t', str(timeout)]
+
+        self.execute(_args + [container_name])
+        self.set_state(container_name, False)
 
     def remove(self, container_name):
         self.execute(['rm', '-v', container_name])
+        self.set_state(container_name, None)
+
+    def batch(self, params, container_names, state):
+        """
+        Runs docker with params and all the container names at once,
+        setting the state of those that succeeded. Returns a dictionary
+        mapping each name to None or its DockerError, see batch_errors.
+        """
+        try:
+            self.execute(params + list(container_names))
+        except DockerError as e:
+            errors = batch_errors(container_names, str(e))
+        else:
+            errors = dict.fromkeys(container_names)
+
+        for name, error in errors.items():
+            if error is None:
+                self.set_state(name, state)
+        return errors
+
+    def each(self, func, container_names, *args, **kwargs):
+        """
+        Calls func for the containers one by one, returns the errors as
+        batch does.
+        """
+        errors = {}
+        for name in container_names:
+            try:
+                func(name, *args, **kwargs)
+            except DockerError as e:
+                errors[name] = e
+            else:
+                errors[name] = None
+        return errors
+
+    def start_many(self, container_names):
+        return self.batch(['start'], container_names, True)
+
+    def stop_many(self, container_names, timeout=None):
+        _args = ['stop']
+        if timeout is not None:
+            _args += ['-t', str(timeout)]
+        return self.batch(_args, container_names, False)
+
+    def remove_many(self, container_names):
+        return self.batch(['rm', '-v'], container_names, None)
+
+    def pull(self, image):
+        self.execute(['pull', image])
+
+    def local_images(self):
+        """
+        Returns the set of the images present locally (see image_ref),
+        using one docker images call.
+        """
+        output = self.execute(['images']) or ''
+        images = set()
+        for line in output.splitlines()[1:]:
+            fields = line.split()
+            if len(fields) >= 2 and '<none>' not in fields[:2]:
+                images.add('%s:%s' % (fields[0], fields[1]))
+        return images
+
+    def project_states(self, project):
+        """
+        Returns the states of all containers of the project (named
+        <project>.*) in a dictionary, using one bulk inspect.
+        """
+        prefix = project + '.'
+        output = self.execute(['ps', '-a', '-q', '--filter',
+                               'name=%s' % prefix])
+        ids = output.split()
+        if not ids:
+            return {}
+
+        states = {}
+        for cinfo in json.loads(self.execute(['inspect'] + ids)):
+            name = cinfo['Name'][1:]
+            if name.startswith(prefix):
+                states[name] = bool(cinfo['State']['Running'])
+        return states
+
+    def project_labels(self, project, key):
+        """
+        Returns the value of the label key (None when not set) of all
+        containers of the project, using one bulk inspect.
+        """
+        prefix = project + '.'
+        output = self.execute(['ps', '-a', '-q', '--filter',
+                               'name=%s' % prefix])
+        ids = output.split()
+        if not ids:
+            return {}
+
+        labels = {}
+        for cinfo in json.loads(self.execute(['inspect'] + ids)):
+            name = cinfo['Name'][1:]
+            if name.startswith(prefix):
+                container_labels = cinfo['Config'].get('Labels') or {}
+                labels[name] = container_labels.get(key)
+        return labels
+
+    def load_states(self, project, max_age=None):
+        """
+        Loads the state of every container in the project at once.
+        Until the snapshot expires getstate answers from it for the
+        project's containers, and the mutating calls keep it up to date.
+        With max_age a snapshot of the project younger than that is kept.
+        """
+        with self.states_lock:
+            if (max_age is not None and self.states_project == project and
+                    time.time() - self.states_loaded <= max_age):
+                return
+
+            try:
+                states = self.project_states(project)
+            except DockerError:
+                self.states_project = None
+                return
+
+            self.states = states
+            self.states_project = project
+            self.states_loaded = time.time()
+
+    def in_states(self, container_name):
+        project = self.states_project
+        return (project is not None and
+                container_name.startswith(project + '.'))
+
+    def set_state(self, container_name, state):
+        if self.in_states(container_name):
+            if state is None:
+                self.states.pop(container_name, None)
+            else:
+                self.states[container_name] = state
+
+    def cached_state(self, container_name):
+        """
+        Returns the state of the container from the project snapshot,
+        reloading it if expired, or NOT_CACHED if there is no snapshot
+        covering the container.
+        """
+        if self.in_states(container_name):
+            if time.time() - self.states_loaded > self.state_ttl:
+                self.load_states(self.states_project, self.state_ttl)
+
+            if self.in_states(container_name):
+                return self.states.get(container_name)
+
+        return NOT_CACHED
+
+    def container_names(self, project, prefix=None):
+        """
+        Returns the names of the containers of the project, only those
+        starting with prefix if given, from the project snapshot, loaded
+        by load_states if there is none or it expired.
+        """
+        self.load_states(project, self.state_ttl)
+        if self.states_project == project:
+            states = self.states
+        else:
+            # the snapshot could not be loaded, raises the DockerError
+            states = self.project_states(project)
+        prefix = prefix or project + '.'
+        return [name for name in states if name.startswith(prefix)]
 
     def getstate(self, container_name):
         """
         Returns None if the container does not exits,
         False if not running, True if running.
         """
+        state = self.cached_state(container_name)
+        if state is not NOT_CACHED:
+            return state
+
         params = ['inspect', '--format="{{.State.Running}}"', container_name]
         try:
             output = self.execute(params)
@@ -251,34 +527,192 @@ class Docker(object):
 
             utils.yellow('-' * max_len)
 
-    def logs(self, container_names, max_iter=0):
-        for cn in container_names:
-            th = LogsThread(self.queue, self.command, cn)
-            self.logthreads.add(th)
-            th.start()
+    def logs(self, container_names, max_iter=0, buffer_size=100,
+             policy='block', color=None, since=None, until=None, tail=None,
+             line_filter=None, archive=None, direct=False, watch=None):
+        """
+        Follows the logs of the containers until all of them end (or
+        max_iter rounds if given). The streams are read in this thread
+        and written by the pipeline's, see logs.Pipeline for the policies
+        and logs.Renderer for color. Lines not matching line_filter (a
+        logs.LogFilter) are dropped before reaching the pipeline.
+
+        With archive (an archive.Archive) every followed line is archived
+        with its timestamp in this thread, before the filter and whatever
+        the policy drops.
+
+        With direct the history is read from the json-file logs of the
+        containers instead of docker logs, see jsonlog.
+
+        With watch (an events.StateTable) the container events are
+        followed too: the logs of the containers started meanwhile are
+        followed from their start, those of the removed ones dropped (the
+        logs of a stopped container end by themselves).
+
+        With since, until or tail the history is printed first, the lines
+        of all containers merged in time order, then the new lines are
+        followed from where the history ended (unless until was given).
+        """
+        renderer = Renderer(color=color)
+        self.pipeline = Pipeline(renderer.write, buffer_size, policy)
 
-        iter_cnt = 0
-        while (max_iter == 0) or (iter_cnt < max_iter):
+        try:
+            follow_since = None
+            if since is not None or until is not None or tail is not None:
+                if until is None:
+                    follow_since = '%.9f' % time.time()
+                self.history(container_names, since,
+                             until or follow_since, tail, line_filter,
+                             direct)
+                if until is not None:
+                    return
+
+            for cn in container_names:
+                if archive:
+                    sp = self.logs_process(cn, timestamps=True,
+                                           since=follow_since,
+                                           tail=0 if follow_since is None
+                                           else None)
+                elif follow_since is None:
+                    sp = self.logs_process(cn)
+                else:
+                    sp = self.logs_process(cn, since=follow_since)
+                self.multiplexer.add(cn, sp)
+
+            if watch is not None:
+                self.multiplexer.add(events.STREAM_NAME,
+                                     self.events_process(watch.since))
+
+            iter_cnt = 0
+            while self.multiplexer and (max_iter == 0 or iter_cnt < max_iter):
+                batch = self.multiplexer.read(0.1)
+                if watch is not None:
+                    batch = self.watch_events(watch, batch, archive)
+                if archive:
+                    archive.write(batch)
+                    archive.tick()
+                    batch = logs_module.strip_timestamps(batch)
+                if batch and line_filter:
+                    batch = line_filter.filter(batch)
+                if batch:
+                    self.pipeline.put(batch)
+                iter_cnt += 1
+        finally:
             try:
-                container_name, line = self.queue.get(True, 0.1)
-            except Queue.Empty:
-                continue
-            else:
-                self.queue.task_done()
-                utils.yellow_(container_name + ': ')
-                utils.echo_(line)
+                self.pipeline.close()
             finally:
-                iter_cnt += 1
+                if archive:
+                    archive.close()
 
-    def stopthreads(self):
-        for th in self.logthreads:
-            th.stop()
-            th.join()
+    def watch_events(self, table, batch, archive=None):
+        """
+        Applies the event lines of the batch to the table, attaching and
+        detaching log streams accordingly, returns the rest of the batch.
+        """
+        ret = []
+        for name, lines in batch:
+            if name != events.STREAM_NAME:
+                ret.append((name, lines))
+                continue
+
+            for line in lines:
+                event = table.apply(line)
+                if event is None:
+                    continue
+                timestamp, action, cn = event
+                self.set_state(cn, table.states.get(cn))
+                if action == 'start':
+                    since = timestamp
+                    if since is None:
+                        since = '%.9f' % time.time()
+                    sp = self.logs_process(cn, timestamps=bool(archive),
+                                           since=since)
+                    self.multiplexer.add(cn, sp)
+                elif action == 'destroy':
+                    self.multiplexer.remove_name(cn)
+        return ret
+
+    def history(self, container_names, since, until, tail,
+                line_filter=None, direct=False):
+        iterators = []
+        if direct:
+            iterators, container_names = self.direct_history(
+                container_names, since, until, tail)
+
+        processes = [(cn, self.logs_process(cn, follow=False,
+                                            timestamps=True, since=since,
+                                            until=until, tail=tail))
+                     for cn in container_names]
+        try:
+            iterators += [logs_module.timestamped_lines(cn, sp)
+                          for cn, sp in processes]
+            self.put_history(iterators, line_filter)
+        finally:
+            for _, sp in processes:
+                sp.wait()
+                sp.stdout.close()
+
+    def direct_history(self, container_names, since, until, tail):
+        """
+        Returns the history iterators of the containers whose json-file
+        log can be read, and the names of the others, left to docker logs.
+        """
+        from . import jsonlog
+
+        def rfc3339(value):
+            if value is None:
+                return None
+            return logs_module.epoch_to_rfc3339(logs_module.to_epoch(value))
+
+        paths = self.log_paths(container_names)
+        iterators = []
+        others = []
+        for cn in container_names:
+            if cn not in paths:
+                others.append(cn)
+                continue
+            try:
+                iterators += jsonlog.history({cn: paths[cn]}, rfc3339(since),
+                                             rfc3339(until), tail)
+            except (IOError, OSError):
+                utils.red('%s: cannot read %s' % (cn, paths[cn]))
+                others.append(cn)
+        return iterators, others
+
+    def put_history(self, iterators, line_filter=None):
+        merged = logs_module.merge_history(iterators)
+        if line_filter:
+            merged = (item for item in merged
+                      if line_filter.match(item[2]))
+        for batch in logs_module.batched(merged):
+            self.pipeline.put(batch)
+
+    def log_paths(self, container_names):
+        """
+        Returns the json-file log path of the containers by name, as
+        given by one bulk inspect.
+        """
+        names = set(container_names)
+        paths = {}
+        for cinfo in self.container_info:
+            name = cinfo['Name'][1:]
+            if name in names and cinfo.get('LogPath'):
+                paths[name] = cinfo['LogPath']
+        return paths
+
+    def stoplogs(self):
+        self.multiplexer.close()
+        if self.pipeline:
+            self.pipeline.close()
+
+    stopthreads = stoplogs
 
 
 class SafeDocker(Docker):
     """
-    Will not call subprocess, just remember the arguments.
+    Will not call subprocess, just remember the arguments. The calls are
+    answered with the scripted _output and the _popenout_filename files,
+    or by _engine (a test.fake.FakeEngine) when given.
     """
     def replace_with_content(self, o):
         if hasattr(o, 'read'):
@@ -293,6 +727,8 @@ class SafeDocker(Docker):
         self._popenout_filename = None
         self._raise_oserror = False
         self._log_max_iter = 0
+        self._events_filename = None
+        self._engine = kwargs.pop('_engine', None)
 
         if '_output' in kwargs:
             o = kwargs.pop('_output')
@@ -309,10 +745,25 @@ class SafeDocker(Docker):
         if '_log_max_iter' in kwargs:
             self._log_max_iter = kwargs.pop('_log_max_iter')
 
+        if '_events_filename' in kwargs:
+            self._events_filename = kwargs.pop('_events_filename')
+
         super(SafeDocker, self).__init__(*args, **kwargs)
 
     def Popen(self, cmd, *args, **kwargs):
-
+        self._cmd = cmd
+        if self._engine is not None:
+            return self._engine.popen(cmd[len(self.command):])
+        return self.dummy_process(self._popenout_filename + cmd[-1])
+
+    def events_process(self, since=None):
+        if self._engine is not None:
+            return super(SafeDocker, self).events_process(since)
+        if self._events_filename is None:
+            return self.dummy_process(os.devnull)
+        return self.dummy_process(self._events_filename)
+
+    def dummy_process(self, filename):
         _raise_oserror = self._raise_oserror
 
         class Dummy(object):
@@ -327,13 +778,15 @@ class SafeDocker(Docker):
                     raise OSError()
 
         dp = Dummy()
-        filename = self._popenout_filename + cmd[-1]
         dp.stdout = open(filename, 'r')
         return dp
 
     def execute(self, params):
         self._cmd = self.command + params
 
+        if self._engine is not None:
+            return self._engine.execute(params)
+
         if self._output:
             actual = self._output.pop(0)
             if isinstance(actual, Exception):
@@ -344,6 +797,33 @@ class SafeDocker(Docker):
     def execute_interactive(self, params):
         self._cmd = self.command + params
 
-    def logs(self, container_names, max_iter=0):
+        if self._engine is not None:
+            self._engine.execute(params)
+
+    def logs(self, container_names, max_iter=0, **kwargs):
         max_iter = max_iter or self._log_max_iter
-        super(SafeDocker, self).logs(container_names, max_iter)
+        super(SafeDocker, self).logs(container_names, max_iter, **kwargs)
+
+
+def from_env(backend=None):
+    """
+    Returns the Docker backend to use. DOCKMAN_BACKEND ("cli" or "api")
+    overrides the backend given in the config, DOCKMAN_SUDO runs the
+    client with sudo and DOCKMAN_SOCKET is the socket the api backend
+    connects to.
+    """
+    backend = os.environ.get('DOCKMAN_BACKEND') or backend or 'cli'
+
+    if os.environ.get('DOCKMAN_SUDO'):
+        command = ['sudo', 'docker']
+    else:
+        command = ['docker']
+
+    if backend == 'api':
+        from .api import APIDocker, DEFAULT_SOCKET
+        socket_path = os.environ.get('DOCKMAN_SOCKET', DEFAULT_SOCKET)
+        return APIDocker(socket_path=socket_path, command=command)
+    elif backend == 'cli':
+        return Docker(command=command)
+    else:
+        raise utils.WrongConfigException('Unknown backend: %s' % backend)
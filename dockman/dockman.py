@@ -2,39 +2,63 @@
 
 from __future__ import absolute_import
 
-import os
+import errno
+import re
+import sys
+
 import click
 
 import dockman
-from . import docker
-from . import context
 from . import utils
 
+# The context and the docker backend are created on first use by the
+# commands (see utils.get_context and utils.get_docker), the modules
+# behind them are imported there too, so --help and typos stay cheap.
 
-if os.environ.get('DOCKMAN_SUDO'):
-    dockman.DOCKER = docker.Docker(command=['sudo', 'docker'])
-else:
-    dockman.DOCKER = docker.Docker()
 
+@click.group()
+@click.option('--trace', 'trace_path', type=click.Path(dir_okay=False),
+              help='Write the timing of every docker call and phase to '
+                   'this file, in Chrome trace-event format.')
+@click.option('--timings', is_flag=True,
+              help='Print the phases and the slowest docker calls at the '
+                   'end.')
+@click.pass_context
+def main(ctx, trace_path, timings):
+    """Manage Docker containers with ease."""
+    if trace_path or timings:
+        from . import trace
+        tracer = trace.enable()
 
-try:
-    dockman.CONTEXT = context.Context()
-except context.NoConfigException:
-    dockman.CONTEXT = None
-except context.WrongConfigException as e:
-    utils.red(str(e))
+        def report():
+            trace.disable()
+            if trace_path:
+                tracer.write(trace_path)
+            if timings:
+                tracer.timings()
+        ctx.call_on_close(report)
 
 
-@click.group()
-def main():
-    """Manage Docker containers with ease."""
+def cli():
+    """
+    The command line entry point: runs the command on the agent of the
+    project if one is running (see the agent command), in process
+    otherwise.
+    """
+    from . import agent
+    code = agent.forward(sys.argv[1:])
+    if code is None:
+        main()
+    else:
+        sys.exit(code)
 
 
 @main.command()
 def ps():
     """List existing containers."""
-    project = None if dockman.CONTEXT is None else dockman.CONTEXT.project
-    dockman.DOCKER.ps(project)
+    context = utils.get_context()
+    project = None if context is None else context.project
+    utils.get_docker().ps(project)
 
 
 @main.command()
@@ -58,17 +82,59 @@ def run(interactive, container, extra):
 
 
 @main.command()
+@click.option('--reconcile', is_flag=True,
+              help='Recreate the containers whose config changed since '
+                   'they were created, and those depending on them.')
+@click.option('--no-pull', is_flag=True,
+              help='Do not pull the missing images before starting.')
+@click.option('--plan', is_flag=True,
+              help='Only print the containers that can be started at '
+                   'once and the expected critical path, starts nothing '
+                   '(no --reconcile or --no-pull).')
 @click.argument('group')
 @utils.needs_context
-def up(group):
+def up(reconcile, no_pull, plan, group):
+    if plan and (reconcile or no_pull):
+        utils.red('--plan starts nothing, it takes no --reconcile or '
+                  '--no-pull.')
+        sys.exit(1)
+
     if group not in dockman.CONTEXT.groups:
         utils.red('No group %s defined.' % group)
+    elif plan:
+        dockman.CONTEXT.show_plan(group)
     else:
+        from .docker import DockerError
+        from .readiness import NotReadyError
         try:
-            dockman.CONTEXT.up(group)
-        except docker.DockerError:
+            dockman.CONTEXT.up(group, reconcile=reconcile,
+                               pull=not no_pull)
+        except (DockerError, NotReadyError):
             pass
-    dockman.DOCKER.ps(dockman.CONTEXT.project)
+    if not plan:
+        dockman.DOCKER.ps(dockman.CONTEXT.project)
+
+
+@main.command()
+@click.option('-j', '--jobs', type=int,
+              help='Number of images pulled at once (default: 4 or '
+                   'DOCKMAN_WORKERS).')
+@click.argument('group', required=False)
+@utils.needs_context
+def pull(jobs, group):
+    """
+    Pulls the missing images of the group (of all containers if no group
+    is given) and of the containers they depend on, in parallel.
+    """
+    if group is not None and group not in dockman.CONTEXT.groups:
+        utils.red('No group %s defined.' % group)
+        sys.exit(1)
+
+    from .docker import DockerError
+    try:
+        dockman.CONTEXT.pull(group, workers=jobs)
+    except DockerError:
+        sys.exit(1)
 
 
 @main.command()
@@ -98,13 +164,130 @@ def down(group):
 
 
 @main.command()
+@click.option('--buffer', default=100,
+              help='Number of batches of lines waiting to be written.')
+@click.option('--policy', default='block',
+              type=click.Choice(['block', 'drop-oldest', 'sample']),
+              help='What to do when the terminal can not keep up: block '
+                   'reading, drop the oldest batches or keep every 10th '
+                   'line.')
+@click.option('--no-color', is_flag=True,
+              help='Do not color the container names.')
+@click.option('--since',
+              help='Show the history from this time on (timestamp, '
+                   'RFC 3339 date or duration like 10m).')
+@click.option('--until',
+              help='Show the history up to this time and do not follow.')
+@click.option('--tail', type=int,
+              help='Show this many lines of history of each container.')
+@click.option('--container', '-c', multiple=True,
+              help='Only these containers (name or glob), can be repeated.')
+@click.option('--grep', multiple=True,
+              help='Only lines matching this regex, can be repeated.')
+@click.option('--exclude', multiple=True,
+              help='Skip lines matching this regex, can be repeated.')
+@click.option('--field', multiple=True,
+              help='Only json lines with this key=value, can be repeated.')
+@click.option('--level',
+              help='Only json lines with this level (same as '
+                   '--field level=LEVEL).')
+@click.option('--archive', type=click.Path(file_okay=False),
+              help='Also write the followed lines into rotated, '
+                   'compressed segments in this directory.')
+@click.option('--from-archive', type=click.Path(file_okay=False),
+              help='Print the history from this archive directory '
+                   'instead of docker.')
+@click.option('--direct', is_flag=True,
+              help='Read the history straight from the json-file logs '
+                   '(needs read access to the docker directory).')
 @utils.needs_context
-def logs():
+def logs(buffer, policy, no_color, since, until, tail,
+         container, grep, exclude, field, level, archive, from_archive,
+         direct):
     """
     Prints all logs from the current projecti in a tail -f fashion.
+    With --since, --until or --tail the history of all containers is
+    printed first in time order.
     """
+    from .logs import LogFilter
+    from . import archive as archive_module
+
+    fields = {}
+    for f in field:
+        key, sep, value = f.partition('=')
+        if not sep:
+            utils.red('Invalid field filter: %s' % f)
+            sys.exit(1)
+        fields[key] = value
+    if level:
+        fields['level'] = level
+
     try:
-        dockman.CONTEXT.logs()
+        line_filter = LogFilter(grep, exclude, fields)
+    except re.error as e:
+        utils.red('Invalid regex: %s' % e)
+        sys.exit(1)
+
+    color = False if no_color else None
+
+    if from_archive:
+        try:
+            archive_module.print_history(from_archive, container, since,
+                                         until, line_filter, color)
+        except ValueError as e:
+            utils.red(str(e))
+            sys.exit(1)
+        return
+
+    if archive:
+        archive = archive_module.Archive(archive)
+        archive_module.close_on_sigterm(archive)
+
+    try:
+        dockman.CONTEXT.logs(patterns=container,
+                             buffer_size=buffer, policy=policy,
+                             color=color,
+                             since=since, until=until, tail=tail,
+                             line_filter=line_filter, archive=archive,
+                             direct=direct)
     except KeyboardInterrupt:
-        dockman.DOCKER.stopthreads()
+        dockman.DOCKER.stoplogs()
+    except IOError as e:
+        # the reader went away (dockman logs | head)
+        if e.errno != errno.EPIPE:
+            raise
+        dockman.DOCKER.multiplexer.close()
+        return
     utils.echo('')
+
+
+@main.command()
+@click.option('--stop', is_flag=True, help='Stop the running agent.')
+def agent(stop):
+    """
+    Keeps the project loaded and runs the ps, up, down, remove and run
+    commands of the other dockman calls in the project, until stopped.
+    """
+    from . import agent as agent_module
+
+    if stop:
+        if not agent_module.stop():
+            utils.red('No agent running')
+            sys.exit(1)
+        return
+
+    project = agent_module.find_project()
+    if project is None:
+        utils.red('No config file found')
+        sys.exit(1)
+
+    try:
+        server = agent_module.Agent(project)
+        utils.echo('dockman agent listening on %s' %
+                   agent_module.socket_path(project))
+        server.serve()
+    except (RuntimeError, utils.WrongConfigException) as e:
+        utils.red(str(e))
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,83 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import json
+import os
+
+
+# written next to the config file, like the config cache
+FILENAME = '.%s.durations'
+
+# seconds assumed for a container never measured
+DEFAULT_DURATION = 1.0
+
+# weight of a new measure against the previous average
+WEIGHT = 0.5
+
+
+class Durations(object):
+    """
+    The history of how long the containers of a project took to start
+    and become ready, in seconds, kept per container name and image (a
+    new image may start differently) as a running average. It is stored
+    as json in path; without path it is only kept in memory.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.durations = {}
+        self.changed = False
+        if path is not None:
+            self.load()
+
+    def load(self):
+        """
+        Loads the durations of path, skipping whatever is not a number of
+        seconds per name and image (a file edited by hand, ...).
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if not isinstance(data, dict):
+            return
+
+        for name, images in data.items():
+            if not isinstance(images, dict):
+                continue
+            images = dict((image, float(seconds))
+                          for image, seconds in images.items()
+                          if isinstance(seconds, (int, float)) and
+                          not isinstance(seconds, bool) and seconds >= 0)
+            if images:
+                self.durations[name] = images
+
+    def get(self, name, image):
+        """
+        Returns the average duration of the container, None if it was
+        never measured.
+        """
+        return self.durations.get(name, {}).get(image)
+
+    def record(self, name, image, seconds):
+        previous = self.get(name, image)
+        if previous is not None:
+            seconds = WEIGHT * seconds + (1 - WEIGHT) * previous
+        self.durations.setdefault(name, {})[image] = seconds
+        self.changed = True
+
+    def save(self):
+        if self.path is None or not self.changed:
+            return
+        tmp = '%s.%s' % (self.path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                json.dump(self.durations, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+        self.changed = False
@@ -0,0 +1,101 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import json
+
+
+# the container events followed, see Docker.events_process
+EVENTS = ('start', 'die', 'destroy')
+
+# name of the event stream among the log streams of a Multiplexer, not a
+# valid container name
+STREAM_NAME = '<events>'
+
+
+def nano_to_seconds(nano):
+    """
+    Formats a time in nanoseconds as seconds with 9 decimals, as docker
+    takes it for --since.
+    """
+    return '%d.%09d' % divmod(int(nano), 10 ** 9)
+
+
+def parse_event(line):
+    """
+    Returns (time, action, container name) of an event line, either as
+    printed by Docker.events_process or a json object of the API, or None.
+    The time is a string of seconds, see nano_to_seconds.
+    """
+    line = line.strip()
+    if line.startswith('{'):
+        try:
+            data = json.loads(line)
+        except ValueError:
+            return None
+        action = data.get('Action') or data.get('status')
+        name = data.get('Actor', {}).get('Attributes', {}).get('name')
+        timestamp = data.get('timeNano')
+        if timestamp is None and data.get('time') is not None:
+            timestamp = data['time'] * 10 ** 9
+    else:
+        parts = line.split()
+        if len(parts) != 3:
+            return None
+        timestamp, action, name = parts
+
+    if not action or not name:
+        return None
+    try:
+        timestamp = nano_to_seconds(timestamp)
+    except (TypeError, ValueError):
+        timestamp = None
+    if isinstance(action, unicode):
+        action = action.encode('utf-8')
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return timestamp, action, name
+
+
+class StateTable(object):
+    """
+    Running state of the containers of a project, kept current by the
+    events: True if running, False if stopped, missing if removed. Only
+    the containers for which selected(name) is true are tracked. since is
+    the unix time the states are valid at, the events are read from then
+    on.
+    """
+    def __init__(self, project, states=None, selected=None, since=None):
+        self.prefix = project + '.'
+        self.states = dict(states or {})
+        self.selected = selected
+        self.since = since
+
+    def apply(self, line):
+        """
+        Updates the table with an event line, returns (time, action,
+        name) if it changed the table, None otherwise.
+        """
+        event = parse_event(line)
+        if event is None:
+            return None
+        _, action, name = event
+        if not name.startswith(self.prefix):
+            return None
+        if self.selected is not None and not self.selected(name):
+            return None
+
+        if action == 'start':
+            if self.states.get(name):
+                return None
+            self.states[name] = True
+        elif action == 'die':
+            self.states[name] = False
+        elif action == 'destroy':
+            self.states.pop(name, None)
+        else:
+            return None
+        return event
+
+    def running(self):
+        return sorted(n for n, running in self.states.items() if running)
@@ -0,0 +1,136 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import json
+import mmap
+import os
+import re
+
+
+TIME_RE = re.compile(r'"time":\s*"([^"]*)"')
+
+
+def normalize_timestamp(timestamp):
+    """
+    Pads the fraction of an RFC 3339 timestamp to nanoseconds, as docker
+    logs -t prints it, so that timestamps compare as strings. The
+    json-file driver trims the trailing zeros.
+    """
+    if not timestamp.endswith('Z'):
+        return timestamp
+    seconds, dot, fraction = timestamp[:-1].partition('.')
+    return '%s.%sZ' % (seconds, fraction.ljust(9, '0')[:9])
+
+
+class JsonLogReader(object):
+    """
+    Reads a log file of the json-file logging driver, one json object
+    per line: {"log": "...\\n", "stream": "stdout", "time": "..."}.
+    The file is memory mapped, the first line of a time range is found
+    by binary search on the byte offsets, and only the lines returned
+    are decoded.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            if self.size:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.mm = ''
+
+    def close(self):
+        if self.size:
+            self.mm.close()
+
+    def line_start(self, pos):
+        return self.mm.rfind('\n', 0, pos) + 1
+
+    def line_end(self, start):
+        end = self.mm.find('\n', start)
+        return self.size if end == -1 else end + 1
+
+    def time(self, start, end):
+        match = TIME_RE.search(self.mm, start, end)
+        return normalize_timestamp(match.group(1)) if match else ''
+
+    def seek(self, since):
+        """
+        Returns the offset of the first line not older than since.
+        """
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.line_start(mid)
+            end = self.line_end(start)
+            if self.time(start, end) < since:
+                lo = end
+            else:
+                hi = start
+        return lo
+
+    def tail_start(self, end, count):
+        """
+        Returns the offset of the count-th line before end.
+        """
+        pos = end
+        if pos and self.mm[pos - 1] == '\n':
+            pos -= 1
+        for _ in range(count):
+            pos = self.mm.rfind('\n', 0, pos)
+            if pos == -1:
+                return 0
+        return pos + 1
+
+    def lines(self, since=None, until=None, tail=None):
+        """
+        Yields (timestamp, line) between since and until (normalized
+        RFC 3339 strings), only the last tail ones if given.
+        """
+        start = 0 if since is None else self.seek(since)
+        end = self.size
+        if until is not None:
+            # the first line after until
+            end = self.seek(until + '\x7f')
+        if tail is not None:
+            start = max(start, self.tail_start(end, tail))
+
+        pos = start
+        while pos < end:
+            line_end = self.line_end(pos)
+            raw = self.mm[pos:line_end]
+            pos = line_end
+            try:
+                entry = json.loads(raw)
+            except ValueError:
+                continue
+
+            line = entry.get('log', u'').rstrip('\n')
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+            yield normalize_timestamp(entry.get('time', '')), line
+
+
+def history(log_paths, since=None, until=None, tail=None):
+    """
+    Returns one iterator of (timestamp, name, line) for each of the
+    containers in log_paths (name -> json log file). The files are opened
+    right away: IOError or OSError is raised here, not while iterating.
+    """
+    def entries(name, reader):
+        try:
+            for timestamp, line in reader.lines(since, until, tail):
+                yield timestamp, name, line
+        finally:
+            reader.close()
+
+    readers = []
+    try:
+        for name, path in sorted(log_paths.items()):
+            readers.append((name, JsonLogReader(path)))
+    except (IOError, OSError):
+        for _, reader in readers:
+            reader.close()
+        raise
+    return [entries(name, reader) for name, reader in readers]
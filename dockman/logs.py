@@ -0,0 +1,432 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import calendar
+import heapq
+import json
+import os
+import re
+import select
+import sys
+import threading
+import time
+import Queue
+
+import click
+
+from . import utils
+
+
+CHUNK_SIZE = 65536
+
+# what Pipeline.put does when the writer can not keep up
+POLICIES = ('block', 'drop-oldest', 'sample')
+
+# container prefix colors, assigned in order of appearance
+COLORS = ('yellow', 'cyan', 'green', 'magenta', 'blue', 'red')
+
+# lines of history handed to the pipeline at once
+HISTORY_BATCH = 500
+
+DURATION_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def to_epoch(value, now=None):
+    """
+    Converts a --since/--until value to a unix timestamp: a timestamp
+    itself, a duration back from now (30s, 10m, 2h, 1d) or an RFC 3339
+    date (2015-01-26, 2015-01-26T15:03:02.5, ...Z, ...+01:00), UTC unless
+    an offset is given.
+    """
+    value = str(value).strip()
+    if now is None:
+        now = time.time()
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    match = re.match(r'^(\d+(?:\.\d+)?)([smhd])$', value)
+    if match:
+        return now - float(match.group(1)) * DURATION_UNITS[match.group(2)]
+
+    match = re.match(r'^(\d{4})-(\d\d)-(\d\d)'
+                     r'(?:[Tt ](\d\d):(\d\d)(?::(\d\d)(\.\d+)?)?'
+                     r'(Z|z|[+-]\d\d:?\d\d)?)?$', value)
+    if match:
+        fields = [int(f or 0) for f in match.groups()[:6]]
+        fraction, offset = match.groups()[6:]
+        epoch = float(calendar.timegm(fields + [0, 0, 0]))
+        if fraction:
+            epoch += float(fraction)
+        if offset and offset.upper() != 'Z':
+            hours, minutes = int(offset[1:3]), int(offset[-2:])
+            if hours > 23 or minutes > 59:
+                raise ValueError('Invalid time offset: %s' % value)
+            seconds = hours * 3600 + minutes * 60
+            epoch -= seconds if offset[0] == '+' else -seconds
+        return epoch
+
+    raise ValueError('Invalid time: %s' % value)
+
+
+def epoch_to_rfc3339(epoch):
+    """
+    Formats a unix timestamp as docker does with -t, comparable with its
+    timestamps as strings.
+    """
+    seconds = int(epoch)
+    nanos = int(round((epoch - seconds) * 1e9))
+    if nanos >= 1000000000:
+        seconds, nanos = seconds + 1, 0
+    date = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds))
+    return '%s.%09dZ' % (date, nanos)
+
+
+def timestamped_lines(name, source):
+    """
+    Yields (timestamp, name, line) from the stdout of a docker logs -t
+    process, one line at a time.
+    """
+    for line in iter(source.stdout.readline, ''):
+        timestamp, _, line = line.rstrip('\n').partition(' ')
+        yield timestamp, name, line
+
+
+def strip_timestamps(batch):
+    return [(name, [line.partition(' ')[2] for line in lines])
+            for name, lines in batch]
+
+
+def merge_history(iterators):
+    """
+    Merges iterators of (timestamp, name, line), each in time order, into
+    one in time order. Only one item of each is held in memory.
+    """
+    return heapq.merge(*iterators)
+
+
+def batched(items, size=HISTORY_BATCH):
+    """
+    Groups (timestamp, name, line) items into batches as Pipeline takes
+    them, joining the consecutive lines of the same container.
+    """
+    batch = []
+    count = 0
+    for _, name, line in items:
+        if batch and batch[-1][0] == name:
+            batch[-1][1].append(line)
+        else:
+            batch.append((name, [line]))
+        count += 1
+        if count >= size:
+            yield batch
+            batch = []
+            count = 0
+    if batch:
+        yield batch
+
+
+class Poller(object):
+    """
+    select.poll where available, select.select otherwise.
+    """
+    def __init__(self):
+        self.fds = set()
+        self.poll = select.poll() if hasattr(select, 'poll') else None
+
+    def register(self, fd):
+        self.fds.add(fd)
+        if self.poll:
+            self.poll.register(fd, select.POLLIN | select.POLLPRI)
+
+    def unregister(self, fd):
+        self.fds.discard(fd)
+        if self.poll:
+            self.poll.unregister(fd)
+
+    def ready(self, timeout):
+        if self.poll:
+            return [fd for fd, _ in self.poll.poll(timeout * 1000)]
+        return select.select(list(self.fds), [], [], timeout)[0]
+
+
+class Stream(object):
+    """
+    One followed log: a process-like source (see Docker.logs_process)
+    and the partial line read from it so far.
+    """
+    def __init__(self, name, source):
+        self.name = name
+        self.source = source
+        self.buffer = ''
+        self.stdout = source.stdout
+        self.fd = self.stdout.fileno()
+
+    def read(self):
+        """
+        Reads a chunk and returns the complete lines in it (without the
+        line ends) and whether the stream ended.
+        """
+        if hasattr(self.stdout, 'read_chunk'):
+            chunk = self.stdout.read_chunk()
+        else:
+            chunk = os.read(self.fd, CHUNK_SIZE)
+
+        if not chunk:
+            lines = [self.buffer] if self.buffer else []
+            self.buffer = ''
+            return lines, True
+
+        lines = (self.buffer + chunk).split('\n')
+        self.buffer = lines.pop()
+        return lines, False
+
+    def close(self):
+        try:
+            if self.source.poll() is None:
+                self.source.terminate()
+        except OSError:
+            pass
+        self.source.wait()
+        self.stdout.close()
+
+
+class Multiplexer(object):
+    """
+    Follows any number of log streams in a single thread: waits until
+    some of them are readable and reads whole chunks from each.
+    """
+    def __init__(self):
+        self.poller = Poller()
+        self.streams = {}
+
+    def __len__(self):
+        return len(self.streams)
+
+    def add(self, name, source):
+        stream = Stream(name, source)
+        self.streams[stream.fd] = stream
+        self.poller.register(stream.fd)
+
+    def remove(self, fd):
+        stream = self.streams.pop(fd)
+        self.poller.unregister(fd)
+        stream.close()
+
+    def remove_name(self, name):
+        for fd, stream in list(self.streams.items()):
+            if stream.name == name:
+                self.remove(fd)
+
+    def read(self, timeout):
+        """
+        Returns a list of (name, lines) read from the streams ready within
+        timeout seconds. Ended streams are removed.
+        """
+        batches = []
+        for fd in self.poller.ready(timeout):
+            stream = self.streams.get(fd)
+            if stream is None:
+                continue
+            lines, ended = stream.read()
+            if lines:
+                batches.append((stream.name, lines))
+            if ended:
+                self.remove(fd)
+        return batches
+
+    def close(self):
+        for fd in list(self.streams):
+            self.remove(fd)
+
+
+class LogFilter(object):
+    """
+    Selects log lines: a line is kept if it matches any of the include
+    regexes (if given), none of the exclude ones and, if fields are given,
+    it is a json object with all the fields (dotted keys for nested ones)
+    equal to the given values, compared as case insensitive strings.
+    """
+    def __init__(self, include=(), exclude=(), fields=None):
+        self.include = self.compile(include)
+        self.exclude = self.compile(exclude)
+        self.fields = [(key.split('.'), unicode(value).lower())
+                       for key, value in (fields or {}).items()]
+
+    def compile(self, patterns):
+        if not patterns:
+            return None
+        return re.compile('|'.join('(?:%s)' % p for p in patterns))
+
+    def __nonzero__(self):
+        return bool(self.include or self.exclude or self.fields)
+
+    def match_fields(self, line):
+        if not line.startswith('{'):
+            return False
+        try:
+            data = json.loads(line)
+        except ValueError:
+            return False
+
+        for keys, value in self.fields:
+            actual = data
+            for key in keys:
+                if not isinstance(actual, dict) or key not in actual:
+                    return False
+                actual = actual[key]
+            if unicode(actual).lower() != value:
+                return False
+        return True
+
+    def match(self, line):
+        if self.include and not self.include.search(line):
+            return False
+        if self.exclude and self.exclude.search(line):
+            return False
+        if self.fields and not self.match_fields(line):
+            return False
+        return True
+
+    def filter(self, batch):
+        ret = []
+        for name, lines in batch:
+            lines = [line for line in lines if self.match(line)]
+            if lines:
+                ret.append((name, lines))
+        return ret
+
+
+class Renderer(object):
+    """
+    Writes batches of log lines prefixed with the container name, all the
+    lines of a batch with one write. The prefixes are colored, a
+    different color for each container, if color is True or if it is
+    None and the stream is a terminal.
+    """
+    def __init__(self, stream=None, color=None):
+        self.stream = stream or sys.stdout
+        if color is None:
+            isatty = getattr(self.stream, 'isatty', None)
+            color = bool(isatty and isatty())
+        self.color = color
+        self.prefixes = {}
+
+    def prefix(self, name):
+        prefix = self.prefixes.get(name)
+        if prefix is None:
+            prefix = name + ': '
+            if self.color:
+                fg = COLORS[len(self.prefixes) % len(COLORS)]
+                prefix = click.style(prefix, fg=fg)
+            if isinstance(prefix, unicode):
+                prefix = prefix.encode('utf-8')
+            self.prefixes[name] = prefix
+        return prefix
+
+    def render(self, batch):
+        parts = []
+        for name, lines in batch:
+            prefix = self.prefix(name)
+            for line in lines:
+                parts.append(prefix)
+                parts.append(line)
+                parts.append('\n')
+        return ''.join(parts)
+
+    def write(self, batch):
+        self.stream.write(self.render(batch))
+        self.stream.flush()
+
+
+class Pipeline(object):
+    """
+    Bounded queue of batches between the reading thread and a writer
+    thread calling write with each of them. A batch is a list of (name,
+    lines) as returned by Multiplexer.read. When the queue is full, depending
+    on the policy, put blocks (and so does the reading, pushing back on
+    docker), drops the oldest queued batch or keeps only every sample-th
+    line of the new one: sample still blocks until there is room, it only
+    makes the writer catch up sooner. Dropped lines are counted per
+    container and reported by close.
+
+    If write raises (IOError on a closed pipe, ...) the writer keeps
+    taking the batches without writing them, and put and close raise the
+    error.
+    """
+    def __init__(self, write, maxsize=100, policy='block', sample=10):
+        if policy not in POLICIES:
+            raise ValueError('Unknown policy: %s' % policy)
+
+        self.write = write
+        self.policy = policy
+        self.sample = sample
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = {}
+        self.closed = False
+        self.error = None
+
+        self.thread = threading.Thread(target=self.writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def writer(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.write(batch)
+            except Exception as e:
+                self.error = e
+
+    def drop(self, batch):
+        for name, lines in batch:
+            self.dropped[name] = self.dropped.get(name, 0) + len(lines)
+
+    def put(self, batch):
+        if self.error is not None:
+            raise self.error
+
+        if self.policy == 'drop-oldest':
+            while True:
+                try:
+                    self.queue.put_nowait(batch)
+                    return
+                except Queue.Full:
+                    try:
+                        self.drop(self.queue.get_nowait())
+                    except Queue.Empty:
+                        pass
+
+        if self.policy == 'sample' and self.queue.full():
+            sampled = []
+            for name, lines in batch:
+                kept = lines[::self.sample]
+                self.drop([(name, lines[:len(lines) - len(kept)])])
+                sampled.append((name, kept))
+            batch = sampled
+
+        self.queue.put(batch)
+
+    def close(self):
+        """
+        Writes out the queued batches and reports the dropped lines, or
+        raises the error of write.
+        """
+        if self.closed:
+            return
+        self.closed = True
+
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            raise self.error
+        for name in sorted(self.dropped):
+            utils.red('%s: %s lines dropped' % (name, self.dropped[name]))
@@ -0,0 +1,243 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import abc
+import errno
+import re
+import select
+import socket
+import time
+
+import dockman
+from . import logs
+from . import utils
+
+
+DEFAULT_TIMEOUT = 60
+# seconds between two checks of a probe
+DEFAULT_INTERVAL = 0.2
+
+KINDS = ('port', 'cmd', 'log')
+
+
+class NotReadyError(Exception):
+    pass
+
+
+def check_config(container_name, config):
+    """
+    Validates the ready block of a container:
+
+        ready:
+            port: 5432       # a TCP connection is accepted
+            host: 127.0.0.1  # by default the address of the container
+        or  cmd: pg_isready  # docker exec of the command exits with 0
+        or  log: ready to accept connections  # a log line matches
+            timeout: 60
+            interval: 0.2
+    """
+    if config is None:
+        return
+    if not isinstance(config, dict):
+        msg = 'ready of %s must be a mapping' % container_name
+        raise utils.WrongConfigException(msg)
+
+    kinds = [k for k in KINDS if k in config]
+    if len(kinds) != 1:
+        msg = ('ready of %s needs exactly one of %s' %
+               (container_name, ', '.join(KINDS)))
+        raise utils.WrongConfigException(msg)
+
+    def invalid(key, expected):
+        msg = ('ready %s of %s must be %s, not %r' %
+               (key, container_name, expected, config[key]))
+        raise utils.WrongConfigException(msg)
+
+    port = config.get('port')
+    if 'port' in config and (not isinstance(port, int) or
+                             isinstance(port, bool) or
+                             not 0 < port < 65536):
+        invalid('port', 'a port number')
+    for key in ('timeout', 'interval'):
+        value = config.get(key)
+        if key in config and (not isinstance(value, (int, float)) or
+                              isinstance(value, bool) or value <= 0):
+            invalid(key, 'a number of seconds > 0')
+    for key in ('host', 'cmd', 'log'):
+        if key in config and not isinstance(config[key], basestring):
+            invalid(key, 'a string')
+
+    if 'log' in config:
+        try:
+            re.compile(config['log'])
+        except re.error as e:
+            msg = 'Invalid ready log regex of %s: %s' % (container_name, e)
+            raise utils.WrongConfigException(msg)
+
+
+def probe(container_name, config):
+    """
+    Returns a new probe for the ready block of a container.
+    """
+    kwargs = {'timeout': config.get('timeout', DEFAULT_TIMEOUT),
+              'interval': config.get('interval', DEFAULT_INTERVAL)}
+    if 'port' in config:
+        return PortProbe(container_name, int(config['port']),
+                         config.get('host'), **kwargs)
+    if 'cmd' in config:
+        return ExecProbe(container_name, str(config['cmd']).split(),
+                         **kwargs)
+    return LogProbe(container_name, config['log'], **kwargs)
+
+
+class Probe(object):
+    """
+    Tells whether a started container is ready. poll never blocks: the
+    scheduler polls all the pending probes in its own loop, each one
+    checked at most every interval seconds.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self, container_name, timeout=DEFAULT_TIMEOUT,
+                 interval=DEFAULT_INTERVAL):
+        self.container_name = container_name
+        self.timeout = timeout
+        self.interval = interval
+        self.deadline = time.time() + timeout
+        self.next_check = 0
+
+    @abc.abstractmethod
+    def check(self):
+        """
+        Returns whether the container is ready now, without blocking.
+        """
+
+    def close(self):
+        pass
+
+    def poll(self):
+        """
+        Returns True once the container is ready, raises NotReadyError
+        when it is not in time.
+        """
+        message = '%s ready ... ' % self.container_name
+        now = time.time()
+        if now >= self.next_check:
+            self.next_check = now + self.interval
+            if self.check():
+                self.close()
+                utils.status(message)
+                return True
+
+        if now >= self.deadline:
+            self.close()
+            e = NotReadyError('%s not ready after %s seconds' %
+                              (self.container_name, self.timeout))
+            utils.status(message, ok=False, error=e)
+            raise e
+        return False
+
+
+class PortProbe(Probe):
+    """
+    Ready when a TCP connection to the port is accepted. The connection
+    is made without blocking and completed by a later check.
+    """
+    def __init__(self, container_name, port, host=None, **kwargs):
+        super(PortProbe, self).__init__(container_name, **kwargs)
+        self.port = port
+        self.host = host
+        self.sock = None
+
+    def address(self):
+        if self.host is None:
+            ip = dockman.DOCKER.ip_address(self.container_name)
+            self.host = ip or '127.0.0.1'
+        return self.host, self.port
+
+    def check(self):
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setblocking(0)
+            err = self.sock.connect_ex(self.address())
+            if err == 0:
+                return True
+            if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK,
+                           errno.EAGAIN):
+                self.close()
+            return False
+
+        _, writable, _ = select.select([], [self.sock], [], 0)
+        if not writable:
+            return False
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        self.close()
+        return err == 0
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class ExecProbe(Probe):
+    """
+    Ready when the command run in the container exits with 0. It is run
+    again after each failure.
+    """
+    def __init__(self, container_name, cmd, **kwargs):
+        super(ExecProbe, self).__init__(container_name, **kwargs)
+        self.cmd = cmd
+        self.process = None
+
+    def check(self):
+        if self.process is None:
+            self.process = dockman.DOCKER.exec_process(self.container_name,
+                                                       self.cmd)
+        returncode = self.process.poll()
+        if returncode is None:
+            return False
+        self.process = None
+        return returncode == 0
+
+    def close(self):
+        if self.process is not None:
+            try:
+                if self.process.poll() is None:
+                    self.process.terminate()
+            except OSError:
+                pass
+            self.process.wait()
+            self.process = None
+
+
+class LogProbe(Probe):
+    """
+    Ready when a line of the container's log (from the start) matches the
+    regex. The log is followed and only the available chunks are read.
+    """
+    def __init__(self, container_name, regex, **kwargs):
+        super(LogProbe, self).__init__(container_name, **kwargs)
+        self.regex = re.compile(regex)
+        self.stream = None
+
+    def check(self):
+        if self.stream is None:
+            source = dockman.DOCKER.logs_process(self.container_name,
+                                                 tail='all')
+            self.stream = logs.Stream(self.container_name, source)
+
+        while select.select([self.stream.fd], [], [], 0)[0]:
+            lines, ended = self.stream.read()
+            if any(self.regex.search(line) for line in lines):
+                return True
+            if ended:
+                self.close()
+                break
+        return False
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
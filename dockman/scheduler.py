@@ -0,0 +1,229 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import itertools
+import os
+import threading
+import time
+import Queue
+
+
+DEFAULT_WORKERS = 4
+
+# seconds the main loop waits for a result before polling the probes
+POLL_INTERVAL = 0.1
+
+# the result of a task a worker took after the first failure
+NOT_RUN = object()
+
+
+def default_workers():
+    """
+    Size of the worker pool, can be overridden with DOCKMAN_WORKERS.
+    """
+    try:
+        workers = int(os.environ.get('DOCKMAN_WORKERS', DEFAULT_WORKERS))
+    except ValueError:
+        workers = DEFAULT_WORKERS
+    return max(1, workers)
+
+
+class Scheduler(object):
+    """
+    Calls func(node) for every node on a bounded pool of worker threads.
+    A node is handed to a worker as soon as all of its dependencies
+    (restricted to the given nodes) are done. After the first failure no
+    new nodes are started, not even those already queued (they end up in
+    skipped), the running ones are waited for and the exception is
+    reraised.
+
+    func may return a probe (see readiness.Probe): then the node is done
+    only when probe.poll() returns True. The pending probes are polled
+    by the main loop, they do not hold a worker.
+
+    With batch, a function returning a key for a node (or None), the
+    nodes ready at the same time with the same key are handed to func at
+    once, as a list: func(nodes) then returns a dictionary mapping each
+    node to its result, a probe, None or the exception it failed with.
+    The nodes without key are handed alone, still in a list.
+
+    With priority, a function returning a number for a node, the ready
+    nodes with the highest priority are handed to the workers first.
+    After run, durations maps each node done to the seconds from the
+    moment a worker took it until it was done (its probe included).
+    """
+
+    def __init__(self, nodes, dependencies, func, workers=None,
+                 batch=None, priority=None):
+        self.nodes = list(nodes)
+        self.func = func
+        self.workers = workers or default_workers()
+        self.batch = batch
+        self.priority = priority
+        self.started = {}
+        self.durations = {}
+        self.skipped = []
+        self.failed = threading.Event()
+
+        nodeset = set(self.nodes)
+        self.waiting = {}
+        self.dependents = {}
+        for node in self.nodes:
+            deps = set(dependencies(node)) & nodeset
+            self.waiting[node] = deps
+            for dep in deps:
+                self.dependents.setdefault(dep, []).append(node)
+
+    def _worker(self, tasks, results):
+        while True:
+            _, _, task = tasks.get()
+            if task is None:
+                break
+            if self.failed.is_set():
+                results.put([(node, NOT_RUN, None) for node in task])
+                continue
+            now = time.time()
+            for node in task:
+                self.started[node] = now
+            try:
+                if self.batch is None:
+                    outcome = {task[0]: self.func(task[0])}
+                else:
+                    outcome = self.func(task) or {}
+            except Exception as e:
+                self.failed.set()
+                results.put([(node, None, e) for node in task])
+                continue
+
+            finished = []
+            for node in task:
+                result = outcome.get(node)
+                if isinstance(result, Exception):
+                    self.failed.set()
+                    finished.append((node, None, result))
+                else:
+                    finished.append((node, result, None))
+            results.put(finished)
+
+    def group(self, ready):
+        """
+        Groups the ready nodes into the lists handed to the workers, the
+        highest priority first.
+        """
+        if self.priority is not None:
+            ready = sorted(ready, key=self.priority, reverse=True)
+
+        if self.batch is None:
+            return [[node] for node in ready]
+
+        groups = []
+        batches = {}
+        for node in ready:
+            key = self.batch(node)
+            if key is None:
+                groups.append([node])
+            elif key in batches:
+                batches[key].append(node)
+            else:
+                batches[key] = [node]
+                groups.append(batches[key])
+        return groups
+
+    def rank(self, task):
+        # the tasks queue hands out the lowest first
+        if self.priority is None:
+            return 0
+        return -max(self.priority(node) for node in task)
+
+    def done(self, node):
+        """
+        Returns the nodes that became ready by finishing node.
+        """
+        self.durations[node] = time.time() - self.started[node]
+        ready = []
+        for dependent in self.dependents.get(node, []):
+            self.waiting[dependent].discard(node)
+            if not self.waiting[dependent]:
+                ready.append(dependent)
+        return ready
+
+    def run(self):
+        if not self.nodes:
+            return
+
+        tasks = Queue.PriorityQueue()
+        order = itertools.count()
+        results = Queue.Queue()
+        threads = []
+        for _ in range(min(self.workers, len(self.nodes))):
+            th = threading.Thread(target=self._worker, args=(tasks, results))
+            th.daemon = True
+            th.start()
+            threads.append(th)
+
+        ready = [n for n in self.nodes if not self.waiting[n]]
+        running = 0
+        probes = {}
+        error = None
+
+        try:
+            while ready or running or probes:
+                if error is None:
+                    for task in self.group(ready):
+                        tasks.put((self.rank(task), next(order), task))
+                        running += len(task)
+                ready = []
+
+                if not running and not probes:
+                    break
+
+                # wait for a result, then take all the available ones so
+                # that the nodes they make ready are dispatched together
+                finished = []
+                try:
+                    finished += results.get(True, POLL_INTERVAL)
+                    while True:
+                        finished += results.get_nowait()
+                except Queue.Empty:
+                    pass
+
+                for node, probe, exc in finished:
+                    running -= 1
+                    if probe is NOT_RUN:
+                        self.skipped.append(node)
+                    elif exc is not None:
+                        error = error or exc
+                    elif probe is not None and error is None:
+                        probes[node] = probe
+                    else:
+                        ready += self.done(node)
+
+                for node, probe in list(probes.items()):
+                    try:
+                        if not probe.poll():
+                            continue
+                    except Exception as e:
+                        error = error or e
+                    else:
+                        ready += self.done(node)
+                    del probes[node]
+
+                if error is not None:
+                    self.failed.set()
+                    self.close_probes(probes)
+        finally:
+            self.close_probes(probes)
+            for _ in threads:
+                tasks.put((float('inf'), next(order), None))
+
+        for th in threads:
+            th.join()
+
+        if error is not None:
+            raise error
+
+    def close_probes(self, probes):
+        for probe in probes.values():
+            probe.close()
+        probes.clear()
@@ -0,0 +1,156 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import json
+import os
+import threading
+import time
+
+from . import utils
+
+
+# the Tracer collecting the spans, None while tracing is disabled
+TRACER = None
+
+# categories of the spans around a docker call, the others are phases
+CALLS = ('docker', 'api')
+
+
+class NullSpan(object):
+    """
+    What span returns while tracing is disabled: does nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def note(self, key, value):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, category='docker', **args):
+    """
+    Returns a context manager timing the block as a span of the tracer,
+    with args (the argv of a call, ...) and the outcome: ok or the
+    exception raised. A no-op when tracing is disabled.
+    """
+    tracer = TRACER
+    if tracer is None:
+        return NULL_SPAN
+    return Span(tracer, name, category, args)
+
+
+def enable():
+    global TRACER
+    TRACER = Tracer()
+    return TRACER
+
+
+def disable():
+    global TRACER
+    TRACER = None
+
+
+class Span(object):
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.time() - self.start
+        if exc_type is None:
+            outcome = 'ok'
+        else:
+            message = str(exc).strip().split('\n')[0]
+            outcome = '%s: %s' % (exc_type.__name__, message)
+        self.tracer.add(self, duration, outcome)
+        return False
+
+    def note(self, key, value):
+        self.args[key] = value
+
+
+class Tracer(object):
+    """
+    Collects the finished spans of all threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.origin = time.time()
+        self.spans = []
+        # thread ident -> (small id, name), in order of appearance
+        self.threads = {}
+
+    def add(self, span, duration, outcome):
+        thread = threading.current_thread()
+        with self.lock:
+            if thread.ident not in self.threads:
+                self.threads[thread.ident] = (len(self.threads) + 1,
+                                              thread.name)
+            tid = self.threads[thread.ident][0]
+            self.spans.append({
+                'name': span.name, 'category': span.category,
+                'start': span.start - self.origin, 'duration': duration,
+                'tid': tid, 'thread': thread.name, 'outcome': outcome,
+                'args': span.args})
+
+    def chrome_events(self):
+        """
+        Returns the spans as complete events of the Chrome trace-event
+        format (chrome://tracing, Perfetto), with the thread names.
+        """
+        pid = os.getpid()
+        events = []
+        for tid, name in sorted(self.threads.values()):
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                           'tid': tid, 'args': {'name': name}})
+        for s in self.spans:
+            args = dict(s['args'], outcome=s['outcome'])
+            if 'argv' in args:
+                args['argv'] = ' '.join(args['argv'])
+            events.append({'name': s['name'], 'cat': s['category'],
+                           'ph': 'X', 'pid': pid, 'tid': s['tid'],
+                           'ts': int(s['start'] * 1e6),
+                           'dur': int(s['duration'] * 1e6), 'args': args})
+        return events
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.chrome_events(),
+                       'displayTimeUnit': 'ms'}, f)
+
+    def timings(self, limit=10):
+        """
+        Prints the duration of the phases and the slowest docker calls.
+        """
+        phases = [s for s in self.spans if s['category'] not in CALLS]
+        calls = [s for s in self.spans if s['category'] in CALLS]
+        if phases:
+            utils.yellow('%-24s %9s' % ('phase', 'ms'))
+            for s in sorted(phases, key=lambda s: s['start']):
+                utils.echo('%-24s %9.1f' % (s['name'], s['duration'] * 1000))
+
+        total = sum(s['duration'] for s in calls)
+        utils.yellow('%d docker calls, %.1f ms in total, the slowest:' %
+                     (len(calls), total * 1000))
+        utils.yellow('%9s  %-12s  %-7s  %s' % ('ms', 'thread', 'outcome',
+                                               'call'))
+        for s in sorted(calls, key=lambda s: -s['duration'])[:limit]:
+            argv = s['args'].get('argv')
+            call = ' '.join(argv) if argv else s['name']
+            outcome = 'ok' if s['outcome'] == 'ok' else 'error'
+            utils.echo('%9.1f  %-12s  %-7s  %s' % (
+                s['duration'] * 1000, s['thread'][:12], outcome, call))
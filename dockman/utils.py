@@ -3,25 +3,15 @@
 from __future__ import absolute_import
 
 import functools
+import threading
 import sys
 import os
 
 import click
-from yaml import Loader, SafeLoader
 
 import dockman
 
 
-# --------------------
-# Override the default yaml string handling function
-# to always return unicode objects
-def construct_yaml_str(self, node):
-    return self.construct_scalar(node)
-Loader.add_constructor(u'tag:yaml.org,2002:str', construct_yaml_str)
-SafeLoader.add_constructor(u'tag:yaml.org,2002:str', construct_yaml_str)
-# --------------------
-
-
 class NoConfigException(Exception):
     pass
 
@@ -40,13 +30,67 @@ yellow_ = functools.partial(click.secho, fg='yellow', nl=False)
 echo = click.echo
 echo_ = functools.partial(click.echo, nl=False)
 
+# status lines can be written from several worker threads
+output_lock = threading.Lock()
+
+
+def status(message, ok=True, error=None):
+    """
+    Writes a whole status line at once, followed by the error if any.
+    """
+    if ok:
+        mark = click.style(u'✔', fg='green')
+    else:
+        mark = click.style(u'✘', fg='red')
+
+    with output_lock:
+        echo(message + mark)
+        if error is not None:
+            red(str(error))
+
+
+def get_context():
+    """
+    Returns the context, loading it on first use. Returns None if there
+    is no config file, exits if the config is wrong.
+    """
+    if dockman.CONTEXT is None:
+        from . import context
+        from . import trace
+        try:
+            with trace.span('load context', 'phase'):
+                dockman.CONTEXT = context.Context()
+        except NoConfigException:
+            return None
+        except WrongConfigException as e:
+            red(str(e))
+            sys.exit(1)
+    return dockman.CONTEXT
+
+
+def get_docker():
+    """
+    Returns the Docker backend, creating it on first use with the backend
+    given in the config, if the context is already loaded.
+    """
+    if dockman.DOCKER is None:
+        from . import docker
+        config = dockman.CONTEXT.config if dockman.CONTEXT else {}
+        try:
+            dockman.DOCKER = docker.from_env(config.get('backend'))
+        except WrongConfigException as e:
+            red(str(e))
+            sys.exit(1)
+    return dockman.DOCKER
+
 
 def needs_context(func):
     def wrapper(*args, **kwargs):
-        if dockman.CONTEXT is None:
+        if get_context() is None:
             red('No config file found')
             sys.exit(1)
         else:
+            get_docker()
             return func(*args, **kwargs)
 
     return functools.update_wrapper(wrapper, func)
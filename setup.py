@@ -13,6 +13,6 @@ setup(
         'PyYAML >= 3.11'
     ],
     entry_points={
-        "console_scripts": ['dockman = dockman.dockman:main']
+        "console_scripts": ['dockman = dockman.dockman:cli']
     }
 )
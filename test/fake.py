@@ -0,0 +1,560 @@
+# coding: utf-8
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import Queue
+import random
+import re
+import threading
+import time
+
+from dockman.docker import Docker, DockerError
+from dockman.logs import epoch_to_rfc3339, to_epoch
+
+
+TEMPLATE_RE = re.compile(r'\{\{\s*\.([\w.]+)\s*\}\}')
+
+
+class FakeProcess(object):
+    """
+    A process-like object (see Docker.logs_process) whose stdout is a
+    real pipe, so it can be selected on like the one of a docker client.
+    What the engine writes is queued and fed to the pipe by a thread:
+    writing never blocks the engine.
+    """
+    def __init__(self, on_terminate=None):
+        read_fd, self.write_fd = os.pipe()
+        self.stdout = os.fdopen(read_fd, 'rb')
+        self.returncode = None
+        self.on_terminate = on_terminate
+        self.ended = False
+        self.done = threading.Event()
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.feed)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def feed(self):
+        broken = False
+        while True:
+            item = self.queue.get()
+            if isinstance(item, int):
+                break
+            while item and not broken:
+                try:
+                    item = item[os.write(self.write_fd, item):]
+                except OSError:
+                    # the reader closed its end
+                    broken = True
+        os.close(self.write_fd)
+        self.returncode = item
+        self.done.set()
+
+    def write(self, data):
+        if not self.ended:
+            self.queue.put(data)
+
+    def end(self, returncode=0):
+        if not self.ended:
+            self.ended = True
+            self.queue.put(returncode)
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.done.wait()
+        return self.returncode
+
+    def terminate(self):
+        if self.on_terminate is not None:
+            self.on_terminate(self)
+        self.end(-15)
+
+
+class FakeEngine(object):
+    """
+    An in-memory docker engine answering the docker command lines dockman
+    uses (run, start, stop, rm, ps, inspect, images, pull) with the output
+    the docker client would print, errors included. The containers keep
+    their name, running state, port bindings and links as docker inspect
+    shows them; ports are allocated on the host and links checked on
+    start. Thread safe.
+
+    popen answers the followed commands (logs, events, exec) with a
+    FakeProcess; what a container prints is given with output.
+    """
+    def __init__(self, images=()):
+        self.lock = threading.Lock()
+        self.containers = {}
+        self.images = set(images)
+        self.counter = 0
+        # container name -> [(time, line)]
+        self.logs = {}
+        # [(time, action, container name)]
+        self.events = []
+        # (process, container name or None for events, options)
+        self.followers = []
+        # host port -> name of the running container bound to it
+        self.ports = {}
+        self.running = 0
+
+    def new_id(self, name):
+        self.counter += 1
+        return hashlib.sha1('%s-%s' % (name, self.counter)).hexdigest()
+
+    def find(self, ref):
+        container = self.containers.get(ref)
+        if container is not None:
+            return container
+        for container in self.containers.values():
+            if container['Id'].startswith(ref):
+                return container
+        return None
+
+    def execute(self, params):
+        with self.lock:
+            handler = getattr(self, 'do_' + params[0], None)
+            if handler is None:
+                raise DockerError('docker: \'%s\' is not a docker command.\n'
+                                  % params[0])
+            return handler(list(params[1:]))
+
+    def popen(self, params):
+        """
+        Returns a FakeProcess running the docker command line params:
+        logs and events are followed, the other commands end with their
+        output (exit code 1 on error).
+        """
+        handler = getattr(self, 'popen_' + params[0], None)
+        if handler is not None:
+            with self.lock:
+                return handler(list(params[1:]))
+
+        process = FakeProcess()
+        try:
+            process.write(self.execute(params) or '')
+        except DockerError as e:
+            process.write(str(e))
+            process.end(1)
+        else:
+            process.end(0)
+        return process
+
+    def output(self, name, *lines):
+        """
+        Makes the running container print lines, as seen by docker logs.
+        """
+        with self.lock:
+            container = self.containers.get(name)
+            if container is None or not container['State']['Running']:
+                raise DockerError('Container %s is not running\n' % name)
+            for line in lines:
+                now = time.time()
+                self.logs[name].append((now, line))
+                for process, followed, options in self.followers:
+                    if followed == name:
+                        process.write(self.log_line(now, line, options))
+
+    def emit(self, action, name):
+        now = time.time()
+        self.events.append((now, action, name))
+        for process, followed, options in self.followers:
+            if followed is None and action in options['events']:
+                process.write(self.event_line(now, action, name))
+
+    def detach(self, process):
+        with self.lock:
+            self.followers = [f for f in self.followers if f[0] is not process]
+
+    def end_logs(self, name):
+        for process, followed, _ in self.followers:
+            if followed == name:
+                process.end(0)
+        self.followers = [f for f in self.followers if f[1] != name]
+
+    def each(self, names, func, action):
+        """
+        Calls func for each existing container, printing its name as the
+        docker client does, or the error.
+        """
+        out = []
+        failed = []
+        for name in names:
+            container = self.find(name)
+            if container is None:
+                out.append('Error response from daemon: No such container: '
+                           '%s' % name)
+                failed.append(name)
+                continue
+            error = func(container)
+            if error:
+                out.append('Error response from daemon: %s' % error)
+                failed.append(name)
+            else:
+                out.append(name)
+
+        output = '\n'.join(out) + '\n'
+        if failed:
+            output += ('Error: failed to %s containers: [%s]\n' %
+                       (action, ' '.join(failed)))
+            raise DockerError(output)
+        return output
+
+    def start_container(self, container):
+        """
+        Starts the container, returns the error if it cannot be.
+        """
+        name = container['Name'][1:]
+        if container['State']['Running']:
+            return None
+
+        for link in container['HostConfig']['Links'] or []:
+            target, alias = link.split(':')
+            linked = self.containers.get(target[1:])
+            if linked is None or not linked['State']['Running']:
+                return ('Cannot link to a non running container: %s AS %s' %
+                        (target, alias))
+
+        bindings = container['HostConfig']['PortBindings']
+        for port in sorted(bindings):
+            host_port = bindings[port][0]['HostPort']
+            if host_port in self.ports:
+                return ('driver failed programming external connectivity on '
+                        'endpoint %s (%s): Bind for 0.0.0.0:%s failed: port '
+                        'is already allocated' %
+                        (name, container['Id'], host_port))
+
+        self.running += 1
+        container['State'].update({
+            'Running': True, 'Pid': 1000 + self.counter, 'ExitCode': 0,
+            'StartedAt': epoch_to_rfc3339(time.time())})
+        container['NetworkSettings']['IPAddress'] = '172.17.0.%d' % (
+            self.running + 1)
+        container['NetworkSettings']['Ports'] = {}
+        for port, binding in bindings.items():
+            host_port = binding[0]['HostPort']
+            self.ports[host_port] = name
+            container['NetworkSettings']['Ports'][port] = [
+                {'HostIp': '0.0.0.0', 'HostPort': host_port}]
+        self.emit('start', name)
+        return None
+
+    def stop_container(self, container, exit_code=0):
+        name = container['Name'][1:]
+        if not container['State']['Running']:
+            return
+        container['State'].update({
+            'Running': False, 'Pid': 0, 'ExitCode': exit_code,
+            'FinishedAt': epoch_to_rfc3339(time.time())})
+        self.running -= 1
+        for port in container['NetworkSettings']['Ports'].values():
+            self.ports.pop(port[0]['HostPort'], None)
+        container['NetworkSettings']['IPAddress'] = ''
+        container['NetworkSettings']['Ports'] = {}
+        self.end_logs(name)
+        self.emit('die', name)
+        self.emit('stop', name)
+
+    def remove_container(self, container):
+        name = container['Name'][1:]
+        del self.containers[name]
+        del self.logs[name]
+        self.emit('destroy', name)
+
+    def do_run(self, args):
+        options = {'name': None, 'labels': {}, 'daemon': False,
+                   'remove': False, 'volumes_from': [], 'binds': [],
+                   'ports': {}, 'links': [], 'env': [], 'stop_signal': None}
+        while args and args[0].startswith('-'):
+            flag = args.pop(0)
+            if flag == '-d':
+                options['daemon'] = True
+            elif flag == '--rm':
+                options['remove'] = True
+            elif flag == '--name':
+                options['name'] = args.pop(0)
+            elif flag == '--label':
+                key, _, value = args.pop(0).partition('=')
+                options['labels'][key] = value
+            elif flag == '--volumes-from':
+                options['volumes_from'].append(args.pop(0))
+            elif flag == '-v':
+                options['binds'].append(args.pop(0))
+            elif flag == '-p':
+                host_port, _, port = args.pop(0).rpartition(':')
+                if '/' not in port:
+                    port += '/tcp'
+                options['ports'][port] = [{'HostIp': '',
+                                           'HostPort': host_port}]
+            elif flag == '--link':
+                options['links'].append(args.pop(0))
+            elif flag == '-e':
+                options['env'].append(args.pop(0))
+            elif flag == '--stop-signal':
+                options['stop_signal'] = args.pop(0)
+
+        def error(message):
+            return DockerError('docker: Error response from daemon: %s.\n'
+                               'See \'docker run --help\'.\n' % message)
+
+        image, cmd = args[0], args[1:]
+        name = options['name'] or 'container_%s' % (self.counter + 1)
+        if name in self.containers:
+            raise error('Conflict. The container name "/%s" is already in '
+                        'use by container "%s". You have to remove (or '
+                        'rename) that container to be able to reuse that '
+                        'name' % (name, self.containers[name]['Id']))
+        for ref in options['volumes_from']:
+            if self.find(ref) is None:
+                raise error('No such container: %s' % ref)
+        links = []
+        for link in options['links']:
+            target, _, alias = link.partition(':')
+            if target not in self.containers:
+                raise error('Could not get container for %s' % target)
+            links.append('/%s:/%s/%s' % (target, name, alias or target))
+        self.images.add(image)
+
+        container_id = self.new_id(name)
+        container = self.containers[name] = {
+            'Id': container_id,
+            'Name': '/' + name,
+            'Created': epoch_to_rfc3339(time.time()),
+            'State': {'Running': False, 'Pid': 0, 'ExitCode': 0,
+                      'StartedAt': '0001-01-01T00:00:00Z',
+                      'FinishedAt': '0001-01-01T00:00:00Z'},
+            'Config': {'Image': image, 'Cmd': cmd, 'Env': options['env'],
+                       'Labels': options['labels'], 'Tty': False,
+                       'StopSignal': options['stop_signal'],
+                       'ExposedPorts': dict.fromkeys(options['ports'], {})},
+            'HostConfig': {'Binds': options['binds'] or None,
+                           'Links': links or None,
+                           'PortBindings': options['ports'],
+                           'VolumesFrom': options['volumes_from'] or None},
+            'NetworkSettings': {'IPAddress': '', 'Ports': {}},
+            'LogPath': '',
+        }
+        self.logs[name] = []
+
+        message = self.start_container(container)
+        if message:
+            raise error(message)
+        if options['daemon']:
+            return container_id + '\n'
+
+        # attached: the command runs to its end
+        self.stop_container(container)
+        if options['remove']:
+            self.remove_container(container)
+        return ''
+
+    def do_start(self, args):
+        return self.each(args, self.start_container, 'start')
+
+    def do_stop(self, args):
+        names = []
+        while args:
+            arg = args.pop(0)
+            if arg == '-t':
+                args.pop(0)
+            else:
+                names.append(arg)
+
+        def stop(container):
+            self.stop_container(container)
+        return self.each(names, stop, 'stop')
+
+    def do_rm(self, args):
+        force = '-f' in args or '--force' in args
+        names = [a for a in args if not a.startswith('-')]
+
+        def remove(container):
+            name = container['Name'][1:]
+            if container['State']['Running']:
+                if not force:
+                    return ('You cannot remove a running container %s. Stop '
+                            'the container before attempting removal or '
+                            'force remove' % name)
+                self.stop_container(container, 137)
+            self.remove_container(container)
+        return self.each(names, remove, 'remove')
+
+    def do_ps(self, args):
+        prefix = ''
+        if '--filter' in args:
+            prefix = args[args.index('--filter') + 1].partition('=')[2]
+        every = '-a' in args or '--all' in args
+        ids = [c['Id'][:12] for name, c in sorted(self.containers.items())
+               if prefix in name and (every or c['State']['Running'])]
+        return ''.join(i + '\n' for i in ids)
+
+    def do_inspect(self, args):
+        fmt = None
+        if args[0].startswith('--format'):
+            fmt = args.pop(0).partition('=')[2] or args.pop(0)
+
+        infos = []
+        for ref in args:
+            container = self.find(ref)
+            if container is None:
+                raise DockerError('Error: No such object: %s\n' % ref)
+            infos.append(container)
+
+        if fmt is None:
+            return json.dumps(infos)
+        return ''.join(self.render(fmt.strip('"'), c) + '\n' for c in infos)
+
+    def render(self, fmt, container):
+        """
+        Expands the {{.Field.Path}} of a --format template.
+        """
+        def value(match):
+            value = container
+            for key in match.group(1).split('.'):
+                if not isinstance(value, dict) or key not in value:
+                    return '<no value>'
+                value = value[key]
+            if isinstance(value, bool):
+                return str(value).lower()
+            if isinstance(value, (dict, list)):
+                return json.dumps(value)
+            return str(value)
+        return TEMPLATE_RE.sub(value, fmt)
+
+    def do_images(self, args):
+        lines = ['REPOSITORY          TAG       IMAGE ID       SIZE']
+        for image in sorted(self.images):
+            repo, _, tag = image.rpartition(':')
+            if not repo or '/' in tag:
+                repo, tag = image, 'latest'
+            lines.append('%s %s %s 1MB' % (repo, tag,
+                                           hashlib.sha1(image).hexdigest()))
+        return '\n'.join(lines) + '\n'
+
+    def do_pull(self, args):
+        self.images.add(args[-1])
+        return 'Status: Downloaded newer image for %s\n' % args[-1]
+
+    def log_line(self, timestamp, line, options):
+        if options['timestamps']:
+            return '%s %s\n' % (epoch_to_rfc3339(timestamp), line)
+        return line + '\n'
+
+    def event_line(self, timestamp, action, name):
+        # the --format of Docker.events_process
+        return '%d %s %s\n' % (timestamp * 10 ** 9, action, name)
+
+    def popen_logs(self, args):
+        options = {'follow': False, 'timestamps': False, 'since': None,
+                   'until': None, 'tail': None}
+        while args and args[0].startswith('-'):
+            flag = args.pop(0)
+            if flag in ('-f', '--follow'):
+                options['follow'] = True
+            elif flag in ('-t', '--timestamps'):
+                options['timestamps'] = True
+            elif flag in ('--since', '--until'):
+                options[flag[2:]] = to_epoch(args.pop(0))
+            elif flag.startswith('--tail='):
+                tail = flag.partition('=')[2].strip('"')
+                options['tail'] = None if tail == 'all' else int(tail)
+
+        process = FakeProcess(self.detach)
+        name = args[0]
+        container = self.containers.get(name)
+        if container is None:
+            process.write('Error: No such container: %s\n' % name)
+            process.end(1)
+            return process
+
+        entries = [(t, line) for t, line in self.logs[name]
+                   if (options['since'] is None or t >= options['since']) and
+                   (options['until'] is None or t < options['until'])]
+        if options['tail'] is not None:
+            entries = entries[max(0, len(entries) - options['tail']):]
+        for t, line in entries:
+            process.write(self.log_line(t, line, options))
+
+        if (options['follow'] and options['until'] is None and
+                container['State']['Running']):
+            self.followers.append((process, name, options))
+        else:
+            process.end(0)
+        return process
+
+    def popen_events(self, args):
+        options = {'events': set(), 'since': None}
+        while args:
+            flag = args.pop(0)
+            if flag == '--filter':
+                key, _, value = args.pop(0).partition('=')
+                if key == 'event':
+                    options['events'].add(value)
+            elif flag in ('--since', '--format'):
+                value = args.pop(0)
+                if flag == '--since':
+                    options['since'] = to_epoch(value)
+        if not options['events']:
+            options['events'] = set(['start', 'die', 'stop', 'destroy'])
+
+        process = FakeProcess(self.detach)
+        for t, action, name in self.events:
+            if ((options['since'] is None or t >= options['since']) and
+                    action in options['events']):
+                process.write(self.event_line(t, action, name))
+        self.followers.append((process, None, options))
+        return process
+
+    def popen_exec(self, args):
+        process = FakeProcess()
+        name = args[0]
+        container = self.containers.get(name)
+        if container is None:
+            process.write('Error: No such container: %s\n' % name)
+            process.end(1)
+        elif not container['State']['Running']:
+            process.write('Error response from daemon: Container %s is not '
+                          'running\n' % container['Id'])
+            process.end(1)
+        else:
+            process.end(0)
+        return process
+
+
+class LatencyDocker(Docker):
+    """
+    The docker backend on a FakeEngine, each call taking latency seconds
+    plus up to jitter more, as a real daemon would, the jitter drawn from
+    a generator seeded with seed. The calls are counted by command.
+    """
+    def __init__(self, engine=None, latency=0, jitter=0, seed=0, **kwargs):
+        super(LatencyDocker, self).__init__(**kwargs)
+        self.engine = engine or FakeEngine()
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.calls = {}
+        self.calls_lock = threading.Lock()
+
+    def wait(self, command):
+        with self.calls_lock:
+            self.calls[command] = self.calls.get(command, 0) + 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+
+    def execute(self, params):
+        self.wait(params[0])
+        return self.engine.execute(list(params))
+
+    def execute_interactive(self, params):
+        self.execute(params)
+
+    def Popen(self, cmd, *args, **kwargs):
+        params = cmd[len(self.command):]
+        self.wait(params[0])
+        return self.engine.popen(params)
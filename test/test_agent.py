@@ -0,0 +1,122 @@
+# encoding: utf-8
+import os
+import shutil
+import StringIO
+import tempfile
+import threading
+import time
+
+import pytest
+
+import dockman
+from dockman import agent
+from dockman.docker import SafeDocker
+
+
+cwd = os.path.dirname(__file__)
+
+
+@pytest.fixture
+def project(request, monkeypatch):
+    tmpdir = tempfile.mkdtemp()
+    path = os.path.join(tmpdir, 'proj')
+    os.mkdir(path)
+    shutil.copy(os.path.join(cwd, 'test9.yaml'),
+                os.path.join(path, 'dockman.yaml'))
+    monkeypatch.setenv('DOCKMAN_AGENT_SOCKET',
+                       os.path.join(tmpdir, 'agent.sock'))
+    monkeypatch.delenv('DOCKMAN_NO_AGENT', raising=False)
+    request.addfinalizer(lambda: shutil.rmtree(tmpdir))
+    return path
+
+
+def test_find_project(project):
+    subdir = os.path.join(project, 'sub')
+    os.mkdir(subdir)
+    assert agent.find_project(subdir) == project
+    assert agent.find_project('/') is None
+
+
+def test_runtime_dir(project, monkeypatch):
+    tmpdir = os.path.dirname(project)
+    monkeypatch.delenv('DOCKMAN_AGENT_SOCKET')
+    monkeypatch.delenv('XDG_RUNTIME_DIR', raising=False)
+    monkeypatch.setattr(tempfile, 'gettempdir', lambda: tmpdir)
+
+    path = agent.socket_path(project)
+    directory = os.path.join(tmpdir, 'dockman-%s' % os.getuid())
+    assert os.path.dirname(path) == directory
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+
+    # others could put a socket there
+    os.chmod(directory, 0o755)
+    with pytest.raises(RuntimeError):
+        agent.socket_path(project)
+    assert agent.forward(['ps'], cwd=project) is None
+
+    monkeypatch.setenv('XDG_RUNTIME_DIR', tmpdir)
+    assert os.path.dirname(agent.socket_path(project)) == tmpdir
+
+
+def test_default_backend(monkeypatch, tmpdir):
+    monkeypatch.delenv('DOCKMAN_SUDO', raising=False)
+    path = tmpdir.join('docker.sock')
+    path.write('')
+    monkeypatch.setenv('DOCKMAN_SOCKET', str(path))
+    assert agent.default_backend() == 'api'
+
+    monkeypatch.setenv('DOCKMAN_SUDO', '1')
+    assert agent.default_backend() == 'cli'
+
+    monkeypatch.delenv('DOCKMAN_SUDO')
+    monkeypatch.setenv('DOCKMAN_SOCKET', str(tmpdir.join('nothing')))
+    assert agent.default_backend() == 'cli'
+
+
+def test_forward(project, monkeypatch):
+    # no agent running
+    assert agent.forward(['ps'], cwd=project) is None
+
+    server = agent.Agent(project)
+    assert dockman.CONTEXT.project == 'proj'
+    th = threading.Thread(target=server.serve)
+    th.start()
+    while not os.path.exists(os.environ['DOCKMAN_AGENT_SOCKET']):
+        time.sleep(0.01)
+    mode = os.stat(os.environ['DOCKMAN_AGENT_SOCKET']).st_mode
+    assert mode & 0o777 == 0o600
+
+    try:
+        dockman.DOCKER = SafeDocker(_output=['', ''])
+        out = StringIO.StringIO()
+        assert agent.forward(['run', 'a'], cwd=project, stdout=out) == 0
+        assert out.getvalue() == 'proj.a starting ... \xe2\x9c\x94\n'
+        assert dockman.DOCKER._cmd[-1] == 'a'
+
+        out = StringIO.StringIO()
+        assert agent.forward(['run', 'nothing'], cwd=project,
+                             stdout=out) == 0
+        assert out.getvalue() == 'No container named nothing\n'
+
+        out = StringIO.StringIO()
+        assert agent.forward(['up'], cwd=project, stdout=out) == 2
+        assert 'Missing argument' in out.getvalue()
+
+        # not forwarded
+        assert agent.forward(['logs'], cwd=project) is None
+        assert agent.forward(['run', '-i', 'a'], cwd=project) is None
+        os.environ['DOCKMAN_NO_AGENT'] = '1'
+        assert agent.forward(['ps'], cwd=project) is None
+        del os.environ['DOCKMAN_NO_AGENT']
+
+        # the socket of another user
+        uid = os.getuid()
+        monkeypatch.setattr(os, 'getuid', lambda: uid + 1)
+        assert agent.forward(['ps'], cwd=project) is None
+        monkeypatch.setattr(os, 'getuid', lambda: uid)
+    finally:
+        assert agent.stop(cwd=project)
+        th.join()
+
+    assert not os.path.exists(os.environ['DOCKMAN_AGENT_SOCKET'])
+    assert not agent.stop(cwd=project)
@@ -0,0 +1,252 @@
+import BaseHTTPServer
+import SocketServer
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import urlparse
+
+import pytest
+
+from dockman import docker
+from dockman.api import APIDocker
+
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        return 'fake'
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, data=None, content_type='application/json'):
+        body = '' if data is None else data
+        if content_type == 'application/json' and data is not None:
+            body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_one_request(self):
+        self.server.requests += 1
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def route(self, method):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        parts = url.path.strip('/').split('/')
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        self.server.calls.append((method, url.path, query, body))
+        containers = self.server.containers
+
+        if parts == ['containers', 'create']:
+            if body['Image'] not in self.server.images:
+                return self.reply(404, {'message': 'No such image'})
+            name = query['name']
+            containers[name] = {'Id': 'id_' + name, 'Name': '/' + name,
+                                'State': {'Running': False},
+                                'Config': {'Tty': False,
+                                           'Labels': body.get('Labels')}}
+            return self.reply(201, {'Id': 'id_' + name})
+
+        if parts == ['images', 'json']:
+            return self.reply(200, [{'RepoTags': [i + ':latest']}
+                                    for i in self.server.images] +
+                              [{'RepoTags': ['<none>:<none>']}])
+
+        if parts == ['images', 'create']:
+            self.server.images.add(query['fromImage'])
+            return self.reply(200, '{"status": "done"}\n')
+
+        if parts == ['containers', 'json']:
+            return self.reply(200, [{'Id': c['Id'], 'Names': [c['Name']],
+                                     'Labels': c['Config'].get('Labels'),
+                                     'State': ('running'
+                                               if c['State']['Running']
+                                               else 'exited')}
+                                    for c in containers.values()])
+
+        name = parts[1]
+        for c in containers.values():
+            if c['Id'] == name:
+                name = c['Name'][1:]
+        if name not in containers:
+            return self.reply(404, {'message': 'No such container: ' + name})
+        container = containers[name]
+
+        if method == 'DELETE':
+            del containers[name]
+            return self.reply(204)
+        if parts[2] == 'json':
+            return self.reply(200, container)
+        if parts[2] == 'start':
+            container['State']['Running'] = True
+            return self.reply(204)
+        if parts[2] == 'stop':
+            container['State']['Running'] = False
+            return self.reply(204)
+        if parts[2] == 'logs':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.end_headers()
+            for stream, payload in ((1, 'line1\nli'), (2, 'ne2\n'),
+                                    (1, 'line3')):
+                self.wfile.write(struct.pack('>BxxxL', stream, len(payload)))
+                self.wfile.write(payload)
+            self.close_connection = 1
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def do_DELETE(self):
+        self.route('DELETE')
+
+
+class FakeServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        SocketServer.UnixStreamServer.__init__(self, *args, **kwargs)
+        self.containers = {}
+        self.images = set(['image'])
+        self.calls = []
+        self.connections = 0
+        self.requests = 0
+
+
+@pytest.fixture
+def server(request):
+    tmpdir = tempfile.mkdtemp()
+    server = FakeServer(os.path.join(tmpdir, 'docker.sock'), FakeHandler)
+    th = threading.Thread(target=server.serve_forever)
+    th.daemon = True
+    th.start()
+
+    def fin():
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmpdir)
+
+    request.addfinalizer(fin)
+    return server
+
+
+def test_lifecycle(server):
+    api = APIDocker(socket_path=server.server_address)
+
+    assert api.getstate('p.a') is None
+
+    api.run('image', name='p.a', ports={5432: 5432}, env={'x': 'y'},
+            links={'p.b': 'db'}, volumes_from=['p.b'], cmd=['start'],
+            labels={'dockman.hash': 'abc'})
+    assert api.getstate('p.a') is True
+
+    create = [c for c in server.calls if c[1] == '/containers/create'][0]
+    config = create[3]
+    assert config['Cmd'] == ['start']
+    assert config['Env'] == ['x=y']
+    assert config['HostConfig']['PortBindings'] == {
+        '5432/tcp': [{'HostPort': '5432'}]}
+    assert config['HostConfig']['Links'] == ['p.b:db']
+    assert config['HostConfig']['VolumesFrom'] == ['p.b']
+    assert config['Labels'] == {'dockman.hash': 'abc'}
+
+    api.stop('p.a', timeout=3)
+    assert server.calls[-1][2] == {'t': '3'}
+    assert api.getstate('p.a') is False
+
+    api.start('p.a')
+    assert api.getstate('p.a') is True
+
+    assert [c['Name'] for c in api.container_info] == ['/p.a']
+
+    api.stop('p.a')
+    api.remove('p.a')
+    assert api.getstate('p.a') is None
+
+    # everything went through one kept-alive connection
+    assert server.connections == 1
+    assert server.requests > 10
+
+
+def test_state_cache(server):
+    api = APIDocker(socket_path=server.server_address)
+    api.run('image', name='p.a')
+    api.run('image', name='p.b')
+    api.stop('p.b')
+    api.run('image', name='q.a')
+
+    api.load_states('p')
+    assert api.states == {'p.a': True, 'p.b': False}
+    labels = api.project_labels('p', 'dockman.hash')
+    assert labels == {'p.a': None, 'p.b': None}
+    calls = len(server.calls)
+    assert api.getstate('p.a') is True
+    assert api.getstate('p.c') is None
+    assert len(server.calls) == calls
+
+
+def test_pulls_missing_image(server):
+    api = APIDocker(socket_path=server.server_address)
+    assert api.local_images() == set(['image:latest'])
+    api.run('other', name='p.a')
+    assert 'other' in server.images
+    assert 'other:latest' in api.local_images()
+    assert api.getstate('p.a') is True
+
+
+def test_errors(server):
+    api = APIDocker(socket_path=server.server_address)
+    with pytest.raises(docker.DockerError) as e:
+        api.start('nothing')
+    assert str(e.value) == 'No such container: nothing'
+
+
+def test_logs_process(server):
+    api = APIDocker(socket_path=server.server_address)
+    api.run('image', name='p.a')
+    sp = api.logs_process('p.a')
+    assert sp.poll() is None
+    lines = list(iter(sp.stdout.readline, ''))
+    assert lines == ['line1\n', 'line2\n', 'line3']
+    sp.terminate()
+    assert sp.poll() == 0
+    assert server.calls[-1][2]['tail'] == '0'
+
+    sp = api.logs_process('p.a', follow=False, timestamps=True,
+                          since='1422284582', tail=5)
+    sp.terminate()
+    query = server.calls[-1][2]
+    assert query['follow'] == '0'
+    assert query['timestamps'] == '1'
+    assert query['since'] == '1422284582.000000000'
+    assert query['tail'] == '5'
+
+
+def test_from_env(monkeypatch):
+    monkeypatch.setenv('DOCKMAN_BACKEND', 'api')
+    monkeypatch.setenv('DOCKMAN_SOCKET', '/tmp/foo.sock')
+    backend = docker.from_env()
+    assert isinstance(backend, APIDocker)
+    assert backend.socket_path == '/tmp/foo.sock'
+
+    monkeypatch.delenv('DOCKMAN_BACKEND')
+    assert not isinstance(docker.from_env(), APIDocker)
+    assert isinstance(docker.from_env('api'), APIDocker)
+
+    monkeypatch.setenv('DOCKMAN_SUDO', '1')
+    assert docker.from_env().command == ['sudo', 'docker']
@@ -0,0 +1,139 @@
+import os
+import signal
+import threading
+
+import pytest
+
+from dockman import archive
+from dockman.docker import SafeDocker
+from dockman.logs import LogFilter, Pipeline
+from test.fake import FakeEngine
+
+
+def path(relpath):
+    return os.path.join(os.path.dirname(__file__), relpath)
+
+
+def ts(second):
+    return '2015-01-26T15:%02d:%02d.000000000Z' % (second // 60, second % 60)
+
+
+def test_write_and_read(tmpdir, monkeypatch):
+    monkeypatch.setattr(archive, 'BLOCK_LINES', 10)
+    directory = str(tmpdir.join('archive'))
+
+    arch = archive.Archive(directory, max_bytes=100)
+    for second in range(0, 100, 2):
+        arch.write([('p.a', ['%s a%s' % (ts(second), second)]),
+                    ('p.b', ['%s b%s' % (ts(second + 1), second + 1)])])
+    arch.close()
+
+    container = arch.container('p.a')
+    segments = container.segments()
+    assert len(segments) == 5
+    assert [len(s.entries()) for s in segments] == [1] * 5
+    assert segments[1].entries() == [(ts(20), 0)]
+
+    history = list(archive.Archive(directory).history())
+    assert len(history) == 100
+    assert [h[2] for h in history[:3]] == ['a0', 'b1', 'a2']
+
+    history = list(archive.Archive(directory).history(
+        since=ts(45), until=ts(50)))
+    assert [h[2] for h in history] == ['b45', 'a46', 'b47', 'a48',
+                                       'b49', 'a50']
+
+    history = list(archive.Archive(directory).history(patterns=['b']))
+    assert set(h[1] for h in history) == set(['p.b'])
+
+
+def test_seek_into_segment(tmpdir, monkeypatch):
+    monkeypatch.setattr(archive, 'BLOCK_LINES', 10)
+    directory = str(tmpdir)
+    arch = archive.ContainerArchive(directory)
+    arch.write(['%s l%s' % (ts(i), i) for i in range(100)])
+    arch.close()
+
+    segment = arch.segments()[0]
+    entries = segment.entries()
+    assert len(entries) == 10
+    # reading from since starts at the member of the block holding it
+    lines = segment.lines(ts(55))
+    assert next(lines) == '%s l50' % ts(50)
+    assert len(list(lines)) == 49
+
+
+def test_logs_archive(tmpdir, capsys):
+    directory = str(tmpdir)
+    docker = SafeDocker(_popenout_filename=path('logs_03_'),
+                        _log_max_iter=10)
+    docker.logs(['src.postgres', 'src.shared'],
+                archive=archive.Archive(directory),
+                line_filter=LogFilter(exclude=['_2']))
+    out, _ = capsys.readouterr()
+    assert sorted(out.splitlines()) == ['src.postgres: a_1',
+                                        'src.postgres: a_3',
+                                        'src.shared: b_1']
+    assert docker._cmd == ['docker', 'logs', '-f', '-t', '--tail=0',
+                           'src.shared']
+
+    archive.print_history(directory, since='2015-01-26T15:03:02Z',
+                          color=False)
+    out, _ = capsys.readouterr()
+    assert out == ('src.shared: b_1\n'
+                   'src.postgres: a_2\n'
+                   'src.shared: b_2\n'
+                   'src.postgres: a_3\n')
+
+
+def test_logs_archive_dropped(tmpdir, monkeypatch):
+    # whatever the policy drops is archived anyway
+    monkeypatch.setattr(Pipeline, 'put', lambda self, batch: None)
+    directory = str(tmpdir)
+    docker = SafeDocker(_popenout_filename=path('logs_03_'),
+                        _log_max_iter=10)
+    docker.logs(['src.postgres', 'src.shared'], policy='drop-oldest',
+                archive=archive.Archive(directory))
+
+    history = archive.Archive(directory).history()
+    assert sorted((name, line) for _, name, line in history) == [
+        ('src.postgres', 'a_1'), ('src.postgres', 'a_2'),
+        ('src.postgres', 'a_3'), ('src.shared', 'b_1'),
+        ('src.shared', 'b_2')]
+
+
+def test_logs_archive_idle(tmpdir, monkeypatch):
+    monkeypatch.setattr(archive, 'FLUSH_INTERVAL', 0.2)
+    directory = str(tmpdir)
+    arch = archive.Archive(directory)
+    # only the flush of the quiet stream may write the lines
+    monkeypatch.setattr(arch, 'close', lambda: None)
+
+    engine = FakeEngine()
+    docker = SafeDocker(_engine=engine, _log_max_iter=8)
+    docker.run('img', name='src.a')
+    timer = threading.Timer(0.05, engine.output, ('src.a', 'one', 'two'))
+    timer.start()
+    # about 0.8 s of read ticks, the stream is quiet after the first
+    docker.logs(['src.a'], archive=arch)
+    timer.join()
+
+    history = archive.Archive(directory).history()
+    assert [line for _, _, line in history] == ['one', 'two']
+
+
+def test_close_on_sigterm(tmpdir, monkeypatch):
+    handlers = {}
+    monkeypatch.setattr(signal, 'signal',
+                        lambda signum, handler: handlers.update({
+                            signum: handler}))
+    directory = str(tmpdir)
+    arch = archive.Archive(directory)
+    arch.write([('src.a', ['%s one' % ts(1)])])
+    archive.close_on_sigterm(arch)
+
+    with pytest.raises(SystemExit) as e:
+        handlers[signal.SIGTERM](signal.SIGTERM, None)
+    assert e.value.code == 128 + signal.SIGTERM
+    history = archive.Archive(directory).history()
+    assert [line for _, _, line in history] == ['one']
@@ -1,4 +1,6 @@
 import os
+import subprocess
+import sys
 
 from click.testing import CliRunner
 
@@ -51,3 +53,51 @@ def test_logs():
     assert 'src.shared: 02_src.shared_1' in out
     assert 'src.shared: 02_src.shared_2' in out
     assert 'src.shared: 02_src.shared_3' in out
+
+
+def test_lazy_import():
+    """
+    Importing the commands must not load the config or docker modules.
+    """
+    code = ('import sys; import dockman.dockman; '
+            'print(sorted(m for m in ("yaml", "dockman.context", '
+            '"dockman.docker") if sys.modules.get(m)))')
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    assert output.strip() == '[]'
+
+
+def test_logs_filter():
+    container_ids = '944afe740314\n2fb996a8e981\n2ba796be766d\nfc05dd6c5e9c\n'
+    container_info = open(path('inspect1.json'), 'r')
+
+    docker_output = [container_ids, container_info]
+    dockman.DOCKER = SafeDocker(_output=docker_output,
+                                _popenout_filename=path('logs_02_'),
+                                _log_max_iter=10)
+    dockman.CONTEXT = Context(path='src', config={})
+
+    runner = CliRunner()
+    result = runner.invoke(commands.logs, ['-c', 'post*',
+                                           '--exclude', '_2$'])
+    out = result.output.split('\n')
+    assert out == ['src.postgres: 02_src.postgres_1',
+                   'src.postgres: 02_src.postgres_3',
+                   '', '']
+
+
+def test_up_plan():
+    dockman.DOCKER = SafeDocker(_output=[''])
+    dockman.CONTEXT = Context(path='src', config={
+        'containers': {'a': {'image': 'a'}}, 'groups': {'all': ['a']}})
+
+    runner = CliRunner()
+    result = runner.invoke(commands.up, ['--plan', 'all'])
+    assert result.exit_code == 0
+    assert 'critical path' in result.output
+    # nothing started, no ps either
+    assert 'Showing containers' not in result.output
+
+    result = runner.invoke(commands.up, ['--plan', '--reconcile', 'all'])
+    assert result.exit_code == 1
+    assert 'takes no --reconcile' in result.output
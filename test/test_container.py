@@ -1,4 +1,8 @@
+import time
+
+import dockman
 from dockman.container import Container
+from dockman.docker import SafeDocker
 
 
 def test_dependencies():
@@ -8,3 +12,43 @@ def test_dependencies():
 
     c = Container('foo', 'bar_project', '', config)
     assert c.dependencies == set(['shared', 'postgres'])
+
+
+def test_stop_options():
+    c = Container('foo', 'bar_project', '', {'image': 'foo_image'})
+    assert c.stop_timeout is None
+    assert c.stop_signal is None
+    assert 'stop_signal' not in c.run_args()
+
+    config = {'image': 'foo_image', 'stop_timeout': 2, 'stop_signal': 'INT'}
+    c = Container('foo', 'bar_project', '', config)
+    assert c.stop_timeout == 2
+    assert c.stop_signal == 'INT'
+    # the signal is given to docker run, docker stop --signal is recent
+    assert c.run_args()['stop_signal'] == 'INT'
+
+
+def test_next_postfix():
+    c = Container('foo', 'bar', '', {'image': 'foo_image'})
+    docker = dockman.DOCKER = SafeDocker()
+    docker.states_project = 'bar'
+    docker.states_loaded = time.time()
+
+    assert c.next_postfix is None
+
+    docker.states = {'bar.foo': True, 'bar.foo.1': True, 'bar.foo.3': True,
+                     'bar.foo.x': True, 'bar.foobar.2': True}
+    assert c.next_postfix == 2
+    assert docker._cmd is None
+
+    # without snapshot one is loaded, and kept for the next runs
+    docker.states_project = None
+    docker._output = ['true', 'id1 id2\n', '[{"Name": "/bar.foo", '
+                      '"State": {"Running": true}}, {"Name": "/bar.foo.1", '
+                      '"State": {"Running": true}}]']
+    assert c.next_postfix == 2
+    assert docker._cmd == ['docker', 'inspect', 'id1', 'id2']
+    assert docker.states_project == 'bar'
+    docker._cmd = None
+    assert c.next_postfix == 2
+    assert docker._cmd is None
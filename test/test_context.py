@@ -1,11 +1,15 @@
 # encoding: utf-8
+import json
 import os
+import shutil
 
 import pytest
 
 from dockman import context
 from dockman import docker
+from dockman.durations import Durations
 import dockman
+from test.fake import FakeEngine
 
 
 cwd = os.path.dirname(__file__)
@@ -13,7 +17,18 @@ cwd1 = os.path.join(cwd, 'a')
 cwd2 = os.path.join(cwd1, 'b')
 
 
-def test_read_config():
+def load(tmpdir, filename):
+    """
+    Loads a config of the test directory from a copy in tmpdir/test, so
+    that the cache and durations files stay out of the source tree.
+    """
+    path = tmpdir.join('test')
+    path.ensure(dir=True)
+    shutil.copy(os.path.join(cwd, filename), str(path))
+    return context.Context(config_filename=filename, path=str(path))
+
+
+def test_read_config(tmpdir):
     with pytest.raises(context.NoConfigException):
         context.Context(config_filename='dockman.yaml')
 
@@ -37,8 +52,7 @@ def test_read_config():
         context.Context(config_filename='test5.yaml',
                         path=cwd)
 
-    ctx = context.Context(config_filename='test6.yaml',
-                          path=cwd)
+    ctx = load(tmpdir, 'test6.yaml')
 
     assert ctx.containers.keys() == ['a', 'b']
 
@@ -51,9 +65,8 @@ def test_read_config():
                         path=cwd)
 
 
-def test_chains():
-    ctx = context.Context(config_filename='test9.yaml',
-                          path=cwd)
+def test_chains(tmpdir):
+    ctx = load(tmpdir, 'test9.yaml')
 
     a = ctx.containers['a']
     b = ctx.containers['b']
@@ -90,8 +103,7 @@ def test_chains():
 
     assert ctx.reverse_chain(f) == [f]
 
-    ctx = context.Context(config_filename='test10.yaml',
-                          path=cwd)
+    ctx = load(tmpdir, 'test10.yaml')
     with pytest.raises(context.WrongConfigException) as e:
         ctx.chain(ctx.containers['f'])
     assert e.value.message in ('Circular dependencies: f -> e -> b -> a -> f',
@@ -99,14 +111,360 @@ def test_chains():
                                'Circular dependencies: f -> d -> c -> a -> f')
 
 
-def test_run(capsys):
-    ctx = dockman.CONTEXT = context.Context(config_filename='test9.yaml',
-                                            path=cwd)
-    safedocker = dockman.DOCKER = docker.SafeDocker(_output=[Exception()])
+def test_run(tmpdir, capsys):
+    ctx = dockman.CONTEXT = load(tmpdir, 'test9.yaml')
+    safedocker = dockman.DOCKER = docker.SafeDocker(_output=[''])
 
     ctx.run(interactive=False, container_name='a', extra=[])
 
     out, _ = capsys.readouterr()
     assert out == u'test.a starting ... ✔\n'
+    label = 'dockman.hash=%s' % ctx.containers['a'].config_hash
     assert safedocker._cmd == ['docker', 'run', '-d', '--name', 'test.a',
-                               '-e', 'container_name=test.a', 'a']
+                               '-e', 'container_name=test.a',
+                               '--label', label, 'a']
+
+
+class RecordingDocker(docker.SafeDocker):
+    def __init__(self, *args, **kwargs):
+        self._state = kwargs.pop('_state', None)
+        super(RecordingDocker, self).__init__(*args, **kwargs)
+        self.started = []
+        self.stopped = []
+        self.batches = []
+
+    def load_states(self, project, max_age=None):
+        pass
+
+    def local_images(self):
+        return set(['a:latest', 'b:latest', 'c:latest', 'd:latest',
+                    'e:latest', 'f:latest'])
+
+    def getstate(self, container_name):
+        return self._state
+
+    def run(self, image, **kwargs):
+        self.started.append(kwargs['name'])
+
+    def stop(self, container_name, timeout=None):
+        self.stopped.append(container_name)
+
+    def stop_many(self, container_names, timeout=None):
+        self.batches.append(('stop', sorted(container_names)))
+        self.stopped.extend(container_names)
+        return dict.fromkeys(container_names)
+
+    def remove_many(self, container_names):
+        self.batches.append(('rm', sorted(container_names)))
+        return dict.fromkeys(container_names)
+
+
+def test_up(tmpdir, capsys):
+    ctx = dockman.CONTEXT = load(tmpdir, 'test9.yaml')
+    recorder = dockman.DOCKER = RecordingDocker()
+
+    ctx.up('dev')
+
+    started = recorder.started
+    assert sorted(started) == ['test.a', 'test.b', 'test.c',
+                               'test.d', 'test.e', 'test.f']
+    for name in ctx.containers:
+        container = ctx.containers[name]
+        for dep in ctx.dependencies(container):
+            assert (started.index(dep.full_name) <
+                    started.index(container.full_name))
+
+    out, _ = capsys.readouterr()
+    lines = out.splitlines()
+    assert len(lines) == 6
+    assert u'test.f starting ... ✔' in lines
+
+
+class ReconcileDocker(RecordingDocker):
+    def __init__(self, *args, **kwargs):
+        self._states = kwargs.pop('_states')
+        self._labels = kwargs.pop('_labels')
+        super(ReconcileDocker, self).__init__(*args, **kwargs)
+        self.removed = []
+
+    def project_labels(self, project, key):
+        assert key == 'dockman.hash'
+        return self._labels
+
+    def getstate(self, container_name):
+        return self._states.get(container_name)
+
+    def stop(self, container_name, timeout=None):
+        self._states[container_name] = False
+
+    def remove(self, container_name):
+        self.removed.append(container_name)
+        del self._states[container_name]
+
+    def run(self, image, **kwargs):
+        super(ReconcileDocker, self).run(image, **kwargs)
+        self._states[kwargs['name']] = True
+
+
+def test_up_reconcile(tmpdir, capsys):
+    ctx = dockman.CONTEXT = load(tmpdir, 'test9.yaml')
+    hashes = dict((c.full_name, c.config_hash)
+                  for c in ctx.containers.values())
+    assert len(set(hashes.values())) == 6
+
+    labels = dict(hashes, **{'test.c': 'old'})
+    states = dict((name, True) for name in hashes)
+    recorder = dockman.DOCKER = ReconcileDocker(_states=states,
+                                                _labels=labels)
+    ctx.up('dev', reconcile=True)
+
+    # c changed, d and f are linked to it
+    assert recorder.removed.index('test.f') < recorder.removed.index('test.d')
+    assert sorted(recorder.removed) == ['test.c', 'test.d', 'test.f']
+    assert sorted(recorder.started) == ['test.c', 'test.d', 'test.f']
+    assert recorder.started[0] == 'test.c'
+
+    # nothing changed
+    recorder = dockman.DOCKER = ReconcileDocker(_states=states,
+                                                _labels=hashes)
+    ctx.up('dev', reconcile=True)
+    assert recorder.removed == recorder.started == []
+
+    # c was created without the label: unknown, not drifted
+    labels = dict(hashes, **{'test.c': None})
+    recorder = dockman.DOCKER = ReconcileDocker(_states=states,
+                                                _labels=labels)
+    capsys.readouterr()
+    ctx.up('dev', reconcile=True)
+    assert recorder.removed == recorder.started == []
+    out, _ = capsys.readouterr()
+    assert 'test.c has no dockman.hash label, left alone' in out
+
+
+class PullDocker(docker.SafeDocker):
+    def __init__(self, *args, **kwargs):
+        super(PullDocker, self).__init__(*args, **kwargs)
+        self.pulled = []
+
+    def pull(self, image):
+        if image == 'broken':
+            raise docker.DockerError('not found')
+        self.pulled.append(image)
+
+
+def test_pull(tmpdir, capsys):
+    ctx = dockman.CONTEXT = load(tmpdir, 'test9.yaml')
+    for name in ('a', 'b', 'c'):
+        ctx.containers[name].image = 'shared'
+    images = ('REPOSITORY    TAG     IMAGE ID      CREATED      SIZE\n'
+              'd             latest  1111          2 days ago   1 MB\n'
+              'e             v1      2222          2 days ago   1 MB\n'
+              '<none>        <none>  3333          2 days ago   1 MB\n')
+    recorder = dockman.DOCKER = PullDocker(_output=[images])
+
+    ctx.pull('dev')
+    assert recorder._cmd == ['docker', 'images']
+    assert sorted(recorder.pulled) == ['e', 'f', 'shared']
+    out, _ = capsys.readouterr()
+    assert u'd present ... ✔' in out.splitlines()
+    assert u'shared pulling ... ✔' in out.splitlines()
+
+    ctx.containers['f'].image = 'broken'
+    recorder = dockman.DOCKER = PullDocker(_output=[images])
+    with pytest.raises(docker.DockerError):
+        ctx.up('dev')
+    out, _ = capsys.readouterr()
+    assert u'broken pulling ... ✘\nnot found' in out
+    assert 'starting' not in out
+
+
+def test_down(tmpdir, capsys):
+    ctx = dockman.CONTEXT = load(tmpdir, 'test9.yaml')
+    recorder = dockman.DOCKER = RecordingDocker(_state=True)
+
+    ctx.down('dev')
+
+    stopped = recorder.stopped
+    assert sorted(stopped) == ['test.e', 'test.f']
+    assert stopped.index('test.f') < stopped.index('test.e')
+
+    recorder = dockman.DOCKER = RecordingDocker(_state=True)
+    ctx.remove('a')
+    assert sorted(recorder.stopped) == ['test.a', 'test.b', 'test.c',
+                                        'test.d', 'test.e', 'test.f']
+    stopped = recorder.stopped
+    for name in ctx.containers:
+        container = ctx.containers[name]
+        for dep in ctx.dependencies(container):
+            assert (stopped.index(container.full_name) <
+                    stopped.index(dep.full_name))
+
+    # the containers ready together are handled by one docker call
+    assert recorder.batches == [('stop', ['test.d', 'test.e']),
+                                ('rm', ['test.d', 'test.e']),
+                                ('stop', ['test.b', 'test.c']),
+                                ('rm', ['test.b', 'test.c'])]
+
+
+class FailingDocker(RecordingDocker):
+    def stop_many(self, container_names, timeout=None):
+        return docker.Docker.stop_many(self, container_names, timeout)
+
+
+def test_down_batch_failure(tmpdir, capsys):
+    ctx = dockman.CONTEXT = load(tmpdir, 'test9.yaml')
+    error = docker.DockerError('test.d\nError response from daemon: '
+                               'Cannot stop container test.e\n')
+    recorder = dockman.DOCKER = FailingDocker(_state=True, _output=['', error])
+
+    with pytest.raises(docker.DockerError):
+        ctx.remove('b')
+    assert recorder._cmd[:2] == ['docker', 'stop']
+    assert sorted(recorder._cmd[2:]) == ['test.d', 'test.e']
+
+    out, _ = capsys.readouterr()
+    lines = out.splitlines()
+    assert lines[0] == u'test.f stopping ... ✔'
+    assert u'test.d stopping ... ✔' in lines
+    assert u'test.e stopping ... ✘' in lines
+    assert 'Error response from daemon: Cannot stop container test.e' in lines
+    assert 'test.b' not in out
+
+
+def test_large_plan():
+    size = 500
+    containers = {'c0': {'image': 'i'}}
+    for i in range(1, size):
+        # every container depends on the previous one and on c0
+        containers['c%s' % i] = {'image': 'i',
+                                 'volumes_from': ['c%s' % (i - 1)],
+                                 'links': {'c0': 'c0'}}
+    config = {'containers': containers,
+              'groups': {'all': ['c%s' % (size - 1)]}}
+    ctx = context.Context(path=cwd, config=config)
+
+    plan = ctx.plan(ctx.groups['all'])
+    assert [c.name for c in plan] == ['c%s' % i for i in range(size)]
+    assert ctx.plan(ctx.groups['all']) == plan
+    assert ctx.reverse_chain(ctx.containers['c0']) == plan[::-1]
+
+    containers['c0']['links'] = {'c2': 'c2'}
+    ctx = context.Context(path=cwd, config=config)
+    with pytest.raises(context.WrongConfigException) as e:
+        ctx.plan(ctx.groups['all'])
+    assert str(e.value) == 'Circular dependencies: c0 -> c2 -> c0'
+
+
+def test_config_cache(tmpdir, monkeypatch):
+    config = tmpdir.join('dockman.yaml')
+    config.write(open(os.path.join(cwd, 'test6.yaml')).read())
+
+    ctx = context.Context(path=str(tmpdir))
+    assert not ctx.cache_hit
+    assert tmpdir.join('.dockman.cache').check()
+
+    ctx = context.Context(path=str(tmpdir))
+    assert ctx.cache_hit
+    assert sorted(ctx.containers.keys()) == ['a', 'b']
+    assert isinstance(ctx.containers['a'].image, unicode)
+
+    # same size and mtime, different content
+    stat = os.stat(str(config))
+    config.write(config.read().replace('a_image', 'x_image'))
+    os.utime(str(config), (stat.st_atime, stat.st_mtime))
+    ctx = context.Context(path=str(tmpdir))
+    assert not ctx.cache_hit
+    assert ctx.containers['a'].image == 'x_image'
+
+    # the cache is json, with the keys as strings
+    config.write('containers: {a: {image: a, ports: {8000: 80}}}')
+    ctx = context.Context(path=str(tmpdir))
+    assert ctx.containers['a'].ports == {'8000': 80}
+    assert json.loads(tmpdir.join('.dockman.cache').read())['config'] == \
+        ctx.config
+    assert context.Context(path=str(tmpdir)).cache_hit
+
+    # a cache of another user is ignored
+    uid = os.getuid()
+    monkeypatch.setattr(os, 'getuid', lambda: uid + 1)
+    assert not context.Context(path=str(tmpdir)).cache_hit
+    monkeypatch.undo()
+
+    # an invalid config is not cached
+    config.write('containers: []')
+    with pytest.raises(context.WrongConfigException):
+        context.Context(path=str(tmpdir))
+    with pytest.raises(context.WrongConfigException):
+        context.Context(path=str(tmpdir))
+
+
+CRITICAL = """
+containers:
+    shared:
+        image: s
+    postgres:
+        image: p
+        volumes_from: [shared]
+    migrate:
+        image: m
+        links: {postgres: db}
+    app:
+        image: a
+        links: {migrate: m}
+    redis:
+        image: r
+    web:
+        image: w
+        volumes_from: [redis]
+groups:
+    all: [app, web]
+"""
+
+
+def test_durations_load(tmpdir):
+    path = tmpdir.join('.dockman.durations')
+    path.write(json.dumps({'a': {'i': 2, 'j': 'slow', 'k': True, 'l': -1},
+                           'b': 3, 'c': ['i', 1], 'd': {'i': None}}))
+    durations = Durations(str(path))
+    assert durations.durations == {'a': {'i': 2.0}}
+    assert durations.get('a', 'i') == 2.0
+    assert durations.get('b', 'i') is None
+
+    path.write(json.dumps([1, 2]))
+    assert Durations(str(path)).durations == {}
+
+
+def test_critical_path(tmpdir, capsys):
+    tmpdir.join('dockman.yaml').write(CRITICAL)
+    durations = tmpdir.join('.dockman.durations')
+    durations.write(json.dumps({'shared': {'s': 1}, 'postgres': {'p': 5},
+                                'migrate': {'m': 3}, 'app': {'a': 2},
+                                'redis': {'r': 0.5}}))
+    ctx = dockman.CONTEXT = context.Context(path=str(tmpdir))
+    dockman.DOCKER = docker.SafeDocker(_engine=FakeEngine())
+
+    containers = ctx.plan(ctx.groups['all'])
+    assert [[c.name for c in level] for level in ctx.levels(containers)] == [
+        ['redis', 'shared'], ['postgres', 'web'], ['migrate'], ['app']]
+    assert [c.name for c in ctx.critical_path(containers)] == [
+        'shared', 'postgres', 'migrate', 'app']
+    remaining = ctx.remaining(containers)
+    assert remaining[ctx.containers['shared']] == 11
+    # web was never started, the default is assumed
+    assert remaining[ctx.containers['redis']] == 1.5
+
+    ctx.show_plan('all')
+    out = capsys.readouterr()[0]
+    assert '    1  2: redis, shared' in out
+    assert 'critical path, about 11.0 s:' in out
+    assert '  postgres  5.0 s' in out
+
+    ctx.up('all')
+    recorded = json.loads(durations.read())
+    assert sorted(recorded) == ['app', 'migrate', 'postgres', 'redis',
+                                'shared', 'web']
+    # averaged with the fast start on the fake engine
+    assert recorded['postgres']['p'] < 5
+    # nothing to start, the running containers take no time
+    ctx.show_plan('all')
+    assert 'critical path, about 0.0 s:' in capsys.readouterr()[0]
@@ -1,8 +1,16 @@
+import StringIO
+import errno
+import json
 import os
+import threading
+import time
 
+import click
 import pytest
 
-from dockman.docker import SafeDocker
+from dockman.docker import SafeDocker, DockerError, image_ref
+from dockman.logs import Multiplexer, Pipeline, Renderer, LogFilter
+from dockman.logs import to_epoch, epoch_to_rfc3339
 import dockman
 
 
@@ -51,6 +59,98 @@ def test_getstate():
     assert docker.getstate('somecontainer') is True
 
 
+def test_image_ref():
+    assert image_ref('postgres') == 'postgres:latest'
+    assert image_ref('vertis/shared:1.2') == 'vertis/shared:1.2'
+    assert image_ref('localhost:5000/shared') == 'localhost:5000/shared:latest'
+    assert image_ref('shared@sha256:abc') == 'shared@sha256:abc'
+
+
+def test_batch():
+    docker = SafeDocker(_output=['p.a\np.ab\n'])
+    errors = docker.stop_many(['p.a', 'p.ab'], timeout=3)
+    assert errors == {'p.a': None, 'p.ab': None}
+    assert docker._cmd == ['docker', 'stop', '-t', '3', 'p.a', 'p.ab']
+
+    output = ('p.a\nError response from daemon: No such container: p.ab\n'
+              'Error: failed to remove containers: [p.ab]\n')
+    docker._output = [DockerError(output)]
+    errors = docker.remove_many(['p.a', 'p.ab'])
+    assert docker._cmd == ['docker', 'rm', '-v', 'p.a', 'p.ab']
+    assert errors['p.a'] is None
+    assert str(errors['p.ab']) == (
+        'Error response from daemon: No such container: p.ab\n'
+        'Error: failed to remove containers: [p.ab]')
+
+    # nothing tells which failed
+    docker._output = [DockerError('Cannot connect to the daemon\n')]
+    errors = docker.start_many(['p.a', 'p.b'])
+    assert str(errors['p.a']) == str(errors['p.b']) == (
+        'Cannot connect to the daemon')
+
+
+def test_project_labels():
+    container_ids = '944afe740314\n2fb996a8e981\n'
+    container_info = json.load(open(path('inspect1.json'), 'r'))
+    container_info[0]['Config']['Labels'] = {'dockman.hash': 'abc'}
+    docker = SafeDocker(_output=[container_ids, json.dumps(container_info)])
+
+    labels = docker.project_labels('src', 'dockman.hash')
+    assert docker._cmd == ['docker', 'inspect', '944afe740314',
+                           '2fb996a8e981']
+    name = container_info[0]['Name'][1:]
+    assert labels[name] == 'abc'
+    assert sorted(labels.values()) == [None, 'abc']
+
+    docker._output = ['']
+    assert docker.project_labels('src', 'dockman.hash') == {}
+
+
+def test_state_cache():
+    container_ids = '944afe740314\n2fb996a8e981\n'
+    container_info = open(path('inspect1.json'), 'r')
+    docker = SafeDocker(_output=[container_ids, container_info])
+
+    docker.load_states('src')
+    assert docker._cmd == ['docker', 'inspect', '944afe740314',
+                           '2fb996a8e981']
+    assert docker.states == {'src.postgres': True, 'src.shared': True}
+
+    # answered from the snapshot, no more docker calls
+    docker._cmd = None
+    assert docker.getstate('src.postgres') is True
+    assert docker.getstate('src.nothing') is None
+    assert docker._cmd is None
+
+    # mutating calls keep it up to date
+    docker.stop('src.postgres')
+    assert docker.getstate('src.postgres') is False
+    docker.remove('src.postgres')
+    assert docker.getstate('src.postgres') is None
+    docker.run('image', name='src.new')
+    assert docker.getstate('src.new') is True
+    docker.run('image', daemon=False, interactive=True, remove=True,
+               name='src.new.1')
+    assert docker.getstate('src.new.1') is None
+
+    # other containers are inspected one by one
+    docker._output = ['false']
+    assert docker.getstate('other.postgres') is False
+
+    # an expired snapshot is reloaded
+    docker.states_loaded = time.time() - docker.state_ttl - 1
+    docker._output = ['']
+    assert docker.getstate('src.new') is None
+    assert docker._cmd == ['docker', 'ps', '-a', '-q',
+                           '--filter', 'name=src.']
+
+    # a failed load leaves getstate inspecting
+    docker._output = [DockerError('no docker')]
+    docker.load_states('src')
+    docker._output = ['true']
+    assert docker.getstate('src.new') is True
+
+
 def test_run():
     docker = SafeDocker()
     docker.run('image', daemon=True, interactive=False,
@@ -69,6 +169,10 @@ def test_run():
                            '--link', 'l:l', '-e', 'ev=ev', 'image',
                            'do', 'it']
 
+    docker.run('image', name='name', stop_signal='SIGINT')
+    assert docker._cmd == ['docker', 'run', '-d', '--name', 'name',
+                           '--stop-signal', 'SIGINT', 'image']
+
 
 def test_start_stop_remove():
     docker = SafeDocker()
@@ -76,6 +180,8 @@ def test_start_stop_remove():
     assert docker._cmd == ['docker', 'start', 'x']
     docker.stop('x')
     assert docker._cmd == ['docker', 'stop', 'x']
+    docker.stop('x', timeout=3)
+    assert docker._cmd == ['docker', 'stop', '-t', '3', 'x']
     docker.remove('x')
     assert docker._cmd == ['docker', 'rm', '-v', 'x']
 
@@ -148,3 +254,167 @@ def test_logs(capsys):
     assert '2: 01_2_2' in out
     assert '3: 01_3_1' in out
     assert '' in out
+
+
+def test_multiplexer():
+    docker = SafeDocker(_popenout_filename=path('popenout01_'))
+    mux = Multiplexer()
+    mux.add('c', docker.Popen(['c']))
+    assert len(mux) == 1
+
+    batches = mux.read(0.1)
+    assert batches == [('c', ['this', 'is', 'a'])]
+    # the last, unterminated line comes with the end of the stream
+    assert mux.read(0.1) == [('c', ['test'])]
+    assert len(mux) == 0
+
+
+def test_pipeline(capsys):
+    written = []
+    gate = threading.Event()
+
+    def write(batch):
+        gate.wait()
+        written.extend(batch)
+
+    def wait_taken(pipeline):
+        while not pipeline.queue.empty():
+            time.sleep(0.01)
+
+    pipeline = Pipeline(write, maxsize=1, policy='drop-oldest')
+    pipeline.put([('a', ['a0'])])
+    wait_taken(pipeline)
+    for i in range(1, 5):
+        pipeline.put([('a', ['a%s' % i]), ('b', ['b%s' % i, 'b'])])
+    gate.set()
+    pipeline.close()
+    # the writer held the first batch, only the last one was kept
+    assert written == [('a', ['a0']), ('a', ['a4']), ('b', ['b4', 'b'])]
+    assert pipeline.dropped == {'a': 3, 'b': 6}
+    out, _ = capsys.readouterr()
+    assert out == 'a: 3 lines dropped\nb: 6 lines dropped\n'
+
+    written = []
+    gate.clear()
+    pipeline = Pipeline(write, maxsize=1, policy='sample', sample=10)
+    pipeline.put([('a', ['x'])])
+    wait_taken(pipeline)
+    pipeline.put([('a', ['x'])])
+    # still blocks after sampling, until the writer goes on
+    threading.Timer(0.1, gate.set).start()
+    pipeline.put([('a', [str(i) for i in range(25)])])
+    pipeline.close()
+    assert written[-1] == ('a', ['0', '10', '20'])
+    assert pipeline.dropped == {'a': 22}
+
+    with pytest.raises(ValueError):
+        Pipeline(write, policy='nothing')
+
+
+def test_pipeline_write_error():
+    def write(batch):
+        raise IOError(errno.EPIPE, 'Broken pipe')
+
+    pipeline = Pipeline(write, maxsize=2)
+    result = []
+
+    def feed():
+        try:
+            for i in range(10):
+                pipeline.put([('a', [str(i)])])
+        except IOError as e:
+            result.append(e)
+
+    # put raises instead of blocking on the full queue
+    thread = threading.Thread(target=feed)
+    thread.daemon = True
+    thread.start()
+    thread.join(5)
+    assert not thread.is_alive()
+    assert result[0].errno == errno.EPIPE
+    with pytest.raises(IOError):
+        pipeline.close()
+
+
+class TTY(StringIO.StringIO):
+    def isatty(self):
+        return True
+
+
+def test_renderer():
+    batch = [(u'a', ['1', '2']), (u'b', ['3']), (u'a', ['\xc3\xa1'])]
+
+    stream = StringIO.StringIO()
+    Renderer(stream).write(batch)
+    assert stream.getvalue() == 'a: 1\na: 2\nb: 3\na: \xc3\xa1\n'
+
+    stream = TTY()
+    renderer = Renderer(stream)
+    renderer.write(batch)
+    a = click.style('a: ', fg='yellow')
+    b = click.style('b: ', fg='cyan')
+    assert stream.getvalue() == (a + '1\n' + a + '2\n' +
+                                 b + '3\n' + a + '\xc3\xa1\n')
+
+    stream = TTY()
+    Renderer(stream, color=False).write(batch)
+    assert stream.getvalue().startswith('a: 1\n')
+
+
+def test_logs_history(capsys):
+    docker = SafeDocker(_popenout_filename=path('logs_03_'))
+    docker.logs(['src.postgres', 'src.shared'], tail=10, until='1h')
+    out, _ = capsys.readouterr()
+    assert out == ('src.postgres: a_1\n'
+                   'src.shared: b_1\n'
+                   'src.postgres: a_2\n'
+                   'src.shared: b_2\n'
+                   'src.postgres: a_3\n')
+    assert docker._cmd == ['docker', 'logs', '-t', '--until', '1h',
+                           '--tail=10', 'src.shared']
+
+
+def test_logs_process():
+    docker = SafeDocker(_popenout_filename=path('logs_03_'))
+    docker.logs_process('src.shared')
+    assert docker._cmd == ['docker', 'logs', '-f', '--tail="0"',
+                           'src.shared']
+    docker.logs_process('src.shared', since='123.5')
+    assert docker._cmd == ['docker', 'logs', '-f', '--since', '123.5',
+                           'src.shared']
+
+
+def test_times():
+    assert to_epoch('1422284582.5') == 1422284582.5
+    assert to_epoch('10m', now=1000) == 400
+    assert to_epoch('2015-01-26T15:03:02Z') == 1422284582
+    assert to_epoch('2015-01-26') == 1422230400
+    assert to_epoch('2015-01-26T15:03:02.25Z') == 1422284582.25
+    assert to_epoch('2015-01-26T16:03:02+01:00') == 1422284582
+    assert to_epoch('2015-01-26T10:33:02-0430') == 1422284582
+    for value in ('2015-01-26T15:03:02+25:00', '2015-01-26T15:03:02 CET'):
+        with pytest.raises(ValueError):
+            to_epoch(value)
+    with pytest.raises(ValueError):
+        to_epoch('yesterday')
+    assert epoch_to_rfc3339(1422284582.5) == '2015-01-26T15:03:02.500000000Z'
+
+
+def test_log_filter():
+    assert not LogFilter()
+
+    f = LogFilter(include=['err', 'warn'], exclude=['ignore'])
+    assert f
+    assert f.match('an error')
+    assert f.match('a warning')
+    assert not f.match('an error to ignore')
+    assert not f.match('info')
+    assert f.filter([('a', ['error', 'info']), ('b', ['info'])]) == [
+        ('a', ['error'])]
+
+    f = LogFilter(fields={'level': 'ERROR', 'ctx.user': 'joe'})
+    assert f.match('{"level": "error", "ctx": {"user": "joe"}}')
+    assert not f.match('{"level": "error", "ctx": {"user": "bob"}}')
+    assert not f.match('{"level": "error"}')
+    assert not f.match('{"level": "error"')
+    assert not f.match('level error')
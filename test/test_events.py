@@ -0,0 +1,66 @@
+import os
+
+from dockman import events
+from dockman.docker import SafeDocker
+
+
+def path(relpath):
+    return os.path.join(os.path.dirname(__file__), relpath)
+
+
+def test_parse_event():
+    assert events.parse_event('1422284582123456789 start src.a\n') == (
+        '1422284582.123456789', 'start', 'src.a')
+    line = ('{"status": "die", "Action": "die", "time": 1422284582, '
+            '"timeNano": 1422284582000000500, '
+            '"Actor": {"Attributes": {"name": "src.a", "image": "i"}}}')
+    assert events.parse_event(line) == ('1422284582.000000500', 'die',
+                                        'src.a')
+    # older daemons only give seconds
+    line = ('{"status": "die", "time": 1422284582, '
+            '"Actor": {"Attributes": {"name": "src.a"}}}')
+    assert events.parse_event(line)[0] == '1422284582.000000000'
+    assert events.parse_event('{"status": "die"}') is None
+    assert events.parse_event('garbage') is None
+    assert events.parse_event('{garbage') is None
+
+
+def test_state_table():
+    table = events.StateTable('src', {'src.a': True},
+                              selected=lambda name: name != 'src.c')
+    assert table.apply('1 start src.a') is None
+    assert table.apply('2 start src.b') == ('0.000000002', 'start', 'src.b')
+    assert table.apply('3 start src.c') is None
+    assert table.apply('4 start other.a') is None
+    assert table.running() == ['src.a', 'src.b']
+
+    assert table.apply('5 die src.a') == ('0.000000005', 'die', 'src.a')
+    assert table.states['src.a'] is False
+    assert table.apply('6 destroy src.a') == ('0.000000006', 'destroy',
+                                              'src.a')
+    assert 'src.a' not in table.states
+    assert table.apply('7 pause src.b') is None
+
+
+def test_logs_follow_started(capsys):
+    docker = SafeDocker(_popenout_filename=path('logs_02_'),
+                        _events_filename=path('events_01'),
+                        _log_max_iter=10)
+    watch = events.StateTable('src', {'src.postgres': True}, since=100)
+    docker.logs(['src.postgres'], watch=watch)
+
+    out, _ = capsys.readouterr()
+    lines = out.splitlines()
+    # src.postgres is followed once, src.shared since it started
+    assert len(lines) == 6
+    assert lines.count('src.postgres: 02_src.postgres_1') == 1
+    assert 'src.shared: 02_src.shared_3' in lines
+    assert watch.states == {'src.postgres': True, 'src.shared': False}
+    # from the start event on, to the nanosecond
+    assert docker._cmd == ['docker', 'logs', '-f', '--since',
+                           '1422284582.000000000', 'src.shared']
+
+
+def test_no_events():
+    # without a file the fake docker has no events, but still a stream
+    assert SafeDocker().events_process(100).stdout.read() == ''
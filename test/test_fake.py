@@ -0,0 +1,153 @@
+# encoding: utf-8
+import pytest
+
+import dockman
+from dockman import context
+from dockman.docker import DockerError, SafeDocker
+from test.fake import FakeEngine, LatencyDocker
+
+
+CONFIG = {'containers': {'a': {'image': 'a'},
+                         'b': {'image': 'b', 'volumes_from': ['a']},
+                         'c': {'image': 'b', 'volumes_from': ['a']}},
+          'groups': {'all': ['b', 'c']}}
+
+
+def test_latency_seeded():
+    delays = []
+    for _ in range(2):
+        docker = LatencyDocker(jitter=1)
+        delays.append([docker.random.uniform(0, 1) for _ in range(3)])
+    assert delays[0] == delays[1]
+
+
+def test_engine():
+    engine = FakeEngine()
+    engine.execute(['run', '-d', '--name', 'p.a', '--label', 'k=v', 'img'])
+    with pytest.raises(DockerError) as e:
+        engine.execute(['run', '-d', '--name', 'p.a', 'img'])
+    assert 'already in use' in str(e.value)
+    assert engine.execute(['inspect', '--format="{{.State.Running}}"',
+                           'p.a']) == 'true\n'
+
+    with pytest.raises(DockerError) as e:
+        engine.execute(['rm', '-v', 'p.a', 'p.b'])
+    assert str(e.value).splitlines() == [
+        'Error response from daemon: You cannot remove a running container '
+        'p.a. Stop the container before attempting removal or force remove',
+        'Error response from daemon: No such container: p.b',
+        'Error: failed to remove containers: [p.a p.b]']
+
+    assert engine.execute(['stop', '-t', '1', 'p.a']) == 'p.a\n'
+    assert engine.execute(['rm', '-v', 'p.a']) == 'p.a\n'
+    assert engine.execute(['ps', '-a', '-q']) == ''
+    assert 'img ' in engine.execute(['images'])
+
+
+def test_latency_docker(capsys):
+    ctx = dockman.CONTEXT = context.Context(path='p', config=CONFIG)
+    docker = dockman.DOCKER = LatencyDocker(latency=0.001)
+
+    ctx.up('all')
+    assert sorted(docker.engine.containers) == ['p.a', 'p.b', 'p.c']
+    assert docker.calls['run'] == 3
+    assert docker.calls['pull'] == 2
+
+    ctx.down('all')
+    # b and c are stopped together, a is not in the group
+    assert docker.calls['stop'] == 1
+    assert docker.getstate('p.b') is False
+    assert docker.getstate('p.a') is True
+
+
+def test_engine_ports_links():
+    engine = FakeEngine()
+    engine.execute(['run', '-d', '--name', 'p.a', '-p', '5432:5432', 'img'])
+    with pytest.raises(DockerError) as e:
+        engine.execute(['run', '-d', '--name', 'p.b', '-p', '5432:5432',
+                        'img'])
+    assert 'Bind for 0.0.0.0:5432 failed: port is already allocated' in \
+        str(e.value)
+    # created but not started, as docker leaves it
+    assert engine.execute(['ps', '-q']).count('\n') == 1
+    assert engine.execute(['ps', '-a', '-q']).count('\n') == 2
+
+    with pytest.raises(DockerError) as e:
+        engine.execute(['run', '-d', '--name', 'p.c', '--link', 'p.x:x',
+                        'img'])
+    assert 'Could not get container for p.x' in str(e.value)
+
+    engine.execute(['run', '-d', '--name', 'p.c', '--link', 'p.a:db', 'img'])
+    engine.execute(['stop', 'p.a', 'p.c'])
+    with pytest.raises(DockerError) as e:
+        engine.execute(['start', 'p.c'])
+    assert str(e.value).splitlines() == [
+        'Error response from daemon: Cannot link to a non running '
+        'container: /p.a AS /p.c/db',
+        'Error: failed to start containers: [p.c]']
+
+    engine.execute(['start', 'p.b'])
+    docker = SafeDocker(_engine=engine)
+    assert docker.basic_info == [('p.a', 'exited', ['']),
+                                 ('p.b', 'running',
+                                  ['5432 -> 0.0.0.0:5432']),
+                                 ('p.c', 'exited', [''])]
+    assert docker.ip_address('p.b').startswith('172.17.0.')
+    assert docker.ip_address('p.a') is None
+    with pytest.raises(DockerError) as e:
+        engine.execute(['start', 'p.a'])
+    assert 'port is already allocated' in str(e.value)
+
+
+def test_engine_logs():
+    engine = FakeEngine()
+    docker = SafeDocker(_engine=engine)
+    docker.run('img', name='p.a')
+    engine.output('p.a', 'one', 'two')
+
+    process = docker.logs_process('p.a', follow=False, tail=1)
+    assert process.stdout.read() == 'two\n'
+    assert process.wait() == 0
+
+    process = docker.logs_process('p.a', tail='all')
+    engine.output('p.a', 'three')
+    assert process.stdout.readline() == 'one\n'
+    assert process.stdout.readline() == 'two\n'
+    assert process.stdout.readline() == 'three\n'
+    docker.stop('p.a')
+    # the logs of a stopped container end
+    assert process.stdout.read() == ''
+    assert process.wait() == 0
+
+    process = docker.exec_process('p.a', ['true'])
+    assert process.wait() == 1
+
+    events = docker.events_process(since=0)
+    docker.remove('p.a')
+    assert [events.stdout.readline().split()[1:] for _ in range(3)] == [
+        ['start', 'p.a'], ['die', 'p.a'], ['destroy', 'p.a']]
+    events.terminate()
+    assert events.wait() == -15
+    assert engine.followers == []
+
+
+def test_engine_concurrent(capsys):
+    config = {'containers': dict(('c%d' % i, {
+        'image': 'img',
+        'links': {'c%d' % (i // 2): 'parent'} if i else {},
+        'ports': {8000 + i: 80}}) for i in range(16)),
+        'groups': {'all': ['c%d' % i for i in range(16)]}}
+    ctx = dockman.CONTEXT = context.Context(path='p', config=config)
+    engine = FakeEngine()
+    docker = dockman.DOCKER = SafeDocker(_engine=engine)
+
+    ctx.up('all')
+    assert docker.running_container_names('p') == sorted(
+        'p.c%d' % i for i in range(16))
+
+    ctx.down('all')
+    ctx.up('all')
+    assert len(docker.running_container_names('p')) == 16
+    ports = set(c['NetworkSettings']['Ports']['80/tcp'][0]['HostPort']
+                for c in engine.containers.values())
+    assert len(ports) == 16
@@ -0,0 +1,84 @@
+# encoding: utf-8
+import json
+import os
+
+from dockman.docker import SafeDocker
+from dockman.jsonlog import JsonLogReader, normalize_timestamp
+
+
+def path(relpath):
+    return os.path.join(os.path.dirname(__file__), relpath)
+
+
+def ts(seconds):
+    return normalize_timestamp('2015-01-26T15:03:%sZ' % seconds)
+
+
+def test_normalize_timestamp():
+    assert ts('01.5') == '2015-01-26T15:03:01.500000000Z'
+    assert ts('04') == '2015-01-26T15:03:04.000000000Z'
+
+
+def test_reader():
+    reader = JsonLogReader(path('jsonlog_01'))
+    lines = [line for _, line in reader.lines()]
+    assert lines == ['one', 'two', 'three', 'four \xc3\xa1', 'five']
+
+    assert [l for _, l in reader.lines(since=ts('02'))] == [
+        'two', 'three', 'four \xc3\xa1', 'five']
+    assert [l for _, l in reader.lines(since=ts('02.1'))] == [
+        'three', 'four \xc3\xa1', 'five']
+    assert [l for _, l in reader.lines(since=ts('07'))] == []
+    assert [l for _, l in reader.lines(until=ts('02.12'))] == [
+        'one', 'two', 'three']
+    assert [l for _, l in reader.lines(since=ts('02'), until=ts('05'),
+                                       tail=2)] == ['three', 'four \xc3\xa1']
+    assert [l for _, l in reader.lines(tail=10)] == lines
+    reader.close()
+
+    # binary search on a longer file
+    for start in (0, 1, 500, 998, 999):
+        since = '2015-01-26T15:00:00.%09dZ' % start
+        reader.mm = ''.join(
+            json.dumps({'log': '%s\n' % i,
+                        'time': '2015-01-26T15:00:00.%09dZ' % i}) + '\n'
+            for i in range(999))
+        reader.size = len(reader.mm)
+        assert next(reader.lines(since=since), (None, None))[1] == (
+            str(start) if start < 999 else None)
+
+
+def test_direct_history(capsys):
+    info = [{'Name': '/src.a', 'LogPath': path('jsonlog_01')},
+            {'Name': '/src.b', 'LogPath': path('jsonlog_02')},
+            {'Name': '/src.c', 'LogPath': path('nothing')}]
+    docker = SafeDocker(_output=['1\n2\n3\n', json.dumps(info)])
+    docker.logs(['src.a', 'src.b'], since='2015-01-26T15:03:02Z',
+                until='2015-01-26T15:03:05Z', direct=True)
+    out, _ = capsys.readouterr()
+    assert out == ('src.a: two\n'
+                   'src.a: three\n'
+                   'src.b: other\n'
+                   u'src.a: four \xe1\n')
+
+
+def test_direct_history_unreadable(capsys):
+    # the docker directory is usually 0700: docker logs reads the rest
+    info = [{'Name': '/src.a', 'LogPath': path('jsonlog_01')},
+            {'Name': '/src.postgres', 'LogPath': path('nothing')}]
+    docker = SafeDocker(_output=['1\n2\n', json.dumps(info)],
+                        _popenout_filename=path('logs_03_'))
+    docker.logs(['src.a', 'src.postgres'], since='2015-01-26T15:03:02Z',
+                until='2015-01-26T15:03:05Z', direct=True)
+    assert docker._cmd == ['docker', 'logs', '-t',
+                           '--since', '2015-01-26T15:03:02Z',
+                           '--until', '2015-01-26T15:03:05Z', 'src.postgres']
+    out, err = capsys.readouterr()
+    assert 'src.postgres: cannot read %s' % path('nothing') in out + err
+    # the fake docker logs ignores since and until, merged in time order
+    assert out.endswith('src.postgres: a_1\n'
+                        'src.a: two\n'
+                        'src.a: three\n'
+                        'src.postgres: a_2\n'
+                        u'src.a: four \xe1\n'
+                        'src.postgres: a_3\n')
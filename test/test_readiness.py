@@ -0,0 +1,94 @@
+import os
+import socket
+
+import pytest
+
+import dockman
+from dockman import readiness
+from dockman.container import Container
+from dockman.docker import Docker, SafeDocker
+from dockman.utils import WrongConfigException
+
+
+def path(relpath):
+    return os.path.join(os.path.dirname(__file__), relpath)
+
+
+def wait(probe, timeout=2):
+    probe.timeout = timeout
+    probe.deadline = probe.deadline - readiness.DEFAULT_TIMEOUT + timeout
+    while not probe.poll():
+        pass
+
+
+def test_config():
+    c = Container('foo', 'bar', '', {'image': 'i'})
+    assert c.probe() is None
+
+    c = Container('foo', 'bar', '', {'image': 'i',
+                                     'ready': {'cmd': 'pg_isready -q',
+                                               'timeout': 5}})
+    probe = c.probe()
+    assert isinstance(probe, readiness.ExecProbe)
+    assert probe.cmd == ['pg_isready', '-q']
+    assert probe.timeout == 5
+    assert probe is not c.probe()
+
+    for ready in ('yes', {'timeout': 5}, {'port': 1, 'log': 'x'},
+                  {'log': '('}, {'port': '5432'}, {'port': 0},
+                  {'port': 1, 'timeout': '60s'}, {'log': 'x', 'timeout': 0},
+                  {'log': 'x', 'interval': -1}, {'log': 'x', 'timeout': True},
+                  {'port': 1, 'host': 127}, {'cmd': ['pg_isready']},
+                  {'log': 1}):
+        with pytest.raises(WrongConfigException):
+            Container('foo', 'bar', '', {'image': 'i', 'ready': ready})
+
+
+def test_probe_abstract():
+    with pytest.raises(TypeError):
+        readiness.Probe('bar.foo')
+
+
+def test_port_probe():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    port = server.getsockname()[1]
+
+    probe = readiness.PortProbe('bar.foo', port, '127.0.0.1', interval=0)
+    assert not probe.poll()
+    server.listen(1)
+    wait(probe)
+    assert probe.sock is None
+    server.close()
+
+    dockman.DOCKER = SafeDocker(_output=['127.0.0.1\n'])
+    probe = readiness.PortProbe('bar.foo', port, interval=0)
+    assert probe.address() == ('127.0.0.1', port)
+    assert dockman.DOCKER._cmd[-1] == 'bar.foo'
+
+
+def test_port_probe_timeout():
+    probe = readiness.PortProbe('bar.foo', 1, '127.0.0.1', timeout=0)
+    with pytest.raises(readiness.NotReadyError):
+        probe.poll()
+
+
+def test_exec_probe():
+    dockman.DOCKER = Docker(command=['true'])
+    wait(readiness.ExecProbe('bar.foo', ['pg_isready'], interval=0))
+
+    dockman.DOCKER = Docker(command=['false'])
+    probe = readiness.ExecProbe('bar.foo', ['pg_isready'], interval=0)
+    with pytest.raises(readiness.NotReadyError):
+        wait(probe, timeout=0.3)
+    assert probe.process is None
+
+
+def test_log_probe():
+    dockman.DOCKER = SafeDocker(_popenout_filename=path('logs_02_'))
+    wait(readiness.LogProbe('src.postgres', r'postgres_2$', interval=0))
+    assert dockman.DOCKER._cmd[-2:] == ['--tail=all', 'src.postgres']
+
+    probe = readiness.LogProbe('src.postgres', 'never', interval=0)
+    with pytest.raises(readiness.NotReadyError):
+        wait(probe, timeout=0.2)
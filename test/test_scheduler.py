@@ -0,0 +1,159 @@
+import threading
+import time
+
+import pytest
+
+from dockman.scheduler import Scheduler
+
+
+class TestException(Exception):
+    pass
+
+
+DEPS = {'a': [], 'b': ['a'], 'c': ['a'], 'd': ['b', 'c'], 'e': []}
+
+
+def test_order():
+    lock = threading.Lock()
+    finished = []
+
+    def func(node):
+        time.sleep(0.01)
+        for dep in DEPS[node]:
+            assert dep in finished
+        with lock:
+            finished.append(node)
+
+    Scheduler(sorted(DEPS), DEPS.get, func, workers=3).run()
+    assert sorted(finished) == ['a', 'b', 'c', 'd', 'e']
+
+
+def test_bounded_pool():
+    lock = threading.Lock()
+    counters = {'running': 0, 'max': 0}
+
+    def func(node):
+        with lock:
+            counters['running'] += 1
+            counters['max'] = max(counters['max'], counters['running'])
+        time.sleep(0.02)
+        with lock:
+            counters['running'] -= 1
+
+    nodes = range(10)
+    Scheduler(nodes, lambda n: [], func, workers=3).run()
+    assert counters['max'] == 3
+
+
+def test_dependencies_outside_nodes_are_ignored():
+    started = []
+    Scheduler(['b', 'd'], DEPS.get, started.append).run()
+    assert sorted(started) == ['b', 'd']
+
+
+def test_failure_stops_dependents():
+    started = []
+
+    def func(node):
+        started.append(node)
+        if node == 'b':
+            raise TestException()
+
+    with pytest.raises(TestException):
+        Scheduler(['a', 'b', 'd'], DEPS.get, func, workers=1).run()
+    assert started == ['a', 'b']
+
+
+def test_failure_stops_queued():
+    started = []
+
+    def func(node):
+        started.append(node)
+        if node == 'a':
+            raise TestException()
+
+    # all of them are queued at once, only a runs
+    scheduler = Scheduler(list('abcdefgh'), lambda n: [], func, workers=1)
+    with pytest.raises(TestException):
+        scheduler.run()
+    assert started == ['a']
+    assert sorted(scheduler.skipped) == list('bcdefgh')
+
+
+class FakeProbe(object):
+    def __init__(self, polls, error=None):
+        self.polls = polls
+        self.error = error
+        self.closed = False
+
+    def poll(self):
+        self.polls -= 1
+        if self.polls > 0:
+            return False
+        if self.error:
+            raise self.error
+        return True
+
+    def close(self):
+        self.closed = True
+
+
+def test_probes():
+    lock = threading.Lock()
+    events = []
+    probes = {'a': FakeProbe(3), 'e': FakeProbe(3)}
+
+    def func(node):
+        with lock:
+            events.append(node)
+        return probes.get(node)
+
+    # the probes of a and e are pending at the same time on one worker
+    Scheduler(sorted(DEPS), DEPS.get, func, workers=1).run()
+    assert events[:2] == ['a', 'e']
+    assert sorted(events) == ['a', 'b', 'c', 'd', 'e']
+
+
+def test_probe_failure():
+    started = []
+    probes = {'a': FakeProbe(2, error=TestException()),
+              'e': FakeProbe(100)}
+
+    def func(node):
+        started.append(node)
+        return probes.get(node)
+
+    with pytest.raises(TestException):
+        Scheduler(['a', 'b', 'e'], DEPS.get, func).run()
+    assert sorted(started) == ['a', 'e']
+    assert probes['e'].closed
+
+
+def test_batch():
+    calls = []
+
+    def func(nodes):
+        calls.append(sorted(nodes))
+        return {'c': TestException()} if 'c' in nodes else {}
+
+    batch = {'b': 'x', 'c': 'x', 'e': 'x'}.get
+    with pytest.raises(TestException):
+        Scheduler(sorted(DEPS), DEPS.get, func, batch=batch).run()
+    assert sorted(calls) == [['a'], ['b', 'c'], ['e']]
+
+
+def test_priority():
+    started = []
+    priority = {'a': 1, 'b': 1, 'c': 5, 'd': 0, 'e': 10}
+
+    def func(node):
+        started.append(node)
+        return FakeProbe(3) if node == 'a' else None
+
+    scheduler = Scheduler(sorted(DEPS), DEPS.get, func, workers=1,
+                          priority=priority.get)
+    scheduler.run()
+    assert started == ['e', 'a', 'c', 'b', 'd']
+    assert sorted(scheduler.durations) == ['a', 'b', 'c', 'd', 'e']
+    # a is done only once its probe is
+    assert scheduler.durations['a'] > scheduler.durations['b']
@@ -0,0 +1,80 @@
+# encoding: utf-8
+import json
+import threading
+
+import pytest
+from click.testing import CliRunner
+
+import dockman
+from dockman import dockman as commands
+from dockman import trace
+from dockman.context import Context
+from dockman.docker import Docker, DockerError, SafeDocker
+from test.fake import FakeEngine
+
+
+@pytest.fixture(autouse=True)
+def disabled():
+    yield
+    trace.disable()
+
+
+def test_disabled():
+    assert trace.span('docker ps') is trace.NULL_SPAN
+    with trace.span('docker ps') as span:
+        span.note('status', 200)
+    Docker(command=['true']).execute(['ps'])
+    assert trace.TRACER is None
+
+
+def test_spans(tmpdir, capsys):
+    tracer = trace.enable()
+    Docker(command=['echo']).execute(['ps', '-a'])
+    with pytest.raises(DockerError):
+        Docker(command=['false']).execute(['stop', 'p.a'])
+
+    def work():
+        with trace.span('start', 'phase'):
+            pass
+    thread = threading.Thread(target=work, name='worker')
+    thread.start()
+    thread.join()
+
+    names = [(s['name'], s['thread'], s['outcome']) for s in tracer.spans]
+    assert names == [('docker ps', 'MainThread', 'ok'),
+                     ('docker stop', 'MainThread', 'DockerError: '),
+                     ('start', 'worker', 'ok')]
+    assert tracer.spans[0]['args'] == {'argv': ['echo', 'ps', '-a']}
+
+    path = str(tmpdir.join('trace.json'))
+    tracer.write(path)
+    events = json.load(open(path))['traceEvents']
+    assert [(e['ph'], e['tid'], e['args']['name'])
+            for e in events if e['ph'] == 'M'] == [
+                ('M', 1, 'MainThread'), ('M', 2, 'worker')]
+    calls = [e for e in events if e['ph'] == 'X']
+    assert calls[0]['args'] == {'argv': 'echo ps -a', 'outcome': 'ok'}
+    assert calls[2]['cat'] == 'phase' and calls[2]['tid'] == 2
+    assert all(e['dur'] >= 0 for e in calls)
+
+    tracer.timings()
+    out = capsys.readouterr()[0]
+    assert '2 docker calls' in out
+    assert 'error    false stop p.a' in out
+
+
+def test_command(tmpdir):
+    config = {'containers': {'a': {'image': 'a'}}, 'groups': {'all': ['a']}}
+    dockman.CONTEXT = Context(path='p', config=config)
+    dockman.DOCKER = SafeDocker(_engine=FakeEngine())
+    path = str(tmpdir.join('trace.json'))
+
+    result = CliRunner().invoke(commands.main, ['--trace', path,
+                                                '--timings', 'up', 'all'])
+    assert result.exit_code == 0
+    assert 'pull images' in result.output
+    assert 'docker calls' in result.output
+    phases = [e['name'] for e in json.load(open(path))['traceEvents']
+              if e.get('cat') == 'phase']
+    assert phases == ['plan', 'pull images', 'start']
+    assert trace.TRACER is None